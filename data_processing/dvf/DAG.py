@@ -21,6 +21,7 @@ from datagouvfr_data_pipelines.data_processing.dvf.task_functions import (
     index_dvf_table,
     create_stats_dvf_table,
     get_epci,
+    build_dvf_year_store,
     populate_stats_dvf_table,
     process_dvf_stats,
     publish_stats_dvf,
@@ -143,6 +144,11 @@ with DAG(
         python_callable=get_epci,
     )
 
+    build_dvf_year_store = PythonOperator(
+        task_id='build_dvf_year_store',
+        python_callable=build_dvf_year_store,
+    )
+
     process_dvf_stats = PythonOperator(
         task_id='process_dvf_stats',
         python_callable=process_dvf_stats,
@@ -226,7 +232,9 @@ with DAG(
     index_dvf_table.set_upstream(alter_dvf_table)
 
     get_epci.set_upstream(download_dvf_data)
+    build_dvf_year_store.set_upstream(download_dvf_data)
     process_dvf_stats.set_upstream(get_epci)
+    process_dvf_stats.set_upstream(build_dvf_year_store)
 
     create_distribution_and_stats_whole_period.set_upstream(process_dvf_stats)
 
@@ -1,10 +1,17 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import duckdb
 import gc
 import glob
+import hashlib
 from unidecode import unidecode
 import numpy as np
 import os
 import pandas as pd
 import requests
+import shutil
+import tempfile
+import time
 from datetime import datetime
 import json
 from functools import reduce
@@ -20,9 +27,11 @@ from datagouvfr_data_pipelines.config import (
 )
 from datagouvfr_data_pipelines.utils.postgres import (
     execute_sql_file,
-    copy_file
+    copy_file,
+    bulk_load_files,
 )
 from datagouvfr_data_pipelines.utils.datagouv import post_remote_resource, DATAGOUV_URL
+from datagouvfr_data_pipelines.utils.utils import get_peak_memory_mb
 from datagouvfr_data_pipelines.utils.mattermost import send_message
 from datagouvfr_data_pipelines.utils.minio import MinIOClient
 
@@ -39,6 +48,19 @@ else:
 minio_restricted = MinIOClient(bucket=MINIO_BUCKET_DATA_PIPELINE)
 minio_open = MinIOClient(bucket=MINIO_BUCKET_DATA_PIPELINE_OPEN)
 
+# the cleaned years are cached on Minio, keyed by the hash of their source file
+# bump the version if the cleaning changes, so that the cache is rebuilt
+DVF_STORE_VERSION = 1
+DVF_STORE_FOLDER = "dvf/year_store/"
+natures_of_interest = [
+    "Vente",
+    "Vente en l'état futur d'achèvement",
+    "Adjudication",
+]
+types_of_interest = [1, 2, 4]
+# processes sharing the computation of price distributions
+DISTRIBUTION_MAX_WORKERS = 4
+
 
 def get_year_interval():
     today = datetime.today()
@@ -268,7 +290,22 @@ def populate_distribution_table():
 def populate_dvf_table():
     files = glob.glob(f"{DATADIR}/full*.csv")
     table = f'{schema}.dvf' if schema else "dvf"
-    populate_utils(files, table, True)
+    # yearly files are loaded concurrently, and only land in the table if all succeed
+    bulk_load_files(
+        PG_HOST=conn.host,
+        PG_PORT=conn.port,
+        PG_DB=conn.schema,
+        PG_TABLE=table,
+        PG_USER=conn.login,
+        PG_PASSWORD=conn.password,
+        list_files=[
+            {"source_path": f"{DATADIR}/", "source_name": file.split("/")[-1]}
+            for file in files
+        ],
+        PG_SCHEMA=schema,
+        has_header=True,
+        max_workers=len(files),
+    )
 
 
 def alter_dvf_table():
@@ -326,94 +363,131 @@ def get_epci():
     ).to_csv(DATADIR + "/epci.csv", sep=",", encoding="utf8", index=False)
 
 
+def partition_bdnb_file(
+    file_path: str,
+    columns: list,
+    spill_dir: str,
+    name: str,
+    prefix_length: int = 9,
+    chunk_size: int = 100000,
+) -> list:
+    """Spread the rows of a BDNB file across spill files, according to the prefix of their id
+
+    Args:
+        file_path (str): path of the file to partition
+        columns (list): columns to keep
+        spill_dir (str): where to write the spill files
+        name (str): prefix of the spill files' names
+        prefix_length (int): number of characters of batiment_groupe_id to partition on
+        chunk_size (int): number of rows read at once
+
+    Returns:
+        list: the id prefixes found, in order of appearance
+    """
+    spill_files = {}
+    try:
+        for chunk in pd.read_csv(
+            file_path,
+            dtype=str,
+            usecols=columns,
+            sep=";",
+            chunksize=chunk_size,
+        ):
+            grouped = chunk.groupby(
+                chunk["batiment_groupe_id"].str.slice(0, prefix_length),
+                sort=False,
+            )
+            for pref, part in grouped:
+                is_new = pref not in spill_files
+                if is_new:
+                    spill_files[pref] = open(os.path.join(spill_dir, f"{name}_{pref}.csv"), "w")
+                part.to_csv(spill_files[pref], index=False, header=is_new)
+    finally:
+        for f in spill_files.values():
+            f.close()
+    return list(spill_files)
+
+
 def process_dpe():
-    cols_dpe = {
-        'batiment_groupe_id': str,
+    cols_dpe = [
+        'batiment_groupe_id',
         # 'identifiant_dpe',
         # 'type_batiment_dpe',
-        'periode_construction_dpe': "category",
+        'periode_construction_dpe',
         # 'annee_construction_dpe',
         # 'date_etablissement_dpe',
         # 'nombre_niveau_logement',
-        'nombre_niveau_immeuble': str,
-        'surface_habitable_immeuble': str,
+        'nombre_niveau_immeuble',
+        'surface_habitable_immeuble',
         # 'surface_habitable_logement',
-        'classe_bilan_dpe': "category",
-        'classe_emission_ges': "category",
-    }
+        'classe_bilan_dpe',
+        'classe_emission_ges',
+    ]
     cols_parcelles = [
         "batiment_groupe_id",
         "parcelle_id"
     ]
-    print("Import des batiment_id pour imports segmentés")
     # these files are too big to be loaded at once
     # ids look like this: "bdnb-bg-5CWD-3J5Q-VEGE"
     # they seem to be in even groups if considering the "bdnb-bg-X" prefix
-    # we'll loop through these to merge subparts and append them
+    # so each file is read once and split by prefix into spill files,
+    # which are then merged prefix by prefix
     # if this becomes too heavy we can move down one more character for prefixes
-    bat_id = pd.read_csv(
-        DATADIR + '/csv/batiment_groupe_dpe_representatif_logement.csv',
-        usecols=["batiment_groupe_id"],
-        sep=";",
-    )
-    prefixes = list(bat_id['batiment_groupe_id'].str.slice(0, 9).unique())
-    print(f"{len(prefixes)} prefixes to process")
-    del bat_id
-    print("Imports et traitements DPE x parcelles par batch...")
-    chunk_size = 100000
-    for idx, pref in enumerate(prefixes):
-        iter_dpe = pd.read_csv(
+    spill_dir = tempfile.mkdtemp(dir=DATADIR)
+    try:
+        start = time.time()
+        print("Partitionnement des DPE par préfixe...")
+        prefixes = partition_bdnb_file(
             DATADIR + '/csv/batiment_groupe_dpe_representatif_logement.csv',
-            dtype=cols_dpe,
-            usecols=cols_dpe.keys(),
-            sep=";",
-            iterator=True,
-            chunksize=chunk_size,
+            cols_dpe,
+            spill_dir,
+            "dpe",
         )
-        # dpe['date_etablissement_dpe'] = dpe['date_etablissement_dpe'].str.slice(0, 10)
-        # dpe['surface_habitable_logement'] = dpe['surface_habitable_logement'].apply(
-        #     lambda x: round(float(x), 2)
-        # )
-        dpe = pd.concat([
-            chunk.loc[chunk["batiment_groupe_id"].str.startswith(pref)]
-            for chunk in iter_dpe
-        ])
-        del iter_dpe
-        print(f"> Processing {pref}: {len(dpe)} values ({idx + 1}/{len(prefixes)})")
-        dpe.set_index('batiment_groupe_id', inplace=True)
-        iter_parcelles = pd.read_csv(
+        print(f"> Done in {round(time.time() - start, 2)}s, {len(prefixes)} prefixes to process")
+        step = time.time()
+        print("Partitionnement des parcelles par préfixe...")
+        prefixes_parcelles = set(partition_bdnb_file(
             DATADIR + '/csv/rel_batiment_groupe_parcelle.csv',
-            dtype=str,
-            usecols=cols_parcelles,
-            sep=";",
-            iterator=True,
-            chunksize=chunk_size,
-        )
-        parcelles = pd.concat([
-            chunk.loc[chunk["batiment_groupe_id"].str.startswith(pref)]
-            for chunk in iter_parcelles
-        ])
-        del iter_parcelles
-        parcelles.set_index('batiment_groupe_id', inplace=True)
-        print("  Merging...")
-        dpe_parcelled = dpe.join(
-            parcelles,
-            on='batiment_groupe_id',
-            how='left'
-        )
-        del dpe
-        del parcelles
-        dpe_parcelled.reset_index(inplace=True)
-        dpe_parcelled = dpe_parcelled.dropna(subset=['parcelle_id'])
-        dpe_parcelled.to_csv(
-            DATADIR + "/all_dpe.csv",
-            sep=",",
-            index=False,
-            encoding="utf8",
-            header=False,
-            mode="w" if idx == 0 else "a",
-        )
-        del dpe_parcelled
+            cols_parcelles,
+            spill_dir,
+            "parcelles",
+        ))
+        print(f"> Done in {round(time.time() - step, 2)}s")
+        step = time.time()
+        print("Traitements DPE x parcelles par préfixe...")
+        with open(DATADIR + "/all_dpe.csv", "w", encoding="utf8") as output:
+            for idx, pref in enumerate(prefixes):
+                if pref not in prefixes_parcelles:
+                    print(f"> No parcelle for {pref}, skipping ({idx + 1}/{len(prefixes)})")
+                    continue
+                dpe = pd.read_csv(os.path.join(spill_dir, f"dpe_{pref}.csv"), dtype=str)
+                print(f"> Processing {pref}: {len(dpe)} values ({idx + 1}/{len(prefixes)})")
+                dpe.set_index('batiment_groupe_id', inplace=True)
+                parcelles = pd.read_csv(os.path.join(spill_dir, f"parcelles_{pref}.csv"), dtype=str)
+                parcelles.set_index('batiment_groupe_id', inplace=True)
+                dpe_parcelled = dpe.join(
+                    parcelles,
+                    on='batiment_groupe_id',
+                    how='left'
+                )
+                del dpe
+                del parcelles
+                dpe_parcelled.reset_index(inplace=True)
+                dpe_parcelled = dpe_parcelled.dropna(subset=['parcelle_id'])
+                dpe_parcelled.to_csv(
+                    output,
+                    sep=",",
+                    index=False,
+                    header=False,
+                )
+                del dpe_parcelled
+        print(f"> Done in {round(time.time() - step, 2)}s")
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    print(
+        f"DPE x parcelles done in {round(time.time() - start, 2)}s "
+        f"(peak memory {get_peak_memory_mb()} MB)"
+    )
 
 
 def index_dpe_table():
@@ -433,14 +507,184 @@ def index_dpe_table():
     )
 
 
-def process_dvf_stats():
-    years = sorted(
+def get_dvf_years():
+    return sorted(
         [
             int(f.replace("full_", "").replace(".csv", ""))
             for f in os.listdir(DATADIR)
             if "full_" in f and ".gz" not in f
         ]
     )
+
+
+def get_file_hash(file_path: str, chunk_size: int = 1024 ** 2) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_dvf_store_path(year: int) -> str:
+    return f"{DATADIR}/dvf_{year}.parquet"
+
+
+def clean_dvf_year(year: int) -> pd.DataFrame:
+    df = pd.read_csv(
+        DATADIR + f"/full_{year}.csv",
+        sep=",",
+        encoding="utf8",
+        dtype={
+            "code_commune": str,
+            "code_departement": str,
+        },
+        usecols=[
+            "id_mutation",
+            "date_mutation",
+            "code_departement",
+            "code_commune",
+            "id_parcelle",
+            "nature_mutation",
+            "code_type_local",
+            "type_local",
+            "valeur_fonciere",
+            "surface_reelle_bati",
+        ],
+    )
+    # les fichiers d'entrée contiennent entre 4 et 8% de doublons purs
+    df = df.drop_duplicates()
+    df["code_section"] = df["id_parcelle"].str[:10]
+    # date_mutation est au format YYYY-MM-DD
+    df["month"] = df["date_mutation"].str[5:7].astype(int)
+
+    # filtres sur les ventes et les types de biens à considérer
+    # choix : les terres et/ou dépendances ne rendent pas une mutation
+    # multi-type
+    df["is_vente"] = (
+        (df["nature_mutation"].isin(natures_of_interest)) &
+        (df["code_type_local"].isin(types_of_interest))
+    )
+    # on repère les ventes d'un seul bien
+    # cf historique pour les ventes multi-types
+    count_ventes = df.loc[df["is_vente"], "id_mutation"].value_counts()
+    df["is_monobien"] = df["is_vente"] & df["id_mutation"].isin(
+        count_ventes.index[count_ventes == 1]
+    )
+    df["prix_m2"] = (
+        df["valeur_fonciere"] /
+        df["surface_reelle_bati"]
+    ).replace([np.inf, -np.inf], np.nan)
+    return df[[
+        "code_departement",
+        "code_commune",
+        "code_section",
+        "month",
+        "code_type_local",
+        "type_local",
+        "prix_m2",
+        "is_vente",
+        "is_monobien",
+    ]]
+
+
+def build_dvf_year_store():
+    # each year is parsed and cleaned once, the stats tasks then read
+    # only the columns they need from the parquet files
+    cached = set(
+        f.split("/")[-1] for f in minio_restricted.get_files_from_prefix(DVF_STORE_FOLDER)
+    )
+    for year in get_dvf_years():
+        file_hash = get_file_hash(DATADIR + f"/full_{year}.csv")
+        store_name = f"dvf_{year}_{file_hash[:16]}_v{DVF_STORE_VERSION}.parquet"
+        if store_name in cached:
+            print(f"Using cached store for {year}")
+            minio_restricted.download_files(
+                list_files=[
+                    {
+                        "source_path": DVF_STORE_FOLDER,
+                        "source_name": store_name,
+                        "dest_path": "",
+                        "dest_name": get_dvf_store_path(year),
+                    }
+                ],
+            )
+            continue
+        print(f"Building store for {year}")
+        df = clean_dvf_year(year)
+        duckdb.from_df(df).write_parquet(get_dvf_store_path(year), compression="zstd")
+        del df
+        gc.collect()
+        minio_restricted.send_files(
+            list_files=[
+                {
+                    "source_path": f"{DATADIR}/",
+                    "source_name": get_dvf_store_path(year).split("/")[-1],
+                    "dest_path": DVF_STORE_FOLDER,
+                    "dest_name": store_name,
+                    "content_type": "application/octet-stream",
+                }
+            ],
+        )
+        # the stores of the previous versions of this year's file are not needed anymore
+        for old_store in cached:
+            if old_store.startswith(f"dvf_{year}_") and old_store != store_name:
+                minio_restricted.delete_file(
+                    file_path=f"{AIRFLOW_ENV}/{DVF_STORE_FOLDER}{old_store}"
+                )
+
+
+def read_dvf_year(year: int, columns: list, where: str = None) -> pd.DataFrame:
+    # duckdb only reads the requested columns (and row groups) of the file
+    rel = duckdb.read_parquet(get_dvf_store_path(year))
+    if where:
+        rel = rel.filter(where)
+    return rel.select(", ".join(columns)).df()
+
+
+def build_month_stats(
+    stats: pd.DataFrame,
+    stats_apt_maison: pd.DataFrame,
+    echelle: str,
+    month: int,
+) -> pd.DataFrame:
+    # stats contient count, mean et median des prix au m² par code, mois et type_local
+    # et stats_apt_maison les mêmes agrégats par code et mois pour les appartements et maisons
+    month_stats = stats.loc[stats.index.get_level_values(1) == month]
+    merged = None
+    for agg, prefix in [
+        ("count", "nb_ventes_"),
+        ("mean", "moy_prix_m2_"),
+        ("median", "med_prix_m2_"),
+    ]:
+        agg_ = (
+            month_stats[agg]
+            .unstack()
+            .reset_index()
+            .drop("month", axis=1)
+        )
+        agg_.columns = [
+            prefix + unidecode(c.split(" ")[0].lower())
+            if c != f"code_{echelle}"
+            else c
+            for c in agg_.columns
+        ]
+        merged = agg_ if merged is None else pd.merge(merged, agg_, on=[f"code_{echelle}"])
+
+    # appartement + maison
+    month_stats = stats_apt_maison.loc[stats_apt_maison.index.get_level_values(1) == month]
+    for agg, column, how in [
+        ("count", "nb_ventes_apt_maison", "outer"),
+        ("mean", "moy_prix_m2_apt_maison", "inner"),
+        ("median", "med_prix_m2_apt_maison", "inner"),
+    ]:
+        agg_ = month_stats[agg].unstack().reset_index()
+        agg_.columns = [f"code_{echelle}", column]
+        merged = pd.merge(merged, agg_, on=[f"code_{echelle}"], how=how)
+    return merged
+
+
+def process_dvf_stats():
+    years = get_dvf_years()
     export = {}
     epci = pd.read_csv(
         DATADIR + "/epci.csv",
@@ -450,97 +694,58 @@ def process_dvf_stats():
     )
     sections_from_dvf = set()
     communes_from_dvf = set()
-    to_keep = [
-        "id_mutation",
-        "date_mutation",
-        "code_departement",
-        "code_commune",
-        "id_parcelle",
-        "nature_mutation",
-        "code_type_local",
-        "type_local",
-        "valeur_fonciere",
-        "surface_reelle_bati",
-    ]
-    natures_of_interest = [
-        "Vente",
-        "Vente en l'état futur d'achèvement",
-        "Adjudication",
-    ]
-    types_of_interest = [1, 2, 4]
     echelles_of_interest = ["departement", "epci", "commune", "section"]
     for year in years:
         print("Starting with", year)
-        df_ = pd.read_csv(
-            DATADIR + f"/full_{year}.csv",
-            sep=",",
-            encoding="utf8",
-            dtype={
-                "code_commune": str,
-                "code_departement": str,
-            },
-            usecols=to_keep,
+        # les doublons purs ont été retirés à la construction du store
+        codes = read_dvf_year(year, ["code_section", "code_commune"])
+        sections_from_dvf = sections_from_dvf | set(codes['code_section'].unique())
+        communes_from_dvf = communes_from_dvf | set(codes['code_commune'].unique())
+        del codes
+
+        # types_bien = {
+        #     1: "Maison",
+        #     2: "Appartement",
+        #     3: "Dépendance",
+        #     4: "Local industriel. commercial ou assimilé",
+        #     NaN: terres (cf nature_culture)
+        # }
+
+        # ventes filtrées sur les natures et types de biens à considérer
+        ventes = read_dvf_year(
+            year,
+            [
+                "code_departement",
+                "code_commune",
+                "code_section",
+                "month",
+                "code_type_local",
+                "type_local",
+                "prix_m2",
+                "is_monobien",
+            ],
+            where="is_vente",
         )
-        # les fichiers d'entrée contiennent entre 4 et 8% de doublons purs
-        df = df_.drop_duplicates()
         # certaines communes ne sont pas dans des EPCI
-        df = pd.merge(
-            df,
+        ventes = pd.merge(
+            ventes,
             epci[['code_commune', 'code_epci']],
             on="code_commune",
             how="left"
         )
-        df["code_section"] = df["id_parcelle"].str[:10]
-        sections_from_dvf = sections_from_dvf | set(df['code_section'].unique())
-        communes_from_dvf = communes_from_dvf | set(df['code_commune'].unique())
-        df = df.drop("id_parcelle", axis=1)
-
         types_bien = {
             k: v
-            for k, v in df_[["code_type_local", "type_local"]]
+            for k, v in ventes[["code_type_local", "type_local"]]
             .value_counts()
             .to_dict()
             .keys()
         }
-        del df_
-
-        # types_bien = {
-        #     1: "Maison",
-        #     2: "Appartement",
-        #     3: "Dépendance",
-        #     4: "Local industriel. commercial ou assimilé",
-        #     NaN: terres (cf nature_culture)
-        # }
-
-        # filtres sur les ventes et les types de biens à considérer
-        # choix : les terres et/ou dépendances ne rendent pas une mutation
-        # multi-type
-        ventes = df.loc[
-            (df["nature_mutation"].isin(natures_of_interest)) &
-            (df["code_type_local"].isin(types_of_interest))
-        ]
-        del df
-        ventes["month"] = (
-            ventes["date_mutation"]
-            .apply(lambda x: int(x.split("-")[1]))
-        )
         print("Après déduplication et filtre types et natures :", len(ventes))
 
         # on ne garde que les ventes d'un seul bien
-        # cf historique pour les ventes multi-types
-        count_ventes = ventes['id_mutation'].value_counts().reset_index()
-        liste_ventes_monobien = count_ventes.loc[count_ventes['id_mutation'] == 1, 'index']
-        ventes_nodup = ventes.loc[ventes['id_mutation'].isin(liste_ventes_monobien)]
+        ventes_nodup = ventes.loc[ventes["is_monobien"]]
         print("Après filtrage des ventes de plusieurs biens :", len(ventes_nodup))
 
-        ventes_nodup["prix_m2"] = (
-            ventes_nodup["valeur_fonciere"] /
-            ventes_nodup["surface_reelle_bati"]
-        )
-        ventes_nodup["prix_m2"] = ventes_nodup["prix_m2"].replace(
-            [np.inf, -np.inf], np.nan
-        )
-
         # pas de prix ou pas de surface
         ventes_nodup = ventes_nodup.dropna(subset=["prix_m2"])
 
@@ -549,6 +754,31 @@ def process_dvf_stats():
         print("Après retrait des ventes sans prix au m² et valeurs aberrantes :", len(ventes_nodup))
         export_intermediary = []
 
+        # toutes les statistiques (échelle, mois, type) sont calculées en une seule passe
+        # groupée par échelle pour l'année, puis découpées par mois
+        apt_maison = ventes_nodup.loc[ventes_nodup["code_type_local"].isin([1, 2])]
+        stats_echelles = {
+            echelle: (
+                ventes_nodup.groupby(
+                    [f"code_{echelle}", "month", "type_local"]
+                )["prix_m2"].agg(["count", "mean", "median"]),
+                apt_maison.groupby(
+                    [f"code_{echelle}", "month"]
+                )["prix_m2"].agg(["count", "mean", "median"]),
+            )
+            for echelle in echelles_of_interest
+        }
+        # les nombres de ventes nationaux portent sur toutes les ventes filtrées
+        nb_nation = ventes.groupby(["month", "code_type_local"]).size()
+        nb_nation_apt_maison = ventes.loc[
+            ventes["code_type_local"].isin([1, 2])
+        ].groupby("month").size()
+        stats_nation = ventes_nodup.groupby(
+            ["month", "code_type_local"]
+        )["prix_m2"].agg(["mean", "median"])
+        stats_nation_apt_maison = apt_maison.groupby("month")["prix_m2"].agg(["mean", "median"])
+        del apt_maison
+
         # avoid unnecessary steps due to half years
         month_range = range(1, 13)
         if len(years) == 6:
@@ -560,90 +790,7 @@ def process_dvf_stats():
         for m in month_range:
             dfs_dict = {}
             for echelle in echelles_of_interest:
-                grouped = ventes_nodup.groupby(
-                    [f"code_{echelle}", "month", "type_local"]
-                )["prix_m2"]
-
-                nb = grouped.count()
-                nb_ = (
-                    nb.loc[nb.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                    .drop("month", axis=1)
-                )
-                nb_.columns = [
-                    "nb_ventes_" + unidecode(c.split(" ")[0].lower())
-                    if c != f"code_{echelle}"
-                    else c
-                    for c in nb_.columns
-                ]
-
-                mean = grouped.mean()
-                mean_ = (
-                    mean.loc[mean.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                    .drop("month", axis=1)
-                )
-                mean_.columns = [
-                    "moy_prix_m2_" + unidecode(c.split(" ")[0].lower())
-                    if c != f"code_{echelle}"
-                    else c
-                    for c in mean_.columns
-                ]
-
-                median = grouped.median()
-                median_ = (
-                    median.loc[median.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                    .drop("month", axis=1)
-                )
-                median_.columns = [
-                    "med_prix_m2_" + unidecode(c.split(" ")[0].lower())
-                    if c != f"code_{echelle}"
-                    else c
-                    for c in median_.columns
-                ]
-
-                merged = pd.merge(nb_, mean_, on=[f"code_{echelle}"])
-                merged = pd.merge(merged, median_, on=[f"code_{echelle}"])
-
-                # appartement + maison
-                combined = ventes_nodup.loc[
-                    ventes_nodup["code_type_local"].isin([1, 2])
-                ].groupby(
-                    [f"code_{echelle}", "month"]
-                )["prix_m2"]
-
-                nb = combined.count()
-                nb_ = (
-                    nb.loc[nb.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                )
-                nb_.columns = [f'code_{echelle}', 'nb_ventes_apt_maison']
-
-                mean = combined.mean()
-                mean_ = (
-                    mean.loc[mean.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                )
-                mean_.columns = [f'code_{echelle}', 'moy_prix_m2_apt_maison']
-
-                median = combined.median()
-                median_ = (
-                    median.loc[median.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                )
-                median_.columns = [f'code_{echelle}', 'med_prix_m2_apt_maison']
-
-                merged = pd.merge(merged, nb_, on=[f"code_{echelle}"], how="outer")
-                merged = pd.merge(merged, mean_, on=[f"code_{echelle}"])
-                merged = pd.merge(merged, median_, on=[f"code_{echelle}"])
-
+                merged = build_month_stats(*stats_echelles[echelle], echelle, m)
                 for c in merged.columns:
                     if any([k in c for k in ["moy_", "med_"]]):
                         merged[c] = merged[c].round()
@@ -656,54 +803,21 @@ def process_dvf_stats():
 
             general = {"code_geo": "nation"}
             for t in types_of_interest:
-                general[
-                    "nb_ventes_" + unidecode(
-                        types_bien[t].split(" ")[0].lower()
-                    )
-                ] = len(
-                    ventes.loc[
-                        (ventes["code_type_local"] == t) &
-                        (ventes["month"] == m)
-                    ]
-                )
-                general[
-                    "moy_prix_m2_" + unidecode(
-                        types_bien[t].split(" ")[0].lower()
-                    )
-                ] = np.round(
-                    ventes_nodup.loc[
-                        (ventes_nodup["code_type_local"] == t) &
-                        (ventes_nodup["month"] == m)
-                    ]["prix_m2"].mean()
+                libelle = unidecode(types_bien[t].split(" ")[0].lower())
+                general["nb_ventes_" + libelle] = nb_nation.get((m, t), 0)
+                general["moy_prix_m2_" + libelle] = np.round(
+                    stats_nation["mean"].get((m, t), np.nan)
                 )
-                general[
-                    "med_prix_m2_" + unidecode(
-                        types_bien[t].split(" ")[0].lower()
-                    )
-                ] = np.round(
-                    ventes_nodup.loc[
-                        (ventes_nodup["code_type_local"] == t) &
-                        (ventes_nodup["month"] == m)
-                    ]["prix_m2"].median()
+                general["med_prix_m2_" + libelle] = np.round(
+                    stats_nation["median"].get((m, t), np.nan)
                 )
 
-            general["nb_ventes_apt_maison"] = len(
-                ventes.loc[
-                    (ventes["code_type_local"].isin([1, 2])) &
-                    (ventes["month"] == m)
-                ]
-            )
+            general["nb_ventes_apt_maison"] = nb_nation_apt_maison.get(m, 0)
             general["moy_prix_m2_apt_maison"] = np.round(
-                ventes_nodup.loc[
-                    (ventes_nodup["code_type_local"].isin([1, 2])) &
-                    (ventes_nodup["month"] == m)
-                ]["prix_m2"].mean()
+                stats_nation_apt_maison["mean"].get(m, np.nan)
             )
             general["med_prix_m2_apt_maison"] = np.round(
-                ventes_nodup.loc[
-                    (ventes_nodup["code_type_local"].isin([1, 2])) &
-                    (ventes_nodup["month"] == m)
-                ]["prix_m2"].median()
+                stats_nation_apt_maison["median"].get(m, np.nan)
             )
 
             all_month = pd.concat(
@@ -716,6 +830,7 @@ def process_dvf_stats():
             del general
         export[year] = pd.concat(export_intermediary)
         del export_intermediary
+        del stats_echelles
         del ventes
         del ventes_nodup
         gc.collect()
@@ -867,63 +982,218 @@ def process_dvf_stats():
         print("Done with year " + str(year))
 
 
-def create_distribution_and_stats_whole_period():
-    def process_borne(borne, borne_inf, borne_sup):
-        # handle rounding of bounds
-        if round(borne, -2) <= borne_inf or round(borne, -2) >= borne_sup:
-            return round(borne)
-        else:
-            return round(borne, -2)
-
-    def distrib_from_prix(
+def process_borne(borne, borne_inf, borne_sup):
+    # handle rounding of bounds
+    if round(borne, -2) <= borne_inf or round(borne, -2) >= borne_sup:
+        return round(borne)
+    else:
+        return round(borne, -2)
+
+
+def spread_identical_bins(bins):
+    # handle case where rounding creates identical bins
+    if len(bins) != len(set(bins)):
+        # check how many times bounds appear
+        count_bins = sorted(Counter(bins).items())
+        # get ranges between redundant bounds and next ones
+        ranges = [
+            (count_bins[k + 1][0] - count_bins[k][0]) / count_bins[k][1]
+            for k in range(len(count_bins) - 1)
+        ]
+        # create new bins from bounds and intervals
+        new_bins = [bins[0]]
+        for idx, (_, b) in enumerate(count_bins[:-1]):
+            for k in range(b):
+                new_bins.append(new_bins[-1] + ranges[idx])
+        bins = list(map(round, new_bins))
+    return bins
+
+
+def distrib_from_prix(
+    prix,
+    nb_tranches=10,
+    arrondi=True
+):
+    # 1er et dernier quantiles gardés
+    # on coupe le reste des données en tranches égales de prix (!= volumes)
+    # .unique() pour éviter des bornes identique => ValueError
+    bins = np.quantile(prix.unique(), [k / nb_tranches for k in range(nb_tranches + 1)])
+    q = [[int(bins[k]), int(bins[k + 1])] for k in range(nb_tranches)]
+    size = (q[-1][0] - q[0][1]) / (nb_tranches - 2)
+    # to include the minimum price if it is equal to the lower bound, lower bound-1
+    inf = q[0][0] - 1 if min(prix) == int(min(prix)) else q[0][0]
+    # due to int, the upper bound is rounded down so +1 to include it
+    sup = q[-1][1] + 1
+    intervalles = [[inf, q[0][1]]] +\
+        [[q[0][1] + size * k, q[0][1] + size * (k + 1)]
+            for k in range(nb_tranches - 2)] +\
+        [[q[-1][0], sup]]
+    if arrondi:
+        # keep min and max values unchanged
+        borne_inf = intervalles[0][0]
+        borne_sup = intervalles[-1][1]
+        intervalles = [[borne_inf, process_borne(intervalles[0][1], borne_inf, borne_sup)]] + [
+            [process_borne(i[0], borne_inf, borne_sup), process_borne(i[1], borne_inf, borne_sup)]
+            for i in intervalles[1:-1]
+        ] + [[process_borne(intervalles[-1][0], borne_inf, borne_sup), borne_sup]]
+    bins = spread_identical_bins([i[0] for i in intervalles] + [intervalles[-1][1]])
+    volumes = pd.cut(
         prix,
-        nb_tranches=10,
-        arrondi=True
-    ):
-        # 1er et dernier quantiles gardés
-        # on coupe le reste des données en tranches égales de prix (!= volumes)
-        # .unique() pour éviter des bornes identique => ValueError
-        bins = np.quantile(prix.unique(), [k / nb_tranches for k in range(nb_tranches + 1)])
-        q = [[int(bins[k]), int(bins[k + 1])] for k in range(nb_tranches)]
-        size = (q[-1][0] - q[0][1]) / (nb_tranches - 2)
-        # to include the minimum price if it is equal to the lower bound, lower bound-1
-        inf = q[0][0] - 1 if min(prix) == int(min(prix)) else q[0][0]
-        # due to int, the upper bound is rounded down so +1 to include it
-        sup = q[-1][1] + 1
-        intervalles = [[inf, q[0][1]]] +\
-            [[q[0][1] + size * k, q[0][1] + size * (k + 1)]
-                for k in range(nb_tranches - 2)] +\
-            [[q[-1][0], sup]]
-        if arrondi:
-            # keep min and max values unchanged
-            borne_inf = intervalles[0][0]
-            borne_sup = intervalles[-1][1]
-            intervalles = [[borne_inf, process_borne(intervalles[0][1], borne_inf, borne_sup)]] + [
-                [process_borne(i[0], borne_inf, borne_sup), process_borne(i[1], borne_inf, borne_sup)]
-                for i in intervalles[1:-1]
-            ] + [[process_borne(intervalles[-1][0], borne_inf, borne_sup), borne_sup]]
-        bins = [i[0] for i in intervalles] + [intervalles[-1][1]]
-        # handle case where rounding creates identical bins
-        if len(bins) != len(set(bins)):
-            # check how many times bounds appear
-            count_bins = pd.Series(bins).value_counts().sort_index()
-            # get ranges between redundant bounds and next ones
-            ranges = [
-                (count_bins.index[k + 1] - count_bins.index[k]) / count_bins.values[k]
-                for k in range(len(count_bins) - 1)
-            ]
-            # create new bins from bounds and intervals
-            new_bins = [bins[0]]
-            for idx, b in enumerate(count_bins.values[:-1]):
-                for k in range(b):
-                    new_bins.append(new_bins[-1] + ranges[idx])
-            bins = list(map(round, new_bins))
-        volumes = pd.cut(
-            prix,
-            bins=bins
-        ).value_counts().sort_index().to_list()
-        return intervalles, volumes
+        bins=bins
+    ).value_counts().sort_index().to_list()
+    return intervalles, volumes
+
+
+def _distrib_sorted_groups(
+    codes: np.ndarray,
+    groups: np.ndarray,
+    prix: np.ndarray,
+    nb_tranches: int,
+) -> dict:
+    # groups are contiguous ids from 0 to len(codes) - 1, prix being sorted within each group
+    nb_groups = len(codes)
+    group_starts = np.searchsorted(groups, np.arange(nb_groups))
+
+    # quantiles des prix uniques, même interpolation que np.quantile
+    is_unique = np.ones(len(prix), dtype=bool)
+    is_unique[1:] = (prix[1:] != prix[:-1]) | (groups[1:] != groups[:-1])
+    unique_prix = prix[is_unique]
+    unique_groups = groups[is_unique]
+    unique_starts = np.searchsorted(unique_groups, np.arange(nb_groups))
+    nb_unique = np.bincount(unique_groups, minlength=nb_groups)
+    quantiles = np.asarray([k / nb_tranches for k in range(nb_tranches + 1)])
+    virtual_indexes = (nb_unique[:, None] - 1) * quantiles[None, :]
+    previous_indexes = np.floor(virtual_indexes)
+    next_indexes = previous_indexes + 1
+    above_bounds = virtual_indexes >= (nb_unique[:, None] - 1)
+    previous_indexes[above_bounds] = -1
+    next_indexes[above_bounds] = -1
+    gamma = virtual_indexes - previous_indexes
+    previous_indexes = np.where(above_bounds, nb_unique[:, None] - 1, previous_indexes).astype(np.intp)
+    next_indexes = np.where(above_bounds, nb_unique[:, None] - 1, next_indexes).astype(np.intp)
+    previous = unique_prix[unique_starts[:, None] + previous_indexes]
+    next_ = unique_prix[unique_starts[:, None] + next_indexes]
+    diff = next_ - previous
+    bins = np.where(gamma >= 0.5, next_ - diff * (1 - gamma), previous + diff * gamma)
+
+    # bornes, cf distrib_from_prix
+    q = np.trunc(bins)
+    size = (q[:, -2] - q[:, 1]) / (nb_tranches - 2)
+    inf = np.where(bins[:, 0] == q[:, 0], q[:, 0] - 1, q[:, 0])
+    sup = q[:, -1] + 1
+    middle = q[:, 1][:, None] + size[:, None] * np.arange(nb_tranches - 1)[None, :]
+    # int bounds first, then float ones, as in distrib_from_prix
+    raw = np.column_stack([q[:, 1], middle, q[:, -2]])
+    rounded_100 = np.rint(raw / 100) * 100
+    is_rounded_100 = (rounded_100 > inf[:, None]) & (rounded_100 < sup[:, None])
+    rounded = np.where(is_rounded_100, rounded_100, np.rint(raw))
+    # bins are the lower bounds of the intervals, plus the upper one
+    # (the last middle bound is the same value as the int one that follows)
+    all_bins = np.column_stack([inf, rounded[:, 1:-2], rounded[:, -1], sup])
+    is_valid = (np.diff(all_bins, axis=1) > 0).all(axis=1)
+
+    # volumes : nombre de prix dans chaque intervalle ]borne, borne suivante]
+    nb_bins = all_bins.shape[1]
+    query_groups = np.repeat(np.arange(nb_groups), nb_bins)
+    merged_groups = np.concatenate([groups, query_groups])
+    merged_values = np.concatenate([prix, all_bins.ravel()])
+    # on ties, prices come before bins so that they are counted as lower or equal
+    is_query = np.concatenate([np.zeros(len(prix), dtype=bool), np.ones(len(query_groups), dtype=bool)])
+    order = np.lexsort((is_query, merged_values, merged_groups))
+    nb_lower_or_equal = np.cumsum(~is_query[order])
+    counts = np.empty(len(order), dtype=np.int64)
+    counts[order] = nb_lower_or_equal
+    counts = counts[len(prix):].reshape(nb_groups, nb_bins) - group_starts[:, None]
+    volumes = np.diff(counts, axis=1)
+
+    result = {}
+    for k, code in enumerate(codes):
+        bounds = [int(rounded[k, 0])] + [
+            float(b) if r else int(b)
+            for b, r in zip(rounded[k, 1:-1], is_rounded_100[k, 1:-1])
+        ] + [int(rounded[k, -1])]
+        intervalles = (
+            [[int(inf[k]), bounds[0]]]
+            + [[bounds[i], bounds[i + 1]] for i in range(1, nb_tranches - 1)]
+            + [[bounds[-1], int(sup[k])]]
+        )
+        if is_valid[k]:
+            result[code] = intervalles, volumes[k].tolist()
+            continue
+        # rounding created identical bounds, which are spread as in distrib_from_prix
+        group_prix = prix[group_starts[k]:group_starts[k + 1] if k + 1 < nb_groups else len(prix)]
+        bins = spread_identical_bins([i[0] for i in intervalles] + [intervalles[-1][1]])
+        if not all(b < b_next for b, b_next in zip(bins, bins[1:])):
+            # pd.cut raises on these, as it would have
+            result[code] = distrib_from_prix(pd.Series(group_prix))
+            continue
+        result[code] = intervalles, np.diff(
+            np.searchsorted(group_prix, bins, side="right")
+        ).tolist()
+    return result
+
+
+def distrib_from_prix_by_group(
+    codes: np.ndarray,
+    prix: np.ndarray,
+    threshold: int = 100,
+    nb_tranches: int = 10,
+    max_workers: int = 1,
+) -> dict:
+    """Compute the price distributions of all groups at once
+
+    Same output as distrib_from_prix (with arrondi), but the quantiles, bounds
+    and volumes of all groups are computed on sorted arrays instead of one
+    group at a time.
+
+    Args:
+        codes (np.ndarray): the code of the group of each price
+        prix (np.ndarray): the prices
+        threshold (int): groups with fewer prices are left out
+        nb_tranches (int): number of intervals of the distributions
+        max_workers (int): number of processes to share the groups between
+
+    Returns:
+        dict: {code: (intervalles, volumes)} for groups of at least threshold prices
+    """
+    groups, uniques = pd.factorize(codes)
+    # groupes trop petits (et codes manquants) écartés
+    sizes = np.bincount(groups[groups >= 0], minlength=len(uniques))
+    kept = (groups >= 0) & (sizes[groups] >= threshold)
+    if not kept.any():
+        return {}
+    new_ids = np.cumsum(sizes >= threshold) - 1
+    groups = new_ids[groups[kept]]
+    prix = np.asarray(prix, dtype=float)[kept]
+    uniques = np.asarray(uniques)[sizes >= threshold]
+    order = np.lexsort((prix, groups))
+    groups = groups[order]
+    prix = prix[order]
+
+    nb_chunks = min(max_workers, len(uniques))
+    if nb_chunks <= 1:
+        return _distrib_sorted_groups(uniques, groups, prix, nb_tranches)
+    # chunks of contiguous groups, each worker renumbers its groups from 0
+    group_limits = np.linspace(0, len(uniques), nb_chunks + 1).astype(int)
+    row_limits = np.searchsorted(groups, group_limits)
+    result = {}
+    with ProcessPoolExecutor(max_workers=nb_chunks) as executor:
+        futures = [
+            executor.submit(
+                _distrib_sorted_groups,
+                uniques[group_limits[k]:group_limits[k + 1]],
+                groups[row_limits[k]:row_limits[k + 1]] - group_limits[k],
+                prix[row_limits[k]:row_limits[k + 1]],
+                nb_tranches,
+            )
+            for k in range(nb_chunks)
+        ]
+        for future in futures:
+            result.update(future.result())
+    return result
+
 
+def create_distribution_and_stats_whole_period():
     # on récupère toutes les échelles
     echelles = pd.read_csv(
         DATADIR + "/stats_dvf_api.csv",
@@ -934,13 +1204,7 @@ def create_distribution_and_stats_whole_period():
     )
     echelles = echelles.drop_duplicates()
     # on récupère les données DVF
-    years = sorted(
-        [
-            int(f.replace("full_", "").replace(".csv", ""))
-            for f in os.listdir(DATADIR)
-            if "full_" in f and ".gz" not in f
-        ]
-    )
+    years = get_dvf_years()
     dvf = []
     epci = pd.read_csv(
         DATADIR + "/epci.csv",
@@ -948,63 +1212,20 @@ def create_distribution_and_stats_whole_period():
         encoding="utf8",
         dtype=str
     )
-    to_keep = [
-        "id_mutation",
-        "code_departement",
-        "code_commune",
-        "id_parcelle",
-        "nature_mutation",
-        "code_type_local",
-        "type_local",
-        "valeur_fonciere",
-        "surface_reelle_bati",
-    ]
     for year in years:
         print("Starting with", year)
-        df_ = pd.read_csv(
-            DATADIR + f"/full_{year}.csv",
-            sep=",",
-            encoding="utf8",
-            dtype={
-                "code_commune": str,
-                "code_departement": str,
-            },
-            usecols=to_keep,
+        # ventes d'un seul bien, dédupliquées et filtrées sur les natures et types de biens
+        ventes_nodup = read_dvf_year(
+            year,
+            [
+                "code_departement",
+                "code_commune",
+                "code_section",
+                "code_type_local",
+                "prix_m2",
+            ],
+            where="is_monobien",
         )
-        df = df_.drop_duplicates()
-        df["code_section"] = df["id_parcelle"].str[:10]
-        df = df.drop("id_parcelle", axis=1)
-
-        natures_of_interest = [
-            "Vente",
-            "Vente en l'état futur d'achèvement",
-            "Adjudication",
-        ]
-        del df_
-
-        # filtres sur les ventes et les types de biens à considérer
-        # choix : les terres et/ou dépendances ne rendent pas une mutation
-        # multitype
-        ventes = df.loc[
-            (df["nature_mutation"].isin(natures_of_interest)) &
-            (df["code_type_local"].isin([1, 2, 4]))
-        ]
-        del df
-
-        # on ne garde que les ventes d'un seul bien
-        # cf historique pour les ventes multi-types
-        count_ventes = ventes['id_mutation'].value_counts().reset_index()
-        liste_ventes_monobien = count_ventes.loc[count_ventes['id_mutation'] == 1, 'index']
-        ventes_nodup = ventes.loc[ventes['id_mutation'].isin(liste_ventes_monobien)]
-
-        ventes_nodup["prix_m2"] = (
-            ventes_nodup["valeur_fonciere"] /
-            ventes_nodup["surface_reelle_bati"]
-        )
-        ventes_nodup["prix_m2"] = ventes_nodup["prix_m2"].replace(
-            [np.inf, -np.inf], np.nan
-        )
-
         # pas de prix ou pas de surface
         ventes_nodup = ventes_nodup.dropna(subset=["prix_m2"])
         dvf.append(ventes_nodup)
@@ -1071,38 +1292,21 @@ def create_distribution_and_stats_whole_period():
             # distribution
             if echelles_of_interest[e]:
                 codes_geo = set(echelles.loc[echelles['echelle_geo'] == e, 'code_geo'])
-                restr_dvf = restr_type_dvf[[f'code_{e}', 'prix_m2']].set_index(f'code_{e}')['prix_m2']
-                idx = set(restr_dvf.index)
-                operations = len(codes_geo)
-                for i, code in enumerate(codes_geo):
-                    if i % (operations // 10) == 0 and i > 0:
-                        print(int(round(i / operations * 100, -1)), '%')
-                    if code in idx:
-                        prix = restr_dvf.loc[code]
-                        if not isinstance(prix, pd.core.series.Series):
-                            prix = pd.Series(prix)
-                        if len(prix) >= threshold:
-                            intervalles, volumes = distrib_from_prix(prix)
-                            tranches.append({
-                                'code_geo': code,
-                                'type_local': t,
-                                'xaxis': intervalles,
-                                'yaxis': volumes
-                            })
-                        else:
-                            tranches.append({
-                                'code_geo': code,
-                                'type_local': t,
-                                'xaxis': None,
-                                'yaxis': None
-                            })
-                    else:
-                        tranches.append({
-                            'code_geo': code,
-                            'type_local': t,
-                            'xaxis': None,
-                            'yaxis': None
-                        })
+                # toutes les distributions de l'échelle sont calculées d'un coup
+                distributions = distrib_from_prix_by_group(
+                    restr_type_dvf[f'code_{e}'].to_numpy(),
+                    restr_type_dvf['prix_m2'].to_numpy(),
+                    threshold=threshold,
+                    max_workers=DISTRIBUTION_MAX_WORKERS,
+                )
+                for code in codes_geo:
+                    intervalles, volumes = distributions.get(code, (None, None))
+                    tranches.append({
+                        'code_geo': code,
+                        'type_local': t,
+                        'xaxis': intervalles,
+                        'yaxis': volumes
+                    })
                 print("- Done with distribution")
             else:
                 print("- No distribution")
@@ -3,6 +3,17 @@ echo "Geocoding by increasing size of departments"
 cd /srv/sirene/geocodage-sirene/
 # extrait la liste des anciens codes INSEE et nouveau correspondant
 csvgrep -c POLE -r '^.+$' -t /srv/sirene/geocodage-sirene/France2018.tsv -e iso8859-1 | csvcut -c 6,7,11,14 | sed 's/,//' > /srv/sirene/geocodage-sirene/histo_depcom.csv
+# version de la BAN chargée dans addok, les résultats en cache de score faible sont refaits quand elle change
+export BAN_VERSION=${BAN_VERSION:-$(date +%Y-%m)}
+# dernier géocodage publié : les établissements dont l'adresse n'a pas changé en reprennent le résultat
+PREVIOUS_DIR=$(ls -d /srv/sirene/data-sirene/20??-??/dep 2>/dev/null | sort | tail -n 1)
+# dates d'obtention de ces résultats (non publiées), ils ne sont repris que jusqu'à cache_ttl jours
+DATES_DIR=/srv/sirene/data-sirene/cache_geo/dates
+mkdir -p $DATES_DIR
+# chaque processus garde plusieurs requêtes addok en cours, il en faut moins qu'en synchrone :
+# geocode.py répartit entre les processus un nombre borné de requêtes par instance addok
+export GEOCODE_JOBS=12
 time wc -l /srv/sirene/data-sirene/data/dep_*.csv | sort -n -r | grep dep | sed 's/^.*_\(.*\).csv/\1/' | \
-  parallel -j 36 -t /srv/sirene/venv/bin/python /srv/sirene/geocodage-sirene/geocode.py /srv/sirene/data-sirene/data/dep_{}.csv /srv/sirene/data-sirene/data/geo_siret_{}.csv.gz /srv/sirene/data-sirene/cache_geo/cache_addok_sirene_{}.csv.db \> /srv/sirene/data-sirene/data/geo_siret_{}.log
+  parallel -j $GEOCODE_JOBS -t /srv/sirene/venv/bin/python /srv/sirene/geocodage-sirene/geocode.py /srv/sirene/data-sirene/data/dep_{}.csv /srv/sirene/data-sirene/data/geo_siret_{}.csv.gz /srv/sirene/data-sirene/cache_geo/cache_geocode.db $PREVIOUS_DIR/geo_siret_{}.csv.gz $DATES_DIR/dates_siret_{}.csv.gz /srv/sirene/data-sirene/data/dates_siret_{}.csv.gz \> /srv/sirene/data-sirene/data/geo_siret_{}.log
 echo "Geocode OK!"
+mv /srv/sirene/data-sirene/data/dates_siret_*.csv.gz $DATES_DIR/
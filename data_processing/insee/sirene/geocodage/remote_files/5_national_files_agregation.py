@@ -0,0 +1,164 @@
+import csv
+import glob
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import List, Optional, Tuple
+
+import duckdb
+
+DATA_DIR = "/srv/sirene/data-sirene/"
+NATIONAL_FILE = "StockEtablissement_utf8_geo"
+STATES = {"A": "StockEtablissementActif_utf8_geo", "F": "StockEtablissementFerme_utf8_geo"}
+STATE_COLUMN = "etatAdministratifEtablissement"
+NUMERIC_COLUMNS = ["longitude", "latitude", "geo_score"]
+COMPRESS_LEVEL = 9
+CHUNK_SIZE = 1024 * 1024
+# the department files (and so the national file) are written by csv.writer with "\r\n",
+# the Actif/Ferme files used to go through csvgrep, which writes "\n"
+STATES_LINETERMINATOR = "\n"
+
+
+def read_header_member(file_path: str) -> Tuple[List[str], Optional[int]]:
+    """
+    geocode.py writes the header of the department files as a separate gzip member,
+    so that the body can be concatenated to the national file without recompression.
+
+    Returns:
+        the header and the offset of the body in the compressed file,
+        the offset is None if the file is a single gzip member
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    read = 0
+    text = b""
+    with open(file_path, "rb") as f:
+        while not decompressor.eof:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            read += len(chunk)
+            text += decompressor.decompress(chunk)
+            if b"\n" in text and not decompressor.eof:
+                # the first member goes beyond the header, no need to read more
+                break
+    header = next(csv.reader([text.decode("utf-8").split("\n")[0]]))
+    if decompressor.eof and text.count(b"\n") == 1 and text.endswith(b"\n"):
+        return header, read - len(decompressor.unused_data)
+    return header, None
+
+
+@contextmanager
+def open_rsyncable(path: str):
+    """
+    Text stream compressed by `gzip --rsyncable` (Python's gzip doesn't have it),
+    so that rsync only transfers the changed parts of the published files
+    """
+    with open(path, "wb") as output:
+        process = subprocess.Popen(
+            ["gzip", f"-{COMPRESS_LEVEL}", "--rsyncable"], stdin=subprocess.PIPE, stdout=output
+        )
+    stream = io.TextIOWrapper(process.stdin, encoding="utf-8", newline="")
+    try:
+        yield stream
+    finally:
+        stream.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"gzip failed for {path}")
+
+
+def split_department(file_path: str, tmp_dir: str) -> dict:
+    """
+    Reads a department file once, and writes its active and closed establishments
+    (and its body, if it can't be copied as is) to compressed parts in tmp_dir
+    """
+    header, body_offset = read_header_member(file_path)
+    state_index = header.index(STATE_COLUMN)
+    name = os.path.basename(file_path).replace(".csv.gz", "")
+    parts = {state: os.path.join(tmp_dir, f"{name}_{state}.csv.gz") for state in STATES}
+    if body_offset is None:
+        parts["all"] = os.path.join(tmp_dir, f"{name}_all.csv.gz")
+    nb_rows = 0
+    with ExitStack() as stack:
+        writers = {
+            key: csv.writer(
+                stack.enter_context(open_rsyncable(path)),
+                lineterminator=STATES_LINETERMINATOR if key in STATES else "\r\n",
+            )
+            for key, path in parts.items()
+        }
+        with gzip.open(file_path, "rt", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                nb_rows += 1
+                if row[state_index] in writers:
+                    writers[row[state_index]].writerow(row)
+                if "all" in writers:
+                    writers["all"].writerow(row)
+    print(f"{name}: {nb_rows} rows, header member {'found' if body_offset else 'missing'}")
+    return {"file_path": file_path, "header": header, "body_offset": body_offset, "parts": parts}
+
+
+def copy_bytes(source_path: str, destination, offset: int = 0) -> None:
+    with open(source_path, "rb") as source:
+        source.seek(offset)
+        shutil.copyfileobj(source, destination, CHUNK_SIZE)
+
+
+def write_header_member(destination, header: List[str], lineterminator: str = "\r\n") -> None:
+    with gzip.open(destination, "wt", encoding="utf-8", compresslevel=COMPRESS_LEVEL) as f:
+        csv.writer(f, lineterminator=lineterminator).writerow(header)
+
+
+def aggregate_national_files(files: List[str], tmp_dir: str, max_workers: int) -> None:
+    """
+    The national file is the concatenation of the gzip members of the department files
+    (gzip streams are concatenable), the active/closed files are made of the parts
+    compressed in parallel by split_department
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        departments = list(executor.map(split_department, files, [tmp_dir] * len(files)))
+    header = departments[0]["header"]
+    for department in departments:
+        if department["header"] != header:
+            raise ValueError(f"{department['file_path']} doesn't have the expected header")
+
+    with open(os.path.join(DATA_DIR, f"{NATIONAL_FILE}.csv.gz"), "wb") as national:
+        write_header_member(national, header)
+        for department in departments:
+            if department["body_offset"] is not None:
+                copy_bytes(department["file_path"], national, department["body_offset"])
+            else:
+                copy_bytes(department["parts"]["all"], national)
+    for state, file_name in STATES.items():
+        with open(os.path.join(DATA_DIR, f"{file_name}.csv.gz"), "wb") as output:
+            write_header_member(output, header, STATES_LINETERMINATOR)
+            for department in departments:
+                copy_bytes(department["parts"][state], output)
+
+
+def export_parquet(files: List[str]) -> None:
+    """Parquet edition of the national file, read straight from the department files"""
+    casts = ", ".join(f"TRY_CAST({column} AS DOUBLE) AS {column}" for column in NUMERIC_COLUMNS)
+    duckdb.sql(
+        f"""COPY (
+            SELECT * REPLACE ({casts})
+            FROM read_csv({files}, header=true, all_varchar=true)
+        ) TO '{os.path.join(DATA_DIR, f"{NATIONAL_FILE}.parquet")}' (FORMAT parquet, COMPRESSION zstd)"""
+    )
+
+
+if __name__ == "__main__":
+    geo_files = sorted(glob.glob(os.path.join(DATA_DIR, "data", "geo_siret*.csv.gz")))
+    tmp_dir = tempfile.mkdtemp(dir=DATA_DIR)
+    try:
+        aggregate_national_files(geo_files, tmp_dir, max_workers=os.cpu_count())
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    export_parquet(geo_files)
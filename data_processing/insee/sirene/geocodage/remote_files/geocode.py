@@ -1,16 +1,24 @@
 #! /usr/bin/python3
 import sys
 import csv
+import io
+import os
 import json
 import re
 import gzip
+import time
+import hashlib
+import struct
+import subprocess
+import asyncio
+import contextvars
+from collections import OrderedDict
 
 # modules installés par pip
-import requests
+import aiohttp
 import sqlite3
 import marshal
 import unidecode
-import random
 
 # modules locaux
 from normadresse.normadresse import abrev
@@ -24,17 +32,278 @@ addok_ban = ['http://localhost:7878/search/','http://localhost:7879/search/','ht
 
 addok_poi = 'http://localhost:7830/search'
 
+# nombre de lignes traitées ensemble (lecture/écriture du cache, requête /search/csv/)
+window_size = 1000
+# nombre max de requêtes en cours par instance addok BAN, tous processus confondus
+max_in_flight_per_backend = 8
+# nombre de processus lancés en parallèle par 3_geocoding_by_increasing_size.sh
+geocode_jobs = int(os.environ.get('GEOCODE_JOBS', '1'))
+# nombre max de requêtes addok en cours pour ce processus : la charge totale reste
+# bornée quel que soit le nombre de processus, pour ne pas saturer addok (les requêtes
+# en timeout finissent en centroïde de commune)
+max_in_flight = max(1, max_in_flight_per_backend * len(addok_ban) // geocode_jobs)
+# nombre d'adresses gardées en mémoire devant le cache sqlite
+lru_size = 200000
+# première recherche BAN des adresses faite par lot via /search/csv/
+use_csv_batch = True
+
+# cache partagé par tous les départements et entre stock et quotidien
+default_cache = 'cache_geo/cache_geocode.db'
+# version de la BAN chargée dans addok, les résultats sont liés à cette version
+# (par défaut le mois en cours, comme dans 3_geocoding_by_increasing_size.sh)
+ban_version = os.environ.get('BAN_VERSION') or time.strftime('%Y-%m')
+# version du format binaire des résultats en cache
+cache_format = 1
+# les bons résultats sont réutilisés après un changement de BAN, jusqu'à cache_ttl jours
+cache_score_keep = 0.7
+cache_ttl = 180
+
+# colonnes de l'adresse lues pour le géocodage, comparées avec le fichier géocodé précédent
+address_columns = [11, 12, 13, 16, 17, 20, 22]
+
 geocode_count = 0
+errors_count = 0
+# requêtes en erreur de l'adresse en cours de géocodage (une tâche asyncio par adresse),
+# un résultat obtenu malgré une erreur n'est pas mis en cache
+request_errors = contextvars.ContextVar('request_errors')
+
+
+class AddokClient:
+    """Requêtes addok asynchrones sur des connexions keep-alive,
+    les requêtes BAN vont à l'instance qui en a le moins en cours"""
+
+    def __init__(self, ban_urls, poi_url, max_in_flight):
+        self.ban_urls = ban_urls
+        self.max_in_flight = max_in_flight
+        self.outstanding = {url: 0 for url in ban_urls + [poi_url]}
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.session = None
+        # résultats de /search/csv/ par (q, citycode)
+        self.prefetched = {}
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=120),
+        )
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    def pick_ban(self):
+        return min(self.ban_urls, key=lambda url: self.outstanding[url])
+
+    async def request(self, method, api, **kwargs):
+        async with self.semaphore:
+            self.outstanding[api] += 1
+            try:
+                url = api if method == 'GET' else api + 'csv/'
+                async with self.session.request(method, url, **kwargs) as r:
+                    r.raise_for_status()
+                    return await r.text()
+            finally:
+                self.outstanding[api] -= 1
+
+    async def prefetch(self, queries):
+        # une seule requête /search/csv/ pour toutes les adresses de la fenêtre
+        global geocode_count
+        queries = list(dict.fromkeys((q.strip(), citycode) for q, citycode in queries))
+        if not queries:
+            return
+        data = io.StringIO()
+        writer = csv.writer(data)
+        writer.writerow(['q', 'citycode'])
+        writer.writerows(queries)
+        form = aiohttp.FormData()
+        form.add_field('data', data.getvalue().encode('utf-8'),
+                       filename='adresses.csv', content_type='text/csv')
+        form.add_field('columns', 'q')
+        form.add_field('citycode', 'citycode')
+        try:
+            text = await self.request('POST', self.pick_ban(), data=form)
+        except Exception:
+            # en cas d'échec, les adresses seront cherchées une à une
+            print(json.dumps({'action': 'erreur', 'api': 'csv', 'nb': len(queries)}))
+            return
+        geocode_count += len(queries)
+        for result in csv.DictReader(io.StringIO(text)):
+            feature = None
+            if result.get('result_score'):
+                feature = {'type': 'Feature',
+                           'geometry': {'type': 'Point',
+                                        'coordinates': [float(result['longitude']),
+                                                        float(result['latitude'])]},
+                           'properties': {'score': float(result['result_score']),
+                                          'type': result['result_type'],
+                                          'label': result['result_label'],
+                                          'name': result['result_name'],
+                                          'id': result['result_id'],
+                                          'housenumber': result.get('result_housenumber', '')}}
+            # sérialisé pour que chaque appel reçoive sa propre copie
+            self.prefetched[(result['q'], result['citycode'])] = marshal.dumps(feature)
+
+
+def cache_key(depcom, ligne4G, ligne4N, ligne4D):
+    # adresses normalisées : sans accents, en majuscules, espaces simplifiés
+    return '|'.join([depcom] + [re.sub(r'\s+', ' ', unidecode.unidecode(ligne)).upper().strip()
+                                for ligne in (ligne4G, ligne4N, ligne4D)])
+
+
+def pack_geo(source):
+    # résultat compact : lon, lat, score puis les textes utiles à la sortie
+    if source is None:
+        return b''
+    return struct.pack('<ddd', source['geometry']['coordinates'][0],
+                       source['geometry']['coordinates'][1],
+                       source['properties']['score']) + '\x1f'.join(
+        [source['properties']['type'], source['properties']['label'],
+         source['properties']['id'], source.get('l4', ''),
+         source.get('geo_l4', ''), source.get('geo_l5', '')]).encode('utf-8')
+
+
+def unpack_geo(geo):
+    if geo == b'':
+        return None
+    lon, lat, score = struct.unpack_from('<ddd', geo)
+    typ, label, geo_id, l4, geo_l4, geo_l5 = geo[24:].decode('utf-8').split('\x1f')
+    return {'geometry': {'coordinates': [lon, lat]},
+            'properties': {'score': score, 'type': typ, 'label': label, 'id': geo_id},
+            'l4': l4, 'geo_l4': geo_l4, 'geo_l5': geo_l5}
+
+
+def address_hash(et):
+    return hashlib.blake2b('\x1f'.join([str(len(et))] + [et[c] for c in address_columns])
+                           .encode('utf-8'), digest_size=8).digest()
+
+
+def load_dates(path):
+    # date (timestamp) d'obtention de chaque résultat du précédent géocodage, par siret
+    dates = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for siret, created in csv.reader(f):
+            dates[siret] = int(created)
+    return dates
+
+
+def load_previous(path, dates):
+    # résultats du précédent géocodage par siret, avec l'empreinte de l'adresse géocodée
+    # et la date d'obtention du résultat : comme pour le cache après un changement de BAN,
+    # seuls les bons résultats de moins de cache_ttl jours sont repris, les adresses
+    # non trouvées, avec un score faible ou sans date repassent par le cache et addok
+    previous = {}
+    oldest = time.time() - cache_ttl * 86400
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            et, geo = row[:-9], row[-9:]
+            if geo[3] != '':
+                source = {'geometry': {'coordinates': [float(geo[0]), float(geo[1])]},
+                          'properties': {'score': float(geo[2]), 'type': geo[3],
+                                         'label': geo[4], 'id': geo[5]},
+                          'l4': geo[6], 'geo_l4': geo[7], 'geo_l5': geo[8]}
+                created = dates.get(et[0]+et[1])
+                if float(geo[2]) >= cache_score_keep and created is not None and created >= oldest:
+                    previous[et[0]+et[1]] = (address_hash(et), pack_geo(source), created)
+    return previous
+
+
+class GeocodeCache:
+    """Cache LRU en mémoire devant la table sqlite cache_geocode, lue et écrite par lots.
+    Un résultat est valide pour la BAN avec laquelle il a été obtenu, ou jusqu'à
+    cache_ttl jours s'il a un bon score. Les résultats sont des tuples (geo, created)"""
+
+    def __init__(self, conn, size):
+        self.conn = conn
+        self.size = size
+        self.lru = OrderedDict()
+        self.pending = []
+        self.stats = {'cache_hit_memory': 0, 'cache_hit_sqlite': 0,
+                      'cache_miss': 0, 'cache_expired': 0}
+
+    def remember(self, key, result):
+        self.lru[key] = result
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+
+    def valid(self, score, fmt, version, created):
+        if fmt != cache_format:
+            return False
+        # une version vide (entrées écrites sans BAN_VERSION) ne correspond à aucune BAN
+        if version and version == ban_version:
+            return True
+        return score >= cache_score_keep and created >= time.time() - cache_ttl * 86400
+
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                found[key] = self.lru[key]
+            else:
+                missing.append(key)
+        self.stats['cache_hit_memory'] += len(found)
+        if self.conn:
+            for k in range(0, len(missing), 500):
+                chunk = missing[k:k + 500]
+                cursor = self.conn.execute('SELECT adr, geo, score, format, ban_version, created '
+                                           'FROM cache_geocode WHERE adr IN (%s)'
+                                           % ','.join('?' * len(chunk)), chunk)
+                for adr, geo, score, fmt, version, created in cursor:
+                    if self.valid(score, fmt, version, created):
+                        found[adr] = (geo, created)
+                        self.remember(adr, found[adr])
+                        self.stats['cache_hit_sqlite'] += 1
+                    else:
+                        self.stats['cache_expired'] += 1
+        self.stats['cache_miss'] += len(keys) - len(found)
+        return found
+
+    def put(self, key, geo, score, created):
+        self.remember(key, (geo, created))
+        if self.conn:
+            self.pending.append((key, geo, score, cache_format, ban_version, created))
+
+    def flush(self):
+        if self.conn:
+            if self.pending:
+                self.conn.executemany('INSERT OR REPLACE INTO cache_geocode VALUES (?,?,?,?,?,?)',
+                                      self.pending)
+                self.pending = []
+            self.conn.commit()
+
+
+def open_cache(path):
+    # base partagée par les processus lancés en parallèle : WAL et attente des verrous
+    conn = sqlite3.connect(path, timeout=300)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS cache_geocode (adr text PRIMARY KEY,
+                 geo blob, score numeric, format integer, ban_version text,
+                 created integer) WITHOUT ROWID''')
+    return conn
+
 
 # effecture une req. sur l'API de géocodage
-def geocode(api, params, l4):
+async def geocode(client, api, params, l4):
     params['autocomplete'] = 0
     params['q'] = params['q'].strip()
     try:
-        r = requests.get(api, params)
-        j = json.loads(r.text)
-        global geocode_count
-        geocode_count += 1
+        prefetched = None
+        if api is addok_ban:
+            prefetched = client.prefetched.get((params['q'], params['citycode']))
+        if prefetched is not None:
+            feature = marshal.loads(prefetched)
+            j = {'features': [feature] if feature is not None else []}
+        else:
+            if api is addok_ban:
+                api = client.pick_ban()
+            j = json.loads(await client.request('GET', api, params=params))
+            global geocode_count
+            geocode_count += 1
         if 'features' in j and len(j['features']) > 0:
             j['features'][0]['l4'] = l4
             j['features'][0]['geo_l4'] = ''
@@ -62,6 +331,7 @@ def geocode(api, params, l4):
     except:
         print(json.dumps({'action': 'erreur', 'api': api,
                          'params': params, 'l4': l4}))
+        request_errors.get([]).append(api)
         return(None)
 
 
@@ -73,24 +343,31 @@ def trace(txt):
 if len(sys.argv) > 2:
     stock = False
     sirene_csv = csv.reader(open(sys.argv[1], 'r', encoding='utf-8'), delimiter=',')
-    sirene_geo = csv.writer(gzip.open(sys.argv[2], 'wt', encoding='utf-8', compresslevel=9))
+    # ouvert après l'écriture de l'entête
+    sirene_geo = None
+    gzip_body = None
     conn = None
     if len(sys.argv) > 3:
         print(sys.argv[3])
-        conn = sqlite3.connect(sys.argv[3])
-        conn.execute('''CREATE TABLE IF NOT EXISTS cache_addok (adr text, geo text,
-                     score numeric)''')
-        conn.execute('CREATE INDEX IF NOT EXISTS cache_addok_adr ON cache_addok (adr)')  # noqa
-        conn.execute('DELETE FROM cache_addok WHERE score<0.7')
+        conn = open_cache(sys.argv[3])
+    # fichier géocodé précédent du département : les adresses inchangées ne sont pas regéocodées
+    # avec la date d'obtention de ses résultats, qui ne sont repris que jusqu'à cache_ttl jours
+    previous = {}
+    if len(sys.argv) > 5 and os.path.exists(sys.argv[4]) and os.path.exists(sys.argv[5]):
+        print(sys.argv[4])
+        previous = load_previous(sys.argv[4], load_dates(sys.argv[5]))
+    # dates d'obtention des résultats écrits, pour le prochain géocodage
+    dates_file = None
+    if len(sys.argv) > 6:
+        dates_file = gzip.open(sys.argv[6], 'wt', encoding='utf-8')
 else:
     stock = True
     sirene_csv = csv.reader(open(sys.argv[1], 'r'))
     sirene_geo = csv.writer(open('geo-'+sys.argv[1], 'w'))
-    conn = sqlite3.connect('cache_geo/cache_addok_'+sys.argv[1]+'.db')
-    conn.execute('''CREATE TABLE IF NOT EXISTS cache_addok (adr text, geo text,
-                 score numeric)''')
-    conn.execute('CREATE INDEX IF NOT EXISTS cache_addok_adr ON cache_addok (adr)')  # noqa
-    conn.execute('DELETE FROM cache_addok WHERE score<0.7')
+    gzip_body = None
+    conn = open_cache(default_cache)
+    previous = {}
+    dates_file = None
 
 # chargement de la liste des communes et lat/lon
 communes = csv.DictReader(open('communes-plus-20140630.csv', 'r'))
@@ -109,6 +386,7 @@ header = None
 ok = 0
 total = 0
 cache = 0
+reused = 0
 numbers = re.compile('(^[0-9]*)')
 stats = {'action': 'progress', 'housenumber': 0, 'interpolation': 0,
          'street': 0, 'locality': 0, 'municipality': 0, 'vide': 0,
@@ -185,291 +463,378 @@ header = [
     'geo_l5'
 ]
 
-sirene_geo.writerow(header)
+if sirene_geo is None:
+    # l'entête est un membre gzip à part, pour concaténer les fichiers sans les recompresser
+    with gzip.open(sys.argv[2], 'wt', encoding='utf-8', compresslevel=9) as f:
+        csv.writer(f).writerow(header)
+    # le corps est compressé par gzip --rsyncable (absent du module gzip), pour que rsync
+    # ne transfère que les parties modifiées des fichiers publiés
+    with open(sys.argv[2], 'ab') as f:
+        gzip_body = subprocess.Popen(['gzip', '-9', '--rsyncable'], stdin=subprocess.PIPE, stdout=f)
+    geo_file = io.TextIOWrapper(gzip_body.stdin, encoding='utf-8')
+    sirene_geo = csv.writer(geo_file)
+else:
+    sirene_geo.writerow(header)
 
-test = 0
-test2 = 0
-for et in sirene_csv:
-    # ban_number = random.randint(0,8)
-    ban_number = random.randint(0,5)
+
+def prepare(et):
     # on ne tente pas le géocodage des adresses hors de France
     if et[22] == '' or re.match(r'^(978|98|99)',et[20]):
-        row = et+['', '', 0, '', '', '', '', '', '']
-        sirene_geo.writerow(row)
+        return None
+    # fichier SIRENE (stock et quotidien)
+    #  géocodage de l'adresse géographique
+    #  au cas où numvoie contiendrait autre chose que des chiffres...
+    numvoie = numbers.match(et[12]).group(0)
+    indrep = et[13]
+    typvoie = et[16]
+    libvoie = et[17]
+    ligne4N = ''
+    ligne4D = ''
+    # code INSEE de la commune
+    depcom = et[22]
+
+    if numvoie == '' and numbers.match(libvoie).group(0):
+        numvoie = numbers.match(libvoie).group(0)
+        libvoie = libvoie[len(numvoie):]
+
+    # typvoie incorrect ou à désabréger pour un score cohérent
+    typ_abrege = {'PRO': 'PROMENADE',
+                  'AV': 'AVENUE',
+                  'BD': 'BOULEVARD',
+                  'PL': 'PLACE',
+                  'CAR': 'CARREFOUR',
+                  'PAS': 'PASSAGE',
+                  'IMP': 'IMPASSE'}
+    if typvoie in typ_abrege:
+        typvoie == typ_abrege[typvoie]
+
+    # élimination des LD / LIEU-DIT des libellés
+    if typvoie in ['LD', 'HAM']:
+        typvoie = ''
+    libvoie = re.sub(r'^PRO ', 'PROMENADE ', libvoie)
+    libvoie = re.sub(r'^(LD|HAM|HAMMEAU) ', '', libvoie)
+    libvoie = re.sub(r'^LIEU(.|)DIT ', '', libvoie)
+    libvoie = re.sub(r'^ADRESSE INCOMPLETE.*', '', libvoie)
+    libvoie = re.sub(r'^SANS DOMICILE FIXE', '', libvoie)
+    libvoie = re.sub(r'^COMMUNE DE RATTACHEMENT', '', libvoie)
+
+    # code insee inconnu ?
+    if depcom != '' and depcom < '97000' and depcom in histo_depcom:
+        if libvoie != '':
+            libvoie = libvoie + " " + histo_depcom[depcom]['NCC']
+        depcom = histo_depcom[depcom]['POLE']
+
+    # ou de la ligne 4 normalisée
+    ligne4G = ('%s%s %s %s' % (numvoie, indrep, typvoie, libvoie)).strip()
+    if et[11] != '':
+        ligne4D = ('%s%s %s %s %s' % (numvoie, indrep, typvoie, libvoie, et[11])).strip()
+
+    return {'numvoie': numvoie, 'indrep': indrep, 'typvoie': typvoie,
+            'libvoie': libvoie, 'depcom': depcom, 'ligne4G': ligne4G,
+            'ligne4N': ligne4N, 'ligne4D': ligne4D,
+            'key': cache_key(depcom, ligne4G, ligne4N, ligne4D)}
+
+
+async def geocode_address(client, adr):
+    numvoie, indrep = adr['numvoie'], adr['indrep']
+    typvoie, libvoie, depcom = adr['typvoie'], adr['libvoie'], adr['depcom']
+    ligne4G, ligne4N, ligne4D = adr['ligne4G'], adr['ligne4N'], adr['ligne4D']
+    trace('%s / %s / %s' % (ligne4G, ligne4D, ligne4N))
+    errors = []
+    request_errors.set(errors)
+
+    # géocodage BAN (ligne4 géo, déclarée ou normalisée si pas trouvé
+    # ou score insuffisant)
+    ban = None
+    if ligne4G != '':
+        ban = await geocode(client, addok_ban, {'q': ligne4G, 'citycode': depcom,
+                                  'limit': '1'}, 'G')
+    if (ban is None or ban['properties']['score'] < score_min
+       and ligne4N != ligne4G and ligne4N != ''):
+        ban = await geocode(client, addok_ban, {'q': ligne4N, 'citycode': depcom,
+                                  'limit': '1'}, 'N')
+        trace('+ ban  L4N')
+    if (ban is None or ban['properties']['score'] < score_min
+       and ligne4D != ligne4N and ligne4D != ligne4G
+       and ligne4D != ''):
+        ban = await geocode(client, addok_ban, {'q': ligne4D, 'citycode': depcom,
+                                  'limit': '1'}, 'D')
+        trace('+ ban  L4D')
+
+    if ban is not None:
+        ban_score = ban['properties']['score']
+        ban_type = ban['properties']['type']
+        if ['village', 'town', 'city'].count(ban_type) > 0:
+            ban_type = 'municipality'
     else:
-        total = total + 1
-        # fichier SIRENE (stock et quotidien)
-        #  géocodage de l'adresse géographique
-        #  au cas où numvoie contiendrait autre chose que des chiffres...
-        numvoie = numbers.match(et[12]).group(0)
-        indrep = et[13]
-        typvoie = et[16]
-        libvoie = et[17]
-        ligne4N = ''
-        ligne4D = ''
-        # code INSEE de la commune
-        depcom = et[22]
-
-        if numvoie == '' and numbers.match(libvoie).group(0):
-            numvoie = numbers.match(libvoie).group(0)
-            libvoie = libvoie[len(numvoie):]
-
-        # typvoie incorrect ou à désabréger pour un score cohérent
-        typ_abrege = {'PRO': 'PROMENADE',
-                      'AV': 'AVENUE',
-                      'BD': 'BOULEVARD',
-                      'PL': 'PLACE',
-                      'CAR': 'CARREFOUR',
-                      'PAS': 'PASSAGE',
-                      'IMP': 'IMPASSE'}
-        if typvoie in typ_abrege:
-            typvoie == typ_abrege[typvoie]
-
-        # élimination des LD / LIEU-DIT des libellés
-        if typvoie in ['LD', 'HAM']:
-            typvoie = ''
-        libvoie = re.sub(r'^PRO ', 'PROMENADE ', libvoie)
-        libvoie = re.sub(r'^(LD|HAM|HAMMEAU) ', '', libvoie)
-        libvoie = re.sub(r'^LIEU(.|)DIT ', '', libvoie)
-        libvoie = re.sub(r'^ADRESSE INCOMPLETE.*', '', libvoie)
-        libvoie = re.sub(r'^SANS DOMICILE FIXE', '', libvoie)
-        libvoie = re.sub(r'^COMMUNE DE RATTACHEMENT', '', libvoie)
-
-        # code insee inconnu ?
-        if depcom != '' and depcom < '97000' and depcom in histo_depcom:
-            if libvoie != '':
-                libvoie = libvoie + " " + histo_depcom[depcom]['NCC']
-            depcom = histo_depcom[depcom]['POLE']
-
-        # ou de la ligne 4 normalisée
-        ligne4G = ('%s%s %s %s' % (numvoie, indrep, typvoie, libvoie)).strip()
-        if et[11] != '':
-            ligne4D = ('%s%s %s %s %s' % (numvoie, indrep, typvoie, libvoie, et[11])).strip()
-
-        try:
-            cursor = conn.execute('SELECT * FROM cache_addok WHERE adr=?',
-                                  ('%s|%s|%s|%s' % (depcom, ligne4G,
-                                                    ligne4N, ligne4D), ))
-            g = cursor.fetchone()
-        except:
-            g = None
-        if g is not None:
+        ban_score = 0
+        ban_type = ''
+
+
+    # choix de la source
+    source = None
+    score = 0
+
+    # on a un numéro... on cherche dessus
+    if numvoie != '':
+        # numéro trouvé dans les deux bases, on prend BAN
+        # sauf si score inférieur de 20% à BANO
+        if (ban_type == 'housenumber' and ban_score > score_min):
+            source = ban
+            score = ban['properties']['score']
+        # on cherche une interpollation dans BAN
+        elif ban is None or ban_type == 'street' and int(numvoie) > 2:
+            # les deux numéros encadrants sont cherchés en même temps
+            ban_avant, ban_apres = await asyncio.gather(
+                geocode(client, addok_ban, {'q': '%s %s %s' % (int(numvoie)-2, typvoie, libvoie), 'citycode': depcom, 'limit': '1'}, 'G'),
+                geocode(client, addok_ban, {'q': '%s %s %s' % (int(numvoie)+2, typvoie, libvoie), 'citycode': depcom, 'limit': '1'}, 'G'),
+            )
+            if ban_avant is not None and ban_apres is not None:
+                if (ban_avant['properties']['type'] == 'housenumber' and
+                   ban_apres['properties']['type'] == 'housenumber' and
+                   ban_avant['properties']['score'] > 0.5 and
+                   ban_apres['properties']['score'] > score_min):
+                    source = ban_avant
+                    score = ban_avant['properties']['score']/2
+                    source['geometry']['coordinates'][0] = round((ban_avant['geometry']['coordinates'][0]+ban_apres['geometry']['coordinates'][0])/2,6)
+                    source['geometry']['coordinates'][1] = round((ban_avant['geometry']['coordinates'][1]+ban_apres['geometry']['coordinates'][1])/2,6)
+                    source['properties']['score'] = (ban_avant['properties']['score']+ban_apres['properties']['score'])/2
+                    source['properties']['type'] = 'interpolation'
+                    source['properties']['id'] = ''
+                    source['properties']['label'] = numvoie + ban_avant['properties']['label'][len(ban_avant['properties']['housenumber']):]
+
+    # on essaye sans l'indice de répétition (BIS, TER qui ne correspond pas ou qui manque en base)
+    if source is None and ban is None and indrep != '':
+        trace('supp. indrep BAN : %s %s %s' % (numvoie, typvoie, libvoie))
+        addok = await geocode(client, addok_ban, {'q': '%s %s %s' % (numvoie, typvoie, libvoie), 'citycode': depcom, 'limit': '1'}, 'G')
+        if addok is not None and addok['properties']['type'] == 'housenumber' and addok['properties']['score'] > score_min:
+            addok['properties']['type'] = 'interpolation'
+            source = addok
+            trace('+ ban  L4G-indrep')
+
+    # pas trouvé ? on cherche une rue
+    if source is None and typvoie != '':
+        if ban_type == 'street' and ban_score > score_min:
+            source = ban
+            score = ban['properties']['score']
+
+    # pas trouvé ? on cherche sans numvoie
+    if source is None and numvoie != '':
+        trace('supp. numvoie : %s %s %s' % (numvoie, typvoie, libvoie))
+        addok = await geocode(client, addok_ban, {'q': '%s %s' % (typvoie, libvoie), 'citycode': depcom, 'limit': '1'}, 'G')
+        if addok is not None and addok['properties']['type'] == 'street' and addok['properties']['score'] > score_min:
+            source = addok
+            trace('+ ban  L4G-numvoie')
+
+    # toujours pas trouvé ? tout type accepté...
+    if source is None:
+        if ban_score > score_min:
+            source = ban
+
+    # vraiment toujours pas trouvé comme adresse ?
+    # on cherche dans les POI OpenStreetMap...
+    if source is None:
+        # Mairies et Hôtels de Ville...
+        if ['MAIRIE','LA MAIRIE','HOTEL DE VILLE'].count(libvoie) > 0:
+            poi = await geocode(client, addok_poi, {'q': 'hotel de ville', 'poi': 'townhall', 'citycode': depcom, 'limit': '1'}, 'G')
+            if poi is not None and poi['properties']['score'] > score_min:
+                source = poi
+        # Gares...
+        elif ['GARE', 'GARE SNCF', 'LA GARE'].count(libvoie) > 0:
+            poi = await geocode(client, addok_poi, {'q': 'gare', 'poi': 'station', 'citycode': depcom, 'limit': '1'}, 'G')
+            if poi is not None and poi['properties']['score'] > score_min:
+                source = poi
+        # Centres commerciaux...
+        elif re.match(ccial, libvoie) is not None:
+            poi = await geocode(client, addok_poi, {'q': re.sub(ccial, '\1 Galerie Marchande', libvoie), 'poi': 'mall', 'citycode': depcom, 'limit': '1'}, 'G')
+            if poi is not None and poi['properties']['score'] > 0.5:
+                source = poi
+        elif re.match(ccial,libvoie) is not None:
+            poi = await geocode(client, addok_poi, {'q': re.sub(ccial, '\1 Centre Commercial', libvoie), 'citycode': depcom, 'limit': '1'}, 'G')
+            if poi is not None and poi['properties']['score'] > 0.5:
+                source = poi
+        # Aéroports et aérodromes...
+        elif re.match(r'(AEROPORT|AERODROME)', libvoie) is not None:
+            poi = await geocode(client, addok_poi, {'q': libvoie, 'poi': 'aerodrome', 'citycode': depcom, 'limit': '1'}, 'G')
+            if poi is not None and poi['properties']['score'] > score_min:
+                source = poi
+        elif re.match(r'(AEROGARE|TERMINAL)', libvoie) is not None:
+            poi = await geocode(client, addok_poi, {'q': re.sub(r'(AEROGARE|TERMINAL)', '', libvoie)+' terminal', 'poi': 'terminal', 'citycode': depcom, 'limit': '1'}, 'G')
+            if poi is not None and poi['properties']['score'] > score_min:
+                source = poi
+
+        # recherche tout type de POI à partir du type et libellé de voie
+        if source is None:
+            poi = await geocode(client, addok_poi, {'q': typvoie+' '+libvoie,
+                                      'citycode': depcom,
+                                      'limit': '1'}, 'G')
+            if poi is not None and poi['properties']['score'] > 0.7:
+                source = poi
+
+        if source is not None:
+            if source['properties']['poi'] != 'yes':
+                source['properties']['type'] = source['properties']['type']+'.'+source['properties']['poi']
+            print(json.dumps({'action': 'poi', 'adr_insee': depcom,
+                              'adr_texte': libvoie, 'poi': source},
+                             sort_keys=True))
+
+    if source is not None and score == 0:
+        score = source['properties']['score']
+
+    return source, score, len(errors) > 0
+
+
+async def geocode_window(client, geocache, addresses):
+    # chaque adresse distincte de la fenêtre n'est géocodée qu'une fois
+    global test, test2
+    keys = list(dict.fromkeys(adr['key'] for adr in addresses if adr is not None))
+    found = geocache.get_many(keys)
+    to_geocode = {}
+    for adr in addresses:
+        if adr is None:
+            continue
+        if adr['key'] in found:
             test = test + 1
-            source = marshal.loads(g[1])
-            cache = cache+1
-        else:
+        elif adr['key'] not in to_geocode:
             test2 = test2 + 1
-            trace('%s / %s / %s' % (ligne4G, ligne4D, ligne4N))
-
-            # géocodage BAN (ligne4 géo, déclarée ou normalisée si pas trouvé
-            # ou score insuffisant)
-            ban = None
-            if ligne4G != '':
-                ban = geocode(addok_ban[ban_number], {'q': ligne4G, 'citycode': depcom,
-                                          'limit': '1'}, 'G')
-            if (ban is None or ban['properties']['score'] < score_min
-               and ligne4N != ligne4G and ligne4N != ''):
-                ban = geocode(addok_ban[ban_number], {'q': ligne4N, 'citycode': depcom,
-                                          'limit': '1'}, 'N')
-                trace('+ ban  L4N')
-            if (ban is None or ban['properties']['score'] < score_min
-               and ligne4D != ligne4N and ligne4D != ligne4G
-               and ligne4D != ''):
-                ban = geocode(addok_ban[ban_number], {'q': ligne4D, 'citycode': depcom,
-                                          'limit': '1'}, 'D')
-                trace('+ ban  L4D')
-
-            if ban is not None:
-                ban_score = ban['properties']['score']
-                ban_type = ban['properties']['type']
-                if ['village', 'town', 'city'].count(ban_type) > 0:
-                    ban_type = 'municipality'
-            else:
-                ban_score = 0
-                ban_type = ''
-
-
-            # choix de la source
-            source = None
-            score = 0
-
-            # on a un numéro... on cherche dessus
-            if numvoie != '':
-                # numéro trouvé dans les deux bases, on prend BAN
-                # sauf si score inférieur de 20% à BANO
-                if (ban_type == 'housenumber' and ban_score > score_min):
-                    source = ban
-                    score = ban['properties']['score']
-                # on cherche une interpollation dans BAN
-                elif ban is None or ban_type == 'street' and int(numvoie) > 2:
-                    ban_avant = geocode(addok_ban[ban_number], {'q': '%s %s %s' % (int(numvoie)-2, typvoie, libvoie), 'citycode': depcom, 'limit': '1'}, 'G')
-                    ban_apres = geocode(addok_ban[ban_number], {'q': '%s %s %s' % (int(numvoie)+2, typvoie, libvoie), 'citycode': depcom, 'limit': '1'}, 'G')
-                    if ban_avant is not None and ban_apres is not None:
-                        if (ban_avant['properties']['type'] == 'housenumber' and
-                           ban_apres['properties']['type'] == 'housenumber' and
-                           ban_avant['properties']['score'] > 0.5 and
-                           ban_apres['properties']['score'] > score_min):
-                            source = ban_avant
-                            score = ban_avant['properties']['score']/2
-                            source['geometry']['coordinates'][0] = round((ban_avant['geometry']['coordinates'][0]+ban_apres['geometry']['coordinates'][0])/2,6)
-                            source['geometry']['coordinates'][1] = round((ban_avant['geometry']['coordinates'][1]+ban_apres['geometry']['coordinates'][1])/2,6)
-                            source['properties']['score'] = (ban_avant['properties']['score']+ban_apres['properties']['score'])/2
-                            source['properties']['type'] = 'interpolation'
-                            source['properties']['id'] = ''
-                            source['properties']['label'] = numvoie + ban_avant['properties']['label'][len(ban_avant['properties']['housenumber']):]
-
-            # on essaye sans l'indice de répétition (BIS, TER qui ne correspond pas ou qui manque en base)
-            if source is None and ban is None and indrep != '':
-                trace('supp. indrep BAN : %s %s %s' % (numvoie, typvoie, libvoie))
-                addok = geocode(addok_ban[ban_number], {'q': '%s %s %s' % (numvoie, typvoie, libvoie), 'citycode': depcom, 'limit': '1'}, 'G')
-                if addok is not None and addok['properties']['type'] == 'housenumber' and addok['properties']['score'] > score_min:
-                    addok['properties']['type'] = 'interpolation'
-                    source = addok
-                    trace('+ ban  L4G-indrep')
-
-            # pas trouvé ? on cherche une rue
-            if source is None and typvoie != '':
-                if ban_type == 'street' and ban_score > score_min:
-                    source = ban
-                    score = ban['properties']['score']
-
-            # pas trouvé ? on cherche sans numvoie
-            if source is None and numvoie != '':
-                trace('supp. numvoie : %s %s %s' % (numvoie, typvoie, libvoie))
-                addok = geocode(addok_ban[ban_number], {'q': '%s %s' % (typvoie, libvoie), 'citycode': depcom, 'limit': '1'}, 'G')
-                if addok is not None and addok['properties']['type'] == 'street' and addok['properties']['score'] > score_min:
-                    source = addok
-                    trace('+ ban  L4G-numvoie')
-
-            # toujours pas trouvé ? tout type accepté...
-            if source is None:
-                if ban_score > score_min:
-                    source = ban
-
-            # vraiment toujours pas trouvé comme adresse ?
-            # on cherche dans les POI OpenStreetMap...
-            if source is None:
-                # Mairies et Hôtels de Ville...
-                if ['MAIRIE','LA MAIRIE','HOTEL DE VILLE'].count(libvoie) > 0:
-                    poi = geocode(addok_poi, {'q': 'hotel de ville', 'poi': 'townhall', 'citycode': depcom, 'limit': '1'}, 'G')
-                    if poi is not None and poi['properties']['score'] > score_min:
-                        source = poi
-                # Gares...
-                elif ['GARE', 'GARE SNCF', 'LA GARE'].count(libvoie) > 0:
-                    poi = geocode(addok_poi, {'q': 'gare', 'poi': 'station', 'citycode': depcom, 'limit': '1'}, 'G')
-                    if poi is not None and poi['properties']['score'] > score_min:
-                        source = poi
-                # Centres commerciaux...
-                elif re.match(ccial, libvoie) is not None:
-                    poi = geocode(addok_poi, {'q': re.sub(ccial, '\1 Galerie Marchande', libvoie), 'poi': 'mall', 'citycode': depcom, 'limit': '1'}, 'G')
-                    if poi is not None and poi['properties']['score'] > 0.5:
-                        source = poi
-                elif re.match(ccial,libvoie) is not None:
-                    poi = geocode(addok_poi, {'q': re.sub(ccial, '\1 Centre Commercial', libvoie), 'citycode': depcom, 'limit': '1'}, 'G')
-                    if poi is not None and poi['properties']['score'] > 0.5:
-                        source = poi
-                # Aéroports et aérodromes...
-                elif re.match(r'(AEROPORT|AERODROME)', libvoie) is not None:
-                    poi = geocode(addok_poi, {'q': libvoie, 'poi': 'aerodrome', 'citycode': depcom, 'limit': '1'}, 'G')
-                    if poi is not None and poi['properties']['score'] > score_min:
-                        source = poi
-                elif re.match(r'(AEROGARE|TERMINAL)', libvoie) is not None:
-                    poi = geocode(addok_poi, {'q': re.sub(r'(AEROGARE|TERMINAL)', '', libvoie)+' terminal', 'poi': 'terminal', 'citycode': depcom, 'limit': '1'}, 'G')
-                    if poi is not None and poi['properties']['score'] > score_min:
-                        source = poi
-
-                # recherche tout type de POI à partir du type et libellé de voie
-                if source is None:
-                    poi = geocode(addok_poi, {'q': typvoie+' '+libvoie,
-                                              'citycode': depcom,
-                                              'limit': '1'}, 'G')
-                    if poi is not None and poi['properties']['score'] > 0.7:
-                        source = poi
-
-                if source is not None:
-                    if source['properties']['poi'] != 'yes':
-                        source['properties']['type'] = source['properties']['type']+'.'+source['properties']['poi']
-                    print(json.dumps({'action': 'poi', 'adr_insee': depcom,
-                                      'adr_texte': libvoie, 'poi': source},
-                                     sort_keys=True))
-
-            if source is not None and score == 0:
-                score = source['properties']['score']
-
-            # on conserve le résultat dans le cache sqlite
-            if conn:
-                key = ('%s|%s|%s|%s' % (depcom, ligne4G, ligne4N, ligne4D))
-                cursor = conn.execute('INSERT INTO cache_addok VALUES (?,?,?)',
-                                      (key, marshal.dumps(source), score))
-
-        if source is None:
-            # attention latitude et longitude sont inversées dans le fichier
-            # CSV et donc la base sqlite
-            row = et+['', '', 0, '', '', '', '', '', '']
-            try:
-                row = et+[commune_insee[depcom]['lon'],
-                          commune_insee[depcom]['lat'],
-                          0, 'municipality', '', commune_insee[i], '', '', '']
-                if ligne4G.strip() != '':
-                    if typvoie == '' and ['CHEF LIEU', 'CHEF-LIEU',
-                                          'LE CHEF LIEU', 'LE CHEF-LIEU',
-                                          'BOURG', 'LE BOURG', 'AU BOURG',
-                                          'VILLAGE', 'AU VILLAGE',
-                                          'LE VILLAGE'].count(libvoie) > 0:
-                        stats['locality'] += 1
-                        ok += 1
+            to_geocode[adr['key']] = adr
+    if use_csv_batch:
+        await client.prefetch([(adr['ligne4G'], adr['depcom'])
+                               for adr in to_geocode.values() if adr['ligne4G'] != ''])
+    results = await asyncio.gather(*[geocode_address(client, adr)
+                                     for adr in to_geocode.values()])
+    client.prefetched = {}
+    # on conserve le résultat dans le cache sqlite, sauf si une requête a échoué
+    global errors_count
+    created = int(time.time())
+    for key, (source, score, failed) in zip(to_geocode, results):
+        found[key] = (pack_geo(source), created)
+        if failed:
+            errors_count += 1
+        else:
+            geocache.put(key, found[key][0], score, created)
+    geocache.flush()
+    return found, set(to_geocode)
+
+
+async def main():
+    global ok, total, cache, reused, score_count, score_total, score_variance
+    async with AddokClient(addok_ban, addok_poi, max_in_flight) as client:
+        while True:
+            window = [et for _, et in zip(range(window_size), sirene_csv)]
+            if not window:
+                break
+            addresses = [prepare(et) for et in window]
+            for et, adr in zip(window, addresses):
+                if adr is not None and et[0]+et[1] in previous:
+                    old_hash, old_geo, old_created = previous[et[0]+et[1]]
+                    if old_hash == address_hash(et):
+                        adr['previous'] = old_geo
+                        adr['created'] = old_created
+            found, geocoded = await geocode_window(
+                client, geocache, [adr for adr in addresses if adr is not None and 'previous' not in adr])
+            # écriture des résultats dans l'ordre du fichier
+            for et, adr in zip(window, addresses):
+                if adr is None:
+                    row = et+['', '', 0, '', '', '', '', '', '']
+                    sirene_geo.writerow(row)
+                    continue
+                total = total + 1
+                typvoie, libvoie, depcom = adr['typvoie'], adr['libvoie'], adr['depcom']
+                ligne4G, ligne4N, ligne4D = adr['ligne4G'], adr['ligne4N'], adr['ligne4D']
+                if 'previous' in adr:
+                    # adresse inchangée depuis le précédent géocodage
+                    reused = reused+1
+                    source = unpack_geo(adr['previous'])
+                else:
+                    if adr['key'] in geocoded:
+                        # première occurrence de l'adresse, les suivantes sont servies par le cache
+                        geocoded.discard(adr['key'])
                     else:
-                        stats['municipality'] += 1
-                        print(json.dumps({'action': 'manque',
-                                          'siret': et[0]+et[1],
-                                          'adr_comm_insee': depcom,
-                                          'adr_texte': ligne4G.strip(),
-                                          'adr_norm': ligne4N.strip(),
-                                          'adr_decl': ligne4D.strip()},
-                                         sort_keys=True))
+                        cache = cache+1
+                    source = unpack_geo(found[adr['key']][0])
+                    adr['created'] = found[adr['key']][1]
+                if dates_file is not None:
+                    dates_file.write('%s,%d\n' % (et[0]+et[1], adr['created']))
+
+                if source is None:
+                    # attention latitude et longitude sont inversées dans le fichier
+                    # CSV et donc la base sqlite
+                    row = et+['', '', 0, '', '', '', '', '', '']
+                    try:
+                        row = et+[commune_insee[depcom]['lon'],
+                                  commune_insee[depcom]['lat'],
+                                  0, 'municipality', '', commune_insee[i], '', '', '']
+                        if ligne4G.strip() != '':
+                            if typvoie == '' and ['CHEF LIEU', 'CHEF-LIEU',
+                                                  'LE CHEF LIEU', 'LE CHEF-LIEU',
+                                                  'BOURG', 'LE BOURG', 'AU BOURG',
+                                                  'VILLAGE', 'AU VILLAGE',
+                                                  'LE VILLAGE'].count(libvoie) > 0:
+                                stats['locality'] += 1
+                                ok += 1
+                            else:
+                                stats['municipality'] += 1
+                                print(json.dumps({'action': 'manque',
+                                                  'siret': et[0]+et[1],
+                                                  'adr_comm_insee': depcom,
+                                                  'adr_texte': ligne4G.strip(),
+                                                  'adr_norm': ligne4N.strip(),
+                                                  'adr_decl': ligne4D.strip()},
+                                                 sort_keys=True))
+                        else:
+                            stats['vide'] += 1
+                            ok += 1
+                    except:
+                        pass
+                    sirene_geo.writerow(row)
                 else:
-                    stats['vide'] += 1
                     ok += 1
-            except:
-                pass
-            sirene_geo.writerow(row)
-        else:
-            ok += 1
-            if ['village', 'town', 'city'].count(source['properties']['type']) > 0:
-                source['properties']['type'] = 'municipality'
-            stats[re.sub(r'\..*$', '', source['properties']['type'])] += 1
-            sirene_geo.writerow(et+[source['geometry']['coordinates'][0],
-                                    source['geometry']['coordinates'][1],
-                                    round(source['properties']['score'], 2),
-                                    source['properties']['type'],
-                                    source['properties']['label'],
-                                    source['properties']['id'],
-                                    source['l4'] if 'l4' in source else '',
-                                    source['geo_l4'] if 'geo_l4' in source else '',
-                                    source['geo_l5'] if 'geo_l5' in source else ''])
-            if 'score' in source['properties']:
-                score_count = score_count + 1
-                score_total = score_total + source['properties']['score']
-                if score_count > 100:
-                    score_variance = score_variance + (source['properties']['score'] - score_total / score_count) ** 2
-
-        if total % 1000 == 0:
-            stats['geocode_cache'] = cache
-            stats['count'] = total
-            stats['geocode_count'] = geocode_count
-            if total>0:
-                stats['efficacite'] = round(100*ok/total, 2)
-            if score_count > 0:
-                stats['geocode_score_avg'] = score_total / score_count
-            if score_count > 101:
-                stats['geocode_score_variance'] = score_variance / (score_count-101)
-            print(json.dumps(stats, sort_keys=True))
-            if conn:
-                conn.commit()
+                    if ['village', 'town', 'city'].count(source['properties']['type']) > 0:
+                        source['properties']['type'] = 'municipality'
+                    stats[re.sub(r'\..*$', '', source['properties']['type'])] += 1
+                    sirene_geo.writerow(et+[source['geometry']['coordinates'][0],
+                                            source['geometry']['coordinates'][1],
+                                            round(source['properties']['score'], 2),
+                                            source['properties']['type'],
+                                            source['properties']['label'],
+                                            source['properties']['id'],
+                                            source['l4'] if 'l4' in source else '',
+                                            source['geo_l4'] if 'geo_l4' in source else '',
+                                            source['geo_l5'] if 'geo_l5' in source else ''])
+                    if 'score' in source['properties']:
+                        score_count = score_count + 1
+                        score_total = score_total + source['properties']['score']
+                        if score_count > 100:
+                            score_variance = score_variance + (source['properties']['score'] - score_total / score_count) ** 2
+
+                if total % 1000 == 0:
+                    stats['geocode_cache'] = cache
+                    stats['geocode_reused'] = reused
+                    stats['count'] = total
+                    stats['geocode_count'] = geocode_count
+                    stats['geocode_errors'] = errors_count
+                    stats.update(geocache.stats)
+                    if total>0:
+                        stats['efficacite'] = round(100*ok/total, 2)
+                    if score_count > 0:
+                        stats['geocode_score_avg'] = score_total / score_count
+                    if score_count > 101:
+                        stats['geocode_score_variance'] = score_variance / (score_count-101)
+                    print(json.dumps(stats, sort_keys=True))
+
+
+test = 0
+test2 = 0
+geocache = GeocodeCache(conn, lru_size)
+asyncio.run(main())
 
 stats['geocode_cache'] = cache
+stats['geocode_reused'] = reused
 stats['count'] = total
 stats['geocode_count'] = geocode_count
+stats['geocode_errors'] = errors_count
+stats.update(geocache.stats)
 stats['action'] = 'final'
 if total>0:
     stats['efficacite'] = round(100*ok/total, 2)
@@ -480,3 +845,9 @@ if score_count > 101:
 print(json.dumps(stats, sort_keys=True))
 if conn:
     conn.commit()
+if dates_file:
+    dates_file.close()
+if gzip_body:
+    geo_file.close()
+    if gzip_body.wait() != 0:
+        sys.exit('gzip a échoué pour %s' % sys.argv[2])
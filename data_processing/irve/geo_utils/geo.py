@@ -1,9 +1,13 @@
-from typing import Dict, List
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 import geojson
 import json
 import os
+import numpy as np
 import pandas as pd
 import requests
+import shapely
 from shapely.geometry import Point, shape
 from shapely.geometry.polygon import Polygon
 
@@ -18,6 +22,113 @@ with open(
 # Create a Polygon
 geoms = [region["geometry"] for region in FRANCE_BBOXES.get("features")]
 polys = [shape(geom) for geom in geoms]
+for poly in polys:
+    # speeds up the repeated contains tests on these polygons
+    shapely.prepare(poly)
+
+
+GEO_API_COMMUNES_URL = "https://geo.api.gouv.fr/communes"
+GEO_API_MAX_WORKERS = 8
+
+
+class CommuneIndex:
+    """
+    Offline lookups of communes by coordinates, code and postcode, built from a
+    single bulk call to geo.api.gouv.fr. Communes are returned like the API does
+    (dicts with code, nom and codesPostaux), in the API order.
+    """
+
+    def __init__(self, features: List[dict]):
+        self.communes = [
+            {
+                "code": feature["properties"]["code"],
+                "nom": feature["properties"]["nom"],
+                "codesPostaux": feature["properties"].get("codesPostaux", []),
+            }
+            for feature in features
+        ]
+        self.communes_by_code = defaultdict(list)
+        self.communes_by_postcode = defaultdict(list)
+        for commune in self.communes:
+            self.communes_by_code[commune["code"]].append(commune)
+            for postcode in commune["codesPostaux"]:
+                self.communes_by_postcode[postcode].append(commune)
+        # some communes have no contour
+        self.tree_communes = [k for k, feature in enumerate(features) if feature.get("geometry")]
+        self.tree = shapely.STRtree(
+            [shape(features[k]["geometry"]) for k in self.tree_communes]
+        )
+
+    @classmethod
+    def from_api(cls) -> "CommuneIndex":
+        response = requests.get(
+            GEO_API_COMMUNES_URL,
+            params={"fields": "code,nom,codesPostaux", "format": "geojson", "geometry": "contour"},
+        )
+        response.raise_for_status()
+        return cls(response.json()["features"])
+
+    def communes_at(self, lon: pd.Series, lat: pd.Series) -> List[List[dict]]:
+        """Communes containing each point, one list per point"""
+        points = shapely.points(
+            pd.to_numeric(lon, errors="coerce").to_numpy(dtype=float),
+            pd.to_numeric(lat, errors="coerce").to_numpy(dtype=float),
+        )
+        results = [[] for _ in range(len(points))]
+        point_ids, tree_ids = self.tree.query(points, predicate="intersects")
+        for point_id, tree_id in zip(point_ids, tree_ids):
+            results[point_id].append(self.communes[self.tree_communes[tree_id]])
+        return results
+
+    def communes_with_code(self, code: str) -> List[dict]:
+        return self.communes_by_code.get(code, [])
+
+    def communes_with_postcode(self, postcode: str) -> List[dict]:
+        return self.communes_by_postcode.get(postcode, [])
+
+
+class GeoApiCommunes:
+    """
+    Same lookups as CommuneIndex through geo.api.gouv.fr, used if the index can't
+    be built. Each distinct query is sent once, the coordinates ones concurrently.
+    """
+
+    def __init__(self, max_workers: int = GEO_API_MAX_WORKERS):
+        self.session = requests.Session()
+        self.max_workers = max_workers
+        self.cache = {}
+
+    def _get(self, params: Tuple[Tuple[str, str], ...]) -> List[dict]:
+        if params not in self.cache:
+            response = self.session.get(GEO_API_COMMUNES_URL, params=dict(params))
+            commune_results = json.loads(response.content)
+            self.cache[params] = (
+                commune_results if response.status_code == requests.codes.ok else []
+            )
+        return self.cache[params]
+
+    def communes_at(self, lon: pd.Series, lat: pd.Series) -> List[List[dict]]:
+        queries = [
+            (("lat", str(y)), ("lon", str(x)), ("fields", "code,nom,codesPostaux"))
+            for x, y in zip(lon, lat)
+        ]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(self._get, set(queries)))
+        return [self.cache[query] for query in queries]
+
+    def communes_with_code(self, code: str) -> List[dict]:
+        return self._get((("code", code), ("fields", "codesPostaux,nom")))
+
+    def communes_with_postcode(self, postcode: str) -> List[dict]:
+        return self._get((("codePostal", postcode), ("fields", "code,nom")))
+
+
+def get_communes_resolver():
+    try:
+        return CommuneIndex.from_api()
+    except Exception as e:
+        print(f"Could not build the communes index, falling back on the API: {e}")
+        return GeoApiCommunes()
 
 
 def is_point_in_polygon(x: float, y: float, polygon: List[List[float]]) -> bool:
@@ -31,28 +142,52 @@ def is_point_in_france(coordonnees_xy: List[float]) -> bool:
     return any(p.within(poly) for poly in polys)
 
 
-def fix_coordinates_order(
+def are_points_in_france(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Vectorised version of is_point_in_france, for arrays of coordinates"""
+    in_france = np.zeros(len(x), dtype=bool)
+    for poly in polys:
+        # contains_xy excludes the boundary, like within
+        in_france |= shapely.contains_xy(poly, x, y)
+    return in_france
+
+
+def parse_coordinates(
     df: pd.DataFrame, coordinates_column: str = "coordonneesXY"
+) -> List[list]:
+    """Parses the "[lon, lat]" coordinates of the dataframe, once per row"""
+    return [json.loads(coordinates) for coordinates in df[coordinates_column]]
+
+
+def add_lon_lat_cols_from_coordinates(df: pd.DataFrame, coordinates: List[list]) -> None:
+    coordinates = pd.Series(coordinates, index=df.index, dtype=object)
+    df["consolidated_longitude"] = coordinates.str[0]
+    df["consolidated_latitude"] = coordinates.str[1]
+
+
+def fix_coordinates_order(
+    df: pd.DataFrame,
+    coordinates_column: str = "coordonneesXY",
+    add_lon_lat_cols: bool = False,
 ) -> pd.DataFrame:
     """
     Cette fonction modifie une dataframe pour placer la longitude avant la latitude
     dans la colonne qui contient les deux au format "[lon, lat]".
+    Les coordonnées ne sont lues qu'une fois, et avec add_lon_lat_cols les colonnes
+    de longitude et latitude sont créées dans la foulée (voir create_lon_lat_cols).
     """
-
-    def fix_coordinates(row: pd.Series) -> pd.Series:
-        coordonnees_xy = json.loads(row[coordinates_column])
-        reversed_coordonnees = list(reversed(coordonnees_xy))
-        row["consolidated_coordinates_reordered"] = False
-        if is_point_in_france(reversed_coordonnees):
-            # Coordinates are inverted with lat before lon
-            row[coordinates_column] = json.dumps(reversed_coordonnees)
-            row["consolidated_coordinates_reordered"] = True
-            fix_coordinates.rows_modified = fix_coordinates.rows_modified + 1
-        return row
-
-    fix_coordinates.rows_modified = 0
-    df = df.apply(fix_coordinates, axis=1)
-    print(f"Coordinates reordered: {fix_coordinates.rows_modified}/{len(df)}")
+    coordinates = parse_coordinates(df, coordinates_column)
+    xy = np.array(coordinates, dtype=float).reshape(-1, 2)
+    # Coordinates are inverted with lat before lon if the reversed point is in France
+    reordered = are_points_in_france(xy[:, 1], xy[:, 0])
+    for k in np.flatnonzero(reordered):
+        coordinates[k] = list(reversed(coordinates[k]))
+    df.loc[reordered, coordinates_column] = [
+        json.dumps(coordinates[k]) for k in np.flatnonzero(reordered)
+    ]
+    df["consolidated_coordinates_reordered"] = reordered
+    if add_lon_lat_cols:
+        add_lon_lat_cols_from_coordinates(df, coordinates)
+    print(f"Coordinates reordered: {reordered.sum()}/{len(df)}")
     return df
 
 
@@ -60,9 +195,7 @@ def create_lon_lat_cols(
     df: pd.DataFrame, coordinates_column: str = "coordonneesXY"
 ) -> pd.DataFrame:
     """Add longitude and latitude columns to dataframe using coordinates_column"""
-    coordinates = df[coordinates_column].apply(json.loads)
-    df["consolidated_longitude"] = coordinates.str[0]
-    df["consolidated_latitude"] = coordinates.str[1]
+    add_lon_lat_cols_from_coordinates(df, parse_coordinates(df, coordinates_column))
     return df
 
 
@@ -99,24 +232,19 @@ def fix_code_insee( # noqa
     address_col: str = "adresse_station",
     lon_col: str = "consolidated_longitude",
     lat_col: str = "consolidated_latitude",
+    communes_resolver=None,
 ) -> pd.DataFrame:
     """Check code INSEE in CSV file and enrich with postcode and city
     Requires address and coordinates columns
+    Communes are looked up in a CommuneIndex by default (see get_communes_resolver)
     """
 
-    def enrich_row_address(row: pd.Series, session) -> pd.Series:
+    def enrich_row_address(row: Dict, commune_results: List[dict]) -> Dict:
         row["consolidated_is_lon_lat_correct"] = False
         row["consolidated_is_code_insee_verified"] = False
         row["consolidated_code_insee_modified"] = False
         # Try getting commune with code INSEE from latitude and longitude alone
-        response = session.get(
-            url=(
-                f"https://geo.api.gouv.fr/communes?lat={row[lat_col]}"
-                f"&lon={row[lon_col]}&fields=code,nom,codesPostaux"
-            )
-        )
-        commune_results = json.loads(response.content)
-        if (response.status_code == requests.codes.ok) and (len(commune_results) > 0):
+        if len(commune_results) > 0:
             commune = commune_results[0]
             if row[code_insee_col] == commune["code"]:
                 if len(commune["codesPostaux"]) == 1:
@@ -144,13 +272,8 @@ def fix_code_insee( # noqa
 
         if str(row[code_insee_col]) in row[address_col]:
             # Code INSEE field actually contains a postcode
-            response = session.get(
-                url=f"https://geo.api.gouv.fr/communes?codePostal={row[code_insee_col]}&fields=code,nom"
-            )
-            commune_results = json.loads(response.content)
-            if (response.status_code == requests.codes.ok) and (
-                len(commune_results) > 0
-            ):
+            commune_results = communes_resolver.communes_with_postcode(row[code_insee_col])
+            if len(commune_results) > 0:
                 commune = commune_results[0]
                 row["consolidated_code_postal"] = row[code_insee_col]
                 row["consolidated_commune"] = commune["nom"]
@@ -162,11 +285,8 @@ def fix_code_insee( # noqa
 
         if isinstance(row[code_insee_col], str) and row[code_insee_col]:
             # Check if postcode is in address
-            response = session.get(
-                url=f"https://geo.api.gouv.fr/communes?code={row[code_insee_col]}&fields=codesPostaux,nom"
-            )
-            commune_results = json.loads(response.content)
-            if (response.status_code == requests.codes.ok) and (len(commune_results) > 0):
+            commune_results = communes_resolver.communes_with_code(row[code_insee_col])
+            if len(commune_results) > 0:
                 commune = commune_results[0]
                 for postcode in commune["codesPostaux"]:
                     if postcode in row[address_col]:
@@ -183,7 +303,10 @@ def fix_code_insee( # noqa
         enrich_row_address.nothing_matches += 1
         return row
 
-    session = requests.Session()
+    if communes_resolver is None:
+        communes_resolver = get_communes_resolver()
+    # all the coordinates are looked up at once
+    communes_at_coordinates = communes_resolver.communes_at(df[lon_col], df[lat_col])
     enrich_row_address.already_good = 0
     enrich_row_address.code_fixed = 0
     enrich_row_address.code_coords_mismatch = 0
@@ -192,7 +315,14 @@ def fix_code_insee( # noqa
     enrich_row_address.code_insee_has_postcode_in_address = 0
     enrich_row_address.nothing_matches = 0
 
-    df = df.apply(lambda x: enrich_row_address(x, session), axis=1)
+    # rows are enriched as dicts, much faster than adding fields to Series
+    df = pd.DataFrame(
+        [
+            enrich_row_address(row, commune_results)
+            for row, commune_results in zip(df.to_dict("records"), communes_at_coordinates)
+        ],
+        index=df.index,
+    )
 
     total_rows = len(df)
     print(
@@ -229,10 +359,10 @@ def improve_geo_data_quality(file_cols_mapping: Dict[str, Dict[str, str]]) -> No
     for filepath, cols_dict in file_cols_mapping.items():
         df = pd.read_csv(filepath, dtype="str", na_filter=False, keep_default_na=False)
         schema_cols = list(df.columns)
-        df = fix_coordinates_order(df, coordinates_column=cols_dict["xy_coords"])
-        print("Done fixing coordinates")
-        df = create_lon_lat_cols(df, coordinates_column=cols_dict["xy_coords"])
-        print("Done creating long lat")
+        df = fix_coordinates_order(
+            df, coordinates_column=cols_dict["xy_coords"], add_lon_lat_cols=True
+        )
+        print("Done fixing coordinates and creating long lat")
         df = fix_code_insee(
             df,
             code_insee_col=cols_dict["code_insee"],
@@ -1,14 +1,10 @@
 from datetime import datetime, timedelta
-import ftplib
 from airflow.models import DAG
 from airflow.operators.bash import BashOperator
 from airflow.operators.python import PythonOperator
 
 from datagouvfr_data_pipelines.config import (
     AIRFLOW_DAG_TMP,
-    SECRET_FTP_METEO_USER,
-    SECRET_FTP_METEO_PASSWORD,
-    SECRET_FTP_METEO_ADDRESS
 )
 from datagouvfr_data_pipelines.data_processing.meteo.ftp_processing.task_functions import (
     get_current_files_on_ftp,
@@ -27,9 +23,6 @@ TMP_FOLDER = f"{AIRFLOW_DAG_TMP}meteo/"
 DAG_NAME = 'data_processing_meteo'
 DATADIR = f"{AIRFLOW_DAG_TMP}meteo/data"
 
-ftp = ftplib.FTP(SECRET_FTP_METEO_ADDRESS)
-ftp.login(SECRET_FTP_METEO_USER, SECRET_FTP_METEO_PASSWORD)
-
 default_args = {
     'retries': 5,
     'retry_delay': timedelta(minutes=5),
@@ -53,9 +46,6 @@ with DAG(
     get_current_files_on_ftp = PythonOperator(
         task_id='get_current_files_on_ftp',
         python_callable=get_current_files_on_ftp,
-        op_kwargs={
-            "ftp": ftp,
-        },
     )
 
     get_current_files_on_minio = PythonOperator(
@@ -66,9 +56,6 @@ with DAG(
     get_and_upload_file_diff_ftp_minio = PythonOperator(
         task_id='get_and_upload_file_diff_ftp_minio',
         python_callable=get_and_upload_file_diff_ftp_minio,
-        op_kwargs={
-            "ftp": ftp,
-        },
     )
 
     upload_new_files = PythonOperator(
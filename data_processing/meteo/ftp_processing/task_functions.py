@@ -1,10 +1,8 @@
-import ftplib
-import os
+from concurrent.futures import ThreadPoolExecutor
 import json
 from datetime import datetime, timedelta, timezone
 import re
 import requests
-from dateutil import parser
 from collections import defaultdict
 
 from datagouvfr_data_pipelines.config import (
@@ -12,12 +10,20 @@ from datagouvfr_data_pipelines.config import (
     AIRFLOW_DAG_TMP,
     AIRFLOW_ENV,
     MINIO_URL,
+    SECRET_FTP_METEO_USER,
+    SECRET_FTP_METEO_PASSWORD,
+    SECRET_FTP_METEO_ADDRESS,
 )
 from datagouvfr_data_pipelines.utils.datagouv import (
     post_remote_resource,
     update_dataset_or_resource_metadata,
     DATAGOUV_URL
 )
+from datagouvfr_data_pipelines.utils.ftp import (
+    FTPSessionPool,
+    list_ftp_files,
+    transfer_ftp_files_to_minio,
+)
 from datagouvfr_data_pipelines.utils.mattermost import send_message
 from datagouvfr_data_pipelines.utils.minio import MinIOClient
 
@@ -29,6 +35,12 @@ with open(f"{AIRFLOW_DAG_HOME}{ROOT_FOLDER}meteo/config/dgv.json") as fp:
     config = json.load(fp)
 hooks = ["latest", "previous"]
 minio_meteo = MinIOClient(bucket=bucket)
+# budget for FTP transfers, not to overload Météo-France's production server
+FTP_MAX_SESSIONS = 3
+FTP_MAX_BYTES_PER_SECOND = 50 * 1024 ** 2
+# timezone of the dates returned by the server when it doesn't support MLSD
+FTP_SERVER_TIMEZONE = "Europe/Paris"
+DATAGOUV_MAX_WORKERS = 8
 
 
 def clean_hooks(string: str, hooks: list = hooks) -> str:
@@ -38,33 +50,75 @@ def clean_hooks(string: str, hooks: list = hooks) -> str:
     return _
 
 
-def previous_date_parse(date_string: str) -> datetime:
-    # this returns the last occurrence of the date, not a future one
-    tmp = parser.parse(date_string)
-    if tmp > datetime.today():
-        tmp = tmp.replace(year=tmp.year - 1)
-    return tmp
-
-
 def get_path(full_file_path: str) -> str:
     # get BASE/DECAD from BASE/DECAD/DECADQ_01_1852-1949.csv.gz
     return "/".join(full_file_path.split("/")[:-1])
 
 
-def get_resource_lists() -> dict:
-    resources_lists = {
-        path: {
-            r["url"]: {
-                "id": r["id"],
-                "last_modified": datetime.fromisoformat(r["internal"]["last_modified_internal"]),
-            } for r in requests.get(
-                f"{DATAGOUV_URL}/api/1/datasets/{config[path]['dataset_id'][AIRFLOW_ENV]}/",
-                headers={"X-fields": "resources{id,url,internal{last_modified_internal}}"}
-            ).json()["resources"]
+def to_naive_utc(date: datetime) -> datetime:
+    # dates are compared with the modification dates of the FTP files, as naive UTC
+    if date.tzinfo is None:
+        return date
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def fetch_datasets_metadata() -> dict:
+    # one call per dataset (several paths can share a dataset), made concurrently
+    # the result is passed along the tasks through XCom and updated in place
+    # after each modification, so that the API is not called again in every task
+    dataset_ids = set(config[path]["dataset_id"][AIRFLOW_ENV] for path in config)
+    session = requests.Session()
+    session.headers.update({
+        "X-fields": "tags,resources{id,url,title,type,internal{last_modified_internal}}"
+    })
+
+    def fetch(dataset_id):
+        r = session.get(f"{DATAGOUV_URL}/api/1/datasets/{dataset_id}/")
+        r.raise_for_status()
+        return r.json()
+
+    with ThreadPoolExecutor(max_workers=DATAGOUV_MAX_WORKERS) as executor:
+        results = dict(zip(dataset_ids, executor.map(fetch, dataset_ids)))
+    session.close()
+    return {
+        dataset_id: {
+            "tags": dataset["tags"],
+            "resources": {
+                r["url"]: {
+                    "id": r["id"],
+                    "title": r["title"],
+                    "type": r["type"],
+                    "last_modified": to_naive_utc(
+                        datetime.fromisoformat(r["internal"]["last_modified_internal"])
+                    ),
+                } for r in dataset["resources"]
+            },
         }
+        for dataset_id, dataset in results.items()
+    }
+
+
+def apply_resource_changes(datasets_metadata: dict, changes: list) -> dict:
+    # changes are the resources created or modified by a task, as
+    # {"dataset_id", "url", "id", "title", "type", "old_url"}
+    for change in changes:
+        resources = datasets_metadata[change["dataset_id"]]["resources"]
+        if change.get("old_url"):
+            resources.pop(change["old_url"], None)
+        resources[change["url"]] = {
+            "id": change["id"],
+            "title": change["title"],
+            "type": change["type"],
+            "last_modified": to_naive_utc(datetime.now(timezone.utc)),
+        }
+    return datasets_metadata
+
+
+def get_resource_lists(datasets_metadata: dict) -> dict:
+    return {
+        path: datasets_metadata[config[path]["dataset_id"][AIRFLOW_ENV]]["resources"]
         for path in config.keys()
     }
-    return resources_lists
 
 
 def build_file_id(file: str, path: str) -> str:
@@ -126,47 +180,32 @@ def build_resource(
     return file_with_ext, path, resource_name, description, url, is_doc
 
 
-def list_ftp_files_recursive(ftp, path: str = "", base_path: str = "") -> list:
-    files = []
+def get_current_files_on_ftp(ti) -> None:
+    ftp_pool = FTPSessionPool(
+        SECRET_FTP_METEO_ADDRESS,
+        SECRET_FTP_METEO_USER,
+        SECRET_FTP_METEO_PASSWORD,
+        max_sessions=FTP_MAX_SESSIONS,
+    )
     try:
-        ftp.cwd(path)
-        current_path = f"{base_path}/{path}" if base_path else path
-        ftp.retrlines(
-            "LIST",
-            lambda x: files.append((
-                current_path.split("//")[-1],
-                x.split()[-1],
-                int(x.split()[4]),
-                x.split()[5:8],
-            ))
-        )
-        for item in files:
-            # assuming no folder contains a dot (we'll make sure it doesn't happen)
-            if "." not in item[1]:
-                files += list_ftp_files_recursive(ftp, f"{path}/{item[1]}", current_path)
-    except ftplib.error_perm:
-        pass
-    return files
-
-
-def get_current_files_on_ftp(ti, ftp) -> None:
-    raw_ftp_files = list_ftp_files_recursive(ftp)
+        raw_ftp_files = list_ftp_files(ftp_pool, server_tz=FTP_SERVER_TIMEZONE)
+    finally:
+        ftp_pool.close()
     ftp_files = {}
     # pour distinguer les nouveaux fichiers (nouvelles décennie révolue, période stock...)
     # des fichiers qui changent de nom lors de mises à jour (QUOT_SIM2_2020-202309.csv.gz
     # qui devient QUOT_SIM2_2020-202310.csv.gz), on utilise des balises afin de cibler ces fichiers
     # et de remplacer l'ancien par le nouveau au lieu d'ajouter le nouveau fichier
     # et de laisser les deux coexister
-    for (path, file, size, date_list) in raw_ftp_files:
+    for (path, file, size, modif_date) in raw_ftp_files:
         if "." in file:
-            path = path.lstrip("/")
             file_id = build_file_id(file, path)
             # we keep path in the id just in case two files would have the same name/id
             # but in different folders
             ftp_files[path + "/" + file_id] = {
                 "file_path": path + "/" + file,
                 "size": size,
-                "modif_date": previous_date_parse(" ".join(date_list))
+                "modif_date": modif_date,
             }
     for f in ftp_files:
         print(f, ":", ftp_files[f])
@@ -222,7 +261,7 @@ def has_file_been_updated_already(ftp_file: dict, resources_lists: dict) -> bool
     return has_been_modified
 
 
-def get_and_upload_file_diff_ftp_minio(ti, ftp) -> None:
+def get_and_upload_file_diff_ftp_minio(ti) -> None:
     minio_files = ti.xcom_pull(key="minio_files", task_ids="get_current_files_on_minio")
     ftp_files = ti.xcom_pull(key="ftp_files", task_ids="get_current_files_on_ftp")
     # much debated part of the code: how to best get which files to consider here
@@ -234,7 +273,8 @@ def get_and_upload_file_diff_ftp_minio(ti, ftp) -> None:
     # our best try: check the modification date on the FTP and take the file if it has
     # been changed since the previous day (DAG will run daily), and if the file has not
     # been updated already
-    resources_lists = get_resource_lists()
+    datasets_metadata = fetch_datasets_metadata()
+    resources_lists = get_resource_lists(datasets_metadata)
     diff_files = [
         f for f in ftp_files
         if f not in minio_files
@@ -249,7 +289,7 @@ def get_and_upload_file_diff_ftp_minio(ti, ftp) -> None:
     files_to_update_same_name = []
     files_to_update_new_name = {}
     updated_datasets = set()
-    # doing it one file at a time in order not to overload production server
+    to_transfer = []
     for file_to_transfer in diff_files:
         print("___________________________")
         # if the file_id is in minio_files, it means that the current file is not
@@ -277,28 +317,27 @@ def get_and_upload_file_diff_ftp_minio(ti, ftp) -> None:
         # we are recreating the file structure from FTP to Minio
         path = get_path(ftp_files[file_to_transfer]["file_path"])
         file_name = ftp_files[file_to_transfer]["file_path"].split("/")[-1]
-        ftp.cwd("/" + path)
-        # downloading the file from FTP
-        with open(DATADIR + "/" + file_name, "wb") as local_file:
-            ftp.retrbinary("RETR " + file_name, local_file.write)
-
-        # sending file to Minio
-        try:
-            minio_meteo.send_files(
-                list_files=[
-                    {
-                        "source_path": f"{DATADIR}/",
-                        "source_name": file_name,
-                        "dest_path": minio_folder + path + "/",
-                        "dest_name": file_name,
-                    }
-                ],
-                ignore_airflow_env=True
-            )
-            updated_datasets.add(path)
-        except:
-            print("⚠️ Unable to send file")
-        os.remove(f"{DATADIR}/{file_name}")
+        to_transfer.append({
+            "source_path": "/" + path,
+            "source_name": file_name,
+            "dest_path": minio_folder + path + "/",
+            "dest_name": file_name,
+        })
+
+    # files are streamed from the FTP to Minio without being stored locally,
+    # within a budget of sessions and bandwidth in order not to overload production server
+    transfer_metrics = transfer_ftp_files_to_minio(
+        ftp_host=SECRET_FTP_METEO_ADDRESS,
+        ftp_user=SECRET_FTP_METEO_USER,
+        ftp_password=SECRET_FTP_METEO_PASSWORD,
+        minio_client=minio_meteo,
+        list_files=to_transfer,
+        max_sessions=FTP_MAX_SESSIONS,
+        max_bytes_per_second=FTP_MAX_BYTES_PER_SECOND,
+    )
+    for file in to_transfer:
+        if "error" not in transfer_metrics[file["source_path"] + "/" + file["source_name"]]:
+            updated_datasets.add(file["source_path"].lstrip("/"))
     print("___________________________")
     print(len(new_files), "new files:", new_files)
     print(len(files_to_update_same_name), "updated same name:", files_to_update_same_name)
@@ -313,6 +352,8 @@ def get_and_upload_file_diff_ftp_minio(ti, ftp) -> None:
     ti.xcom_push(key="new_files", value=new_files)
     ti.xcom_push(key="files_to_update_new_name", value=files_to_update_new_name)
     ti.xcom_push(key="files_to_update_same_name", value=files_to_update_same_name)
+    ti.xcom_push(key="transfer_metrics", value=transfer_metrics)
+    ti.xcom_push(key="datasets_metadata", value=datasets_metadata)
 
 
 def get_file_extention(file: str) -> str:
@@ -332,7 +373,14 @@ def upload_new_files(ti) -> None:
         ti.xcom_pull(key="new_files", task_ids="handle_updated_files_same_name")
         + ti.xcom_pull(key="new_files", task_ids="handle_updated_files_new_name")
     )
-    resources_lists = get_resource_lists()
+    # the resources have been modified by the previous tasks, we bring the metadata up to date
+    datasets_metadata = ti.xcom_pull(key="datasets_metadata", task_ids="get_and_upload_file_diff_ftp_minio")
+    for task in ["handle_updated_files_same_name", "handle_updated_files_new_name"]:
+        apply_resource_changes(
+            datasets_metadata,
+            ti.xcom_pull(key="resource_changes", task_ids=task),
+        )
+    resources_lists = get_resource_lists(datasets_metadata)
     new_files += spotted_new_files
 
     # adding files that are on minio, not updated from FTP in this batch,
@@ -368,8 +416,9 @@ def upload_new_files(ti) -> None:
             file_with_ext
         )
         try:
-            post_remote_resource(
-                dataset_id=config[path]["dataset_id"][AIRFLOW_ENV],
+            dataset_id = config[path]["dataset_id"][AIRFLOW_ENV]
+            resource = post_remote_resource(
+                dataset_id=dataset_id,
                 payload={
                     "url": url,
                     "filesize": minio_files[minio_folder + file_path],
@@ -379,6 +428,13 @@ def upload_new_files(ti) -> None:
                     "description": description,
                 },
             )
+            apply_resource_changes(datasets_metadata, [{
+                "dataset_id": dataset_id,
+                "url": url,
+                "id": resource["id"],
+                "title": resource["title"],
+                "type": resource["type"],
+            }])
             raise_if_duplicates(idx)
             new_files_datasets.add(path)
             updated_datasets.add(path)
@@ -389,6 +445,7 @@ def upload_new_files(ti) -> None:
     ti.xcom_push(key="new_files_datasets", value=new_files_datasets)
     ti.xcom_push(key="updated_datasets", value=updated_datasets)
     ti.xcom_push(key="new_files", value=[f for f in new_files if f not in went_wrong])
+    ti.xcom_push(key="datasets_metadata", value=datasets_metadata)
 
 
 def handle_updated_files_same_name(ti) -> None:
@@ -398,9 +455,11 @@ def handle_updated_files_same_name(ti) -> None:
         task_ids="get_and_upload_file_diff_ftp_minio"
     )
     minio_files = ti.xcom_pull(key="minio_files", task_ids="get_and_upload_file_diff_ftp_minio")
-    resources_lists = get_resource_lists()
+    datasets_metadata = ti.xcom_pull(key="datasets_metadata", task_ids="get_and_upload_file_diff_ftp_minio")
+    resources_lists = get_resource_lists(datasets_metadata)
 
     new_files = []
+    resource_changes = []
     for idx, file_path in enumerate(files_to_update_same_name):
         path = get_path(file_path)
         if path not in resources_lists:
@@ -422,10 +481,16 @@ def handle_updated_files_same_name(ti) -> None:
             dataset_id=config[path]['dataset_id'][AIRFLOW_ENV],
             resource_id=resources_lists[path][url]["id"],
         )
+        resource_changes.append({
+            "dataset_id": config[path]['dataset_id'][AIRFLOW_ENV],
+            "url": url,
+            **{k: resources_lists[path][url][k] for k in ["id", "title", "type"]},
+        })
         raise_if_duplicates(idx)
         updated_datasets.add(path)
     ti.xcom_push(key="updated_datasets", value=updated_datasets)
     ti.xcom_push(key="new_files", value=new_files)
+    ti.xcom_push(key="resource_changes", value=resource_changes)
 
 
 def handle_updated_files_new_name(ti) -> None:
@@ -435,9 +500,11 @@ def handle_updated_files_new_name(ti) -> None:
         task_ids="get_and_upload_file_diff_ftp_minio"
     )
     minio_files = ti.xcom_pull(key="minio_files", task_ids="get_and_upload_file_diff_ftp_minio")
-    resources_lists = get_resource_lists()
+    datasets_metadata = ti.xcom_pull(key="datasets_metadata", task_ids="get_and_upload_file_diff_ftp_minio")
+    resources_lists = get_resource_lists(datasets_metadata)
 
     new_files = []
+    resource_changes = []
     for idx, file_path in enumerate(files_to_update_new_name):
         file_with_ext, path, resource_name, description, url, is_doc = build_resource(
             file_path,
@@ -463,10 +530,19 @@ def handle_updated_files_new_name(ti) -> None:
             dataset_id=config[path]["dataset_id"][AIRFLOW_ENV],
             resource_id=resources_lists[path][old_url]["id"],
         )
+        resource_changes.append({
+            "dataset_id": config[path]["dataset_id"][AIRFLOW_ENV],
+            "url": url,
+            "id": resources_lists[path][old_url]["id"],
+            "title": resource_name if not is_doc else file_with_ext,
+            "type": resources_lists[path][old_url]["type"],
+            "old_url": old_url,
+        })
         raise_if_duplicates(idx)
         updated_datasets.add(path)
     ti.xcom_push(key="updated_datasets", value=updated_datasets)
     ti.xcom_push(key="new_files", value=new_files)
+    ti.xcom_push(key="resource_changes", value=resource_changes)
 
 
 def update_temporal_coverages(ti) -> None:
@@ -482,13 +558,12 @@ def update_temporal_coverages(ti) -> None:
             key="updated_datasets",
             task_ids=task
         )
+    datasets_metadata = ti.xcom_pull(key="datasets_metadata", task_ids="upload_new_files")
     print("Updating datasets temporal_coverage")
     for path in updated_datasets:
         if path in period_starts:
             # for now the tags are erased when touching the metadata so we save them and put them back
-            tags = requests.get(
-                f"{DATAGOUV_URL}/api/1/datasets/{config[path]['dataset_id'][AIRFLOW_ENV]}/"
-            ).json()["tags"]
+            tags = datasets_metadata[config[path]["dataset_id"][AIRFLOW_ENV]]["tags"]
             update_dataset_or_resource_metadata(
                 payload={
                     "temporal_coverage": {
@@ -500,6 +575,7 @@ def update_temporal_coverages(ti) -> None:
                 dataset_id=config[path]["dataset_id"][AIRFLOW_ENV]
             )
     ti.xcom_push(key="updated_datasets", value=updated_datasets)
+    ti.xcom_push(key="datasets_metadata", value=datasets_metadata)
 
 
 def log_modified_files(ti) -> None:
@@ -599,11 +675,9 @@ def notification_mattermost(ti) -> None:
             config[path]['name_template']
         )
         paths[config[path]['dataset_id'][AIRFLOW_ENV]] = path
+    datasets_metadata = ti.xcom_pull(key="datasets_metadata", task_ids="update_temporal_coverages")
     for dataset_id in allowed_patterns:
-        resources = requests.get(
-            f'{DATAGOUV_URL}/api/1/datasets/{dataset_id}/',
-            headers={'X-fields': 'resources{title,id,type}'}
-        ).json()['resources']
+        resources = datasets_metadata[dataset_id]['resources'].values()
         for r in resources:
             if (
                 r['type'] == 'main'
@@ -1,4 +1,5 @@
 import json
+import hashlib
 import requests
 import os
 from collections import defaultdict
@@ -9,9 +10,7 @@ import csv
 from datetime import datetime, timedelta
 import re
 from jinja2 import Environment, FileSystemLoader
-import psycopg2
 from typing import Optional
-import pandas as pd
 from airflow.hooks.base import BaseHook
 
 from datagouvfr_data_pipelines.config import (
@@ -22,7 +21,13 @@ from datagouvfr_data_pipelines.config import (
 from datagouvfr_data_pipelines.utils.postgres import (
     execute_sql_file,
     execute_query,
+    pooled_conn,
+    copy_iterable,
+    BULK_LOAD_TABLE_SHARE,
+    bulk_load,
+    delete_by_keys,
 )
+from datagouvfr_data_pipelines.utils.diff import diff_lines
 from datagouvfr_data_pipelines.utils.download import download_files
 from datagouvfr_data_pipelines.utils.minio import MinIOClient
 from datagouvfr_data_pipelines.utils.mattermost import send_message
@@ -36,31 +41,12 @@ minio_meteo = MinIOClient(bucket='meteofrance')
 
 
 conn = BaseHook.get_connection("POSTGRES_METEO")
-db_params = {
-    'database': conn.schema,
-    'user': conn.login,
-    'password': conn.password,
-    'host': conn.host,
-    'port': conn.port,
-}
 
 SCHEMA_NAME = 'meteo'
 TIMEOUT = 60 * 5
+MANIFEST_VERSION = 1
 
 
-def smart_cast(value, _type):
-    try:
-        return _type(value)
-    except:
-        return None
-
-
-type_mapping = {
-    'character varying': str,
-    'double precision': lambda x: smart_cast(x, float),
-    'integer': lambda x: smart_cast(x, int),
-}
-
 DEPIDS = [
     '01', '02', '03', '04', '05', '06', '07', '08', '09', '10',
     '11', '12', '13', '14', '15', '16', '17', '18', '19', '20',
@@ -100,6 +86,10 @@ def build_deletions_file_name(file_name):
     return file_name.replace(".csv", "_deletions.csv")
 
 
+def build_manifest_file_name(file_name):
+    return file_name.replace(".csv.gz", ".csv").replace(".csv", ".manifest.json")
+
+
 # %%
 def create_tables_if_not_exists(ti):
     ti.xcom_push(key="start", value=datetime.now().timestamp())
@@ -261,63 +251,99 @@ def process_resources(
         regex_infos = {"name": file_path.name, "regex_infos": regex_infos}
         print("Starting with", file_path.name)
 
-        _conn = psycopg2.connect(**db_params)
-        _conn.autocommit = False
-        _failed = False
-        try:
-            deletions = get_diff(
-                _conn=_conn,
-                csv_path=csv_path,
-                regex_infos=regex_infos,
-                table=table_name,
-            )
-            # skipping if no diff
-            if (
-                count_lines_in_file(build_deletions_file_name(csv_path)) == 0
-                and count_lines_in_file(build_additions_file_name(csv_path)) == 0
-            ):
-                continue
-            delete_and_insert_into_pg(
-                _conn=_conn,
-                deletions=deletions,
-                regex_infos=regex_infos,
-                table=table_name,
-                csv_path=csv_path,
-            )
-
-            if AIRFLOW_ENV == "prod":
-                minio_meteo.send_files(
-                    list_files=[
+        with pooled_conn(
+            conn.host,
+            conn.port,
+            conn.schema,
+            conn.login,
+            conn.password,
+            SCHEMA_NAME,
+        ) as _conn:
+            _failed = False
+            try:
+                new_manifest = build_manifest(csv_path)
+                old_manifest = fetch_manifest(resource)
+                has_changed = True
+                if old_manifest is not None:
+                    # only the stations whose content has changed are replaced,
+                    # no need to download and diff the previous version of the file
+                    changed_blocks = get_changed_blocks(old_manifest, new_manifest)
+                    if not changed_blocks:
+                        print("> No block has changed since last mirroring")
+                        continue
+                    replace_blocks(
+                        _conn=_conn,
+                        table=table_name,
+                        csv_path=csv_path,
+                        regex_infos=regex_infos,
+                        blocks=changed_blocks,
+                    )
+                else:
+                    download_old_file(resource, file_path)
+                    deletions = get_diff(
+                        csv_path=csv_path,
+                        regex_infos=regex_infos,
+                    )
+                    # nothing to load if no diff, but the manifest is still uploaded below
+                    # so that the next runs don't download and diff the previous file again
+                    if (
+                        count_lines_in_file(build_deletions_file_name(csv_path)) == 0
+                        and count_lines_in_file(build_additions_file_name(csv_path)) == 0
+                    ):
+                        print("> No diff since last mirroring")
+                        has_changed = False
+                    else:
+                        delete_and_insert_into_pg(
+                            _conn=_conn,
+                            deletions=deletions,
+                            regex_infos=regex_infos,
+                            table=table_name,
+                            csv_path=csv_path,
+                        )
+
+                if AIRFLOW_ENV == "prod":
+                    manifest_path = build_manifest_file_name(csv_path)
+                    with open(manifest_path, "w") as f:
+                        json.dump(new_manifest, f)
+                    dest_path = (
+                        "synchro_pg/"
+                        + "/".join(resource["url"].split("synchro_ftp/")[1].split("/")[:-1])
+                        + "/"
+                    )
+                    list_files = [
                         {
+                            "source_path": "/".join(manifest_path.split("/")[:-1]),
+                            "source_name": manifest_path.split("/")[-1],
+                            "dest_path": dest_path,
+                            "dest_name": build_manifest_file_name(resource["url"].split("/")[-1]),
+                            "content_type": "application/json",
+                        },
+                    ]
+                    # the mirror copy is already up to date if nothing changed
+                    if has_changed:
+                        list_files.append({
                             # source can be hooked file name
                             "source_path": "/".join(csv_path.split("/")[:-1]),
                             "source_name": csv_path.split("/")[-1],
                             # but destination has to be the real file name
-                            "dest_path": (
-                                "synchro_pg/"
-                                + "/".join(resource["url"].split("synchro_ftp/")[1].split("/")[:-1])
-                                + "/"
-                            ),
+                            "dest_path": dest_path,
                             "dest_name": resource["url"].split("/")[-1].replace(".csv.gz", ".csv")
-                        }
-                    ],
-                    ignore_airflow_env=True
-                )
-            print("=> Completed work for:", regex_infos["name"])
-            _conn.commit()
-        except Exception as e:
-            _failed = True
-            _conn.rollback()
-            print(f"/!\ An error occurred: {e}")
-            print("Transaction rolled back.")
-            raise
-        finally:
-            # deleting if everything was successful, so that we can check content otherwise
-            if not _failed:
-                parent = file_path.parent.as_posix()
-                for file in os.listdir(parent):
-                    os.remove(f"{parent}/{file}")
-            _conn.close()
+                        })
+                    minio_meteo.send_files(list_files=list_files, ignore_airflow_env=True)
+                print("=> Completed work for:", regex_infos["name"])
+                _conn.commit()
+            except Exception as e:
+                _failed = True
+                _conn.rollback()
+                print(f"/!\ An error occurred: {e}")
+                print("Transaction rolled back.")
+                raise
+            finally:
+                # deleting if everything was successful, so that we can check content otherwise
+                if not _failed:
+                    parent = file_path.parent.as_posix()
+                    for file in os.listdir(parent):
+                        os.remove(f"{parent}/{file}")
 
 
 def get_regex_infos(pattern, filename, params):
@@ -345,6 +371,11 @@ def download_resource(res, dataset):
         "dest_name": file_path.name,
     }], timeout=TIMEOUT)
     csv_path = unzip_csv_gz(file_path)
+    return file_path, csv_path
+
+
+def download_old_file(res, file_path):
+    # the previous version of the file, as it is in postgres
     try:
         old_file = file_path.name.replace(".csv.gz", "_old.csv")
         download_files([{
@@ -360,7 +391,82 @@ def download_resource(res, dataset):
         #     columns = f.readline()
         # with open(build_old_file_name(str(csv_path)), "w") as f:
         #     f.write(columns)
-    return file_path, csv_path
+
+
+def build_manifest(csv_path: str):
+    # the manifest holds, for each block of rows (= each station, first column of the file),
+    # its number of rows and an order-independent hash of its rows
+    blocks = defaultdict(lambda: [0, 0])
+    with open(csv_path, "r") as f:
+        # skipping header
+        f.readline()
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            block = blocks[line.split(";", 1)[0]]
+            block[0] += 1
+            block[1] = (block[1] + int.from_bytes(
+                hashlib.blake2b(line.encode(), digest_size=8).digest(), "big"
+            )) % 2 ** 64
+    return {
+        "version": MANIFEST_VERSION,
+        "blocks": {k: f"{count}:{_hash:016x}" for k, (count, _hash) in blocks.items()},
+    }
+
+
+def fetch_manifest(res):
+    r = requests.get(
+        res["url"].replace("data/synchro_ftp/", "synchro_pg/").replace(
+            ".csv.gz", ".manifest.json"
+        ),
+        timeout=TIMEOUT,
+    )
+    if r.status_code in [403, 404]:
+        print("> No manifest for this file, falling back to full diff")
+        return None
+    r.raise_for_status()
+    manifest = r.json()
+    if manifest.get("version") != MANIFEST_VERSION:
+        print("> Outdated manifest for this file, falling back to full diff")
+        return None
+    return manifest
+
+
+def get_changed_blocks(old_manifest: dict, new_manifest: dict):
+    old_blocks, new_blocks = old_manifest["blocks"], new_manifest["blocks"]
+    changed = {
+        k for k in set(old_blocks) | set(new_blocks)
+        if old_blocks.get(k) != new_blocks.get(k)
+    }
+    print(f"> {len(changed)} blocks changed out of {len(new_blocks)}")
+    return changed
+
+
+def replace_blocks(_conn, table, csv_path, regex_infos, blocks):
+    table_name = f'{table}_{regex_infos["regex_infos"]["DEP"]}'
+    dep = regex_infos["regex_infos"]["DEP"]
+    cursor = _conn.cursor()
+    cursor.execute(
+        f"DELETE FROM {SCHEMA_NAME}.{table_name} WHERE num_poste = ANY(%s) "
+        + build_query_filters(regex_infos),
+        (list(blocks),),
+    )
+    print(f"> Deleted {cursor.rowcount} rows")
+    with open(csv_path, 'r') as f:
+        # skipping header, the rows of unchanged blocks are filtered out on the fly
+        f.readline()
+        nb_rows = copy_iterable(
+            cursor,
+            f"{SCHEMA_NAME}.{table_name}",
+            f,
+            delimiter=";",
+            transform=lambda line: (
+                line.strip() + f";{dep}\n" if line.split(";", 1)[0] in blocks else None
+            ),
+        )
+    print(f"> Inserted {nb_rows} rows")
+    cursor.close()
 
 
 def unzip_csv_gz(file_path):
@@ -372,62 +478,29 @@ def unzip_csv_gz(file_path):
     return output_file_path
 
 
-def get_diff(_conn, csv_path: Path, regex_infos: dict, table: str):
-
-    def run_diff(csv_path: str, dep: str, _filter=None):
-        old_file = build_old_file_name(csv_path)
-        additions_file = build_additions_file_name(csv_path)
-        deletions_file = build_deletions_file_name(csv_path)
-
-        with open(csv_path, 'r') as new_file, open(old_file, 'r') as old_file:
-            # skipping headers
-            new_file.readline()
-            old_file.readline()
-            # removing carriage return so that if the last row doesn't have one
-            # it'll not be considered new when data is appended
-            new_lines = set(
-                r.replace("\n", "") for r in new_file
-                if _filter is None or r.startswith(_filter)
-            )
-            old_lines = set(
-                r.replace("\n", "") for r in old_file
-                if _filter is None or r.startswith(_filter)
-            )
+def get_diff(csv_path: Path, regex_infos: dict):
 
-        with open(additions_file, 'a') as outFile:
-            for line in new_lines:
-                if line not in old_lines:
-                    outFile.write(line.strip() + f";{dep}\n")
-
-        with open(deletions_file, 'a') as outFile:
-            for line in old_lines:
-                if line not in new_lines:
-                    outFile.write(line + "\n")
-
-    def _build_deletions(_conn, csv_path: str, table_name: str):
-        cursor = _conn.cursor()
-        cursor.execute(
-            "SELECT column_name, data_type FROM information_schema.columns "
-            f"WHERE table_name = '{table_name}' ORDER BY ordinal_position;"
-        )
-        columns = cursor.fetchall()
-        cursor.close()
-        column_types = {
-            c[0]: type_mapping[c[1]] for c in columns
-        }
-        # deletions will be a list of lists of tuples (column_name, typed value)
-        # we are only keep primary keys: NUM_POSTE and period (AAAA...)
+    def _build_deletions(csv_path: str):
+        # we are only keeping primary keys: NUM_POSTE and period (AAAA...)
+        # values are sent as is, postgres casts them when they are copied
         with open(build_deletions_file_name(csv_path), "r") as f:
-            reader = csv.reader(f, delimiter=";")
-            column_names = next(reader)
-            for row in reader:
-                yield [
-                    (col_name, column_types[col_name.lower()](value))
-                    for value, col_name in zip(row, column_names)
-                    if col_name.lower() == "num_poste" or col_name.lower().startswith("aaaa")
-                ]
+            column_names = next(csv.reader(f, delimiter=";"))
+        key_indexes = [
+            idx for idx, col_name in enumerate(column_names)
+            if col_name.lower() == "num_poste" or col_name.lower().startswith("aaaa")
+        ]
+
+        def _keys():
+            with open(build_deletions_file_name(csv_path), "r") as f:
+                reader = csv.reader(f, delimiter=";")
+                # skipping header
+                next(reader)
+                for row in reader:
+                    if row:
+                        yield [row[idx] for idx in key_indexes]
+
+        return [column_names[idx].lower() for idx in key_indexes], _keys()
 
-    table_name = f'{table}_{regex_infos["regex_infos"]["DEP"]}'
     # creating empty additions and deletions files, we'll fill them up
     old_file = build_old_file_name(csv_path)
     additions_file = build_additions_file_name(csv_path)
@@ -442,39 +515,16 @@ def get_diff(_conn, csv_path: Path, regex_infos: dict, table: str):
         with open(deletions_file, 'w') as outFile:
             outFile.write(header.strip() + "\n")
 
-    # if MIN or HOR: files are too big to be handled at once, we build the diff iteratively
-    if any(_ in csv_path for _ in ['MN_', 'H_']):
-        print("> Building diff in batches...")
-        # files are too big to be handled in one go, so we process them in batches
-        # using the fact that the first column (NUM_POSTE) always starts with dep + numbers
-        for _filter in create_filters(csv_path=csv_path, dep=regex_infos["regex_infos"]["DEP"]):
-            run_diff(csv_path=csv_path, dep=regex_infos["regex_infos"]["DEP"], _filter=_filter)
-    # for other files it's fine to build diff on the whole file
-    else:
-        run_diff(csv_path=csv_path, dep=regex_infos["regex_infos"]["DEP"])
-
-    return _build_deletions(_conn, csv_path, table_name)
-
-
-def create_filters(csv_path: str, dep: str, threshold: int = 5e6):
-    # returns a list of prefixes to filter the rows
-    # once we know the batches will be of a reasonable size
-    postes = pd.read_csv(
-        csv_path,
-        sep=";",
-        dtype=str,
-        usecols=["NUM_POSTE"],
-    )["NUM_POSTE"]
-    maxes = defaultdict(int)
-    k = 0
-    while True:
-        k += 1
-        counts = postes.str.slice(len(dep), k + len(dep)).value_counts()
-        maxes[max(counts)] += 1
-        if max(counts) < threshold or max(maxes.values()) == 3:
-            break
-    print(f"> built filters of length {k} (max occurences: {max(counts)})")
-    return [dep + suffix for suffix in counts.index]
+    # the diff is built in a single pass with bounded memory, even for MIN and HOR files
+    dep = regex_infos["regex_infos"]["DEP"]
+    with open(additions_file, 'a') as add_file, open(deletions_file, 'a') as del_file:
+        for sign, line in diff_lines(csv_path, build_old_file_name(csv_path)):
+            if sign == "+":
+                add_file.write(line.strip() + f";{dep}\n")
+            else:
+                del_file.write(line + "\n")
+
+    return _build_deletions(csv_path)
 
 
 def delete_and_insert_into_pg(_conn, deletions, regex_infos, table, csv_path):
@@ -526,21 +576,26 @@ def replace_whole_period(_conn, table_name, csv_path, regex_infos):
     print("> Deleting period...")
     cursor = _conn.cursor()
     cursor.execute(f"DELETE FROM {SCHEMA_NAME}.{table_name} WHERE 1=1 " + build_query_filters(regex_infos))
-    # the raw source file is missing the DEP column
-    csv_with_dep = csv_path.replace(".csv", "_with_dep.csv")
+    # the raw source file is missing the DEP column, it is added on the fly
     dep = regex_infos["regex_infos"]["DEP"]
-    with open(csv_with_dep, 'w') as dep_file, open(csv_path, 'r') as file:
-        for idx, line in enumerate(file.readlines()):
-            if idx == 0:
-                dep_file.write(line.strip() + ";DEP\n")
-            else:
-                dep_file.write(line.strip() + f";{dep}\n")
-    nb_rows = count_lines_in_file(csv_with_dep)
+    nb_rows = count_lines_in_file(csv_path)
     print(f"> Inserting whole file ({nb_rows} rows)...")
-    with open(csv_with_dep, 'r') as f:
-        cursor.copy_expert(
-            f"COPY {SCHEMA_NAME}.{table_name} FROM STDIN WITH CSV HEADER DELIMITER ';'",
-            f
+    # indexes cover every period of the department, they are only dropped and rebuilt
+    # when the period is a large share of the table (e.g. the first load of a table):
+    # this locks the table until the commit, readers wait for the reload and the rebuild
+    with open(csv_path, 'r') as f, bulk_load(
+        cursor,
+        f"{SCHEMA_NAME}.{table_name}",
+        estimated_rows=nb_rows,
+        min_table_share=BULK_LOAD_TABLE_SHARE,
+    ):
+        copy_iterable(
+            cursor,
+            f"{SCHEMA_NAME}.{table_name}",
+            f,
+            has_header=True,
+            delimiter=";",
+            transform=lambda line: line.strip() + f";{dep}\n",
         )
     cursor.close()
 
@@ -556,59 +611,10 @@ def load_new_data(_conn, table_name, csv_path):
 
 
 def delete_old_data(_conn, table_name, deletions):
-    # deletions is a list of lists of tuples (column_name, typed value)
-    query = f"DELETE FROM {SCHEMA_NAME}.{table_name} WHERE 1 = 2"
-    skip = True
-    batch_size = 50
-    batch = 0
-    for row in deletions:
-        if row:
-            skip = False
-            filters = []
-            for name, value in row:
-                filters.append(f"{name}='{value}'")
-            query += f' OR ({" AND ".join(filters)})'
-            batch += 1
-        # executing deletions in batches for safety
-        if batch == batch_size:
-            # print(query)
-            cursor = _conn.cursor()
-            cursor.execute(query)
-            cursor.close()
-            query = f"DELETE FROM {SCHEMA_NAME}.{table_name} WHERE 1 = 2"
-            batch = 0
-    # print(query)
-    if skip:
-        return
-    # deleting the last batch
+    # deletions is a tuple (key column names, iterator of key values)
+    key_columns, keys = deletions
     cursor = _conn.cursor()
-    cursor.execute(query)
-    cursor.close()
-
-
-def drop_indexes(conn, table_name):
-    cursor = conn.cursor()
-    for col in ["dep", "num_poste", "nom_usuel", "year"]:
-        query = f"DROP INDEX IF EXISTS idx_{table_name}_{col}"
-        cursor.execute(query)
-    print("DROP INDEXES OK")
-    cursor.close()
-
-
-def create_indexes(conn, table_name, period):
-    cursor = conn.cursor()
-    query = f"CREATE INDEX IF NOT EXISTS idx_{table_name}_dep ON meteo.{table_name} (DEP)"
-    cursor.execute(query)
-    query = f"CREATE INDEX IF NOT EXISTS idx_{table_name}_num_poste ON meteo.{table_name} (NUM_POSTE)"
-    cursor.execute(query)
-    query = f"CREATE INDEX IF NOT EXISTS idx_{table_name}_nom_usuel ON meteo.{table_name} (NOM_USUEL)"
-    cursor.execute(query)
-    query = (
-        f"CREATE INDEX IF NOT EXISTS idx_{table_name}_year ON meteo.{table_name}"
-        f" (substring({period}::text, 1, 4))"
-    )
-    cursor.execute(query)
-    print("CREATE INDEXES OK")
+    delete_by_keys(cursor, f"{SCHEMA_NAME}.{table_name}", key_columns, keys)
     cursor.close()
 
 
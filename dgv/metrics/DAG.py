@@ -52,6 +52,8 @@ with DAG(
     get_new_logs = ShortCircuitOperator(
         task_id='get_new_logs',
         python_callable=get_new_logs,
+        # only skip the processing of the logs, so that the refresh still runs
+        ignore_downstream_trigger_rules=False,
     )
 
     copy_log_to_ongoing_folder = PythonOperator(
@@ -92,6 +94,8 @@ with DAG(
     refresh_materialized_views = PythonOperator(
         task_id='refresh_materialized_views',
         python_callable=refresh_materialized_views,
+        # also runs when there are no new logs, the pending dates come from the database
+        trigger_rule='none_failed',
     )
 
     create_metrics_tables.set_upstream(clean_previous_outputs)
@@ -107,3 +111,4 @@ with DAG(
     # see if we keep matomo in same dag
     process_matomo.set_upstream(download_catalog)
     save_matomo_to_postgres.set_upstream(process_matomo)
+    refresh_materialized_views.set_upstream(save_matomo_to_postgres)
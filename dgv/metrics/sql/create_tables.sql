@@ -61,113 +61,95 @@ CREATE TABLE IF NOT EXISTS metric.matomo_organizations
     nb_outlink INTEGER
 );
 
+-- Dates saved in the visits/matomo tables whose rollups haven't been updated yet,
+-- written by the save tasks and cleared once the rollups are up to date
+CREATE TABLE IF NOT EXISTS metric.pending_rollup_dates
+(
+    date_metric DATE PRIMARY KEY
+);
 
 -- Aggregated metrics tables
-CREATE MATERIALIZED VIEW IF NOT EXISTS metric.metrics_datasets AS
-    SELECT visits.__id as __id,
-            COALESCE(visits.date_metric, matomo.date_metric) as date_metric,
-           COALESCE(visits.dataset_id, matomo.dataset_id) as dataset_id,
-           COALESCE(visits.organization_id, matomo.organization_id) as organization_id,
-           visits.nb_visit,
-           matomo.nb_outlink,
-           resources.nb_visit as resource_nb_download
-    FROM metric.visits_datasets visits
-    FULL OUTER JOIN metric.matomo_datasets matomo
-    ON visits.dataset_id = matomo.dataset_id AND
-       visits.date_metric = matomo.date_metric
-    LEFT OUTER JOIN (
-        SELECT dataset_id, date_metric, sum(nb_visit) as nb_visit FROM metric.visits_resources
-        GROUP BY dataset_id, date_metric
-    ) resources
-    ON COALESCE(visits.dataset_id, matomo.dataset_id) = resources.dataset_id AND
-       COALESCE(visits.date_metric, matomo.date_metric) = resources.date_metric
-;
+-- They used to be materialized views, recomputed over the whole history every day:
+-- they are now tables, updated for the processed dates only (see sql/rollups/).
+-- The old views are dropped once, along with the views depending on them
+-- which are created again below.
+DO $$
+DECLARE
+    rollup TEXT;
+BEGIN
+    FOREACH rollup IN ARRAY ARRAY[
+        'metrics_datasets', 'metrics_reuses', 'metrics_organizations',
+        'datasets', 'reuses', 'organizations', 'resources'
+    ] LOOP
+        IF EXISTS (SELECT 1 FROM pg_matviews WHERE schemaname = 'metric' AND matviewname = rollup) THEN
+            EXECUTE format('DROP MATERIALIZED VIEW metric.%I CASCADE', rollup);
+        END IF;
+    END LOOP;
+END $$;
 
-
-CREATE MATERIALIZED VIEW IF NOT EXISTS metric.metrics_reuses AS
-    SELECT visits.__id as __id,
-           COALESCE(visits.date_metric, matomo.date_metric) as date_metric,
-           COALESCE(visits.reuse_id, matomo.reuse_id) as reuse_id,
-           COALESCE(visits.organization_id, matomo.organization_id) as organization_id,
-           visits.nb_visit,
-           matomo.nb_outlink
-    FROM metric.visits_reuses visits
-    FULL OUTER JOIN metric.matomo_reuses matomo
-    ON visits.reuse_id = matomo.reuse_id AND
-       visits.date_metric = matomo.date_metric
-;
-
-CREATE MATERIALIZED VIEW IF NOT EXISTS metric.metrics_organizations AS
-    SELECT visits.__id as __id,
-           COALESCE(visits.date_metric, matomo.date_metric) as date_metric,
-           COALESCE(visits.organization_id, matomo.organization_id) as organization_id,
-           datasets.nb_visit as dataset_nb_visit,
-           datasets.resource_nb_download as resource_nb_download,
-           reuses.nb_visit as reuse_nb_visit,
-           matomo.nb_outlink
-    FROM metric.visits_organizations visits
-    FULL OUTER JOIN metric.matomo_organizations matomo
-    ON visits.organization_id = matomo.organization_id AND
-       visits.date_metric = matomo.date_metric
-    LEFT OUTER JOIN (
-        SELECT organization_id, date_metric, sum(nb_visit) as nb_visit, sum(resource_nb_download) as resource_nb_download
-        FROM metric.metrics_datasets
-        GROUP BY organization_id, date_metric
-    ) datasets
-    ON COALESCE(visits.organization_id, matomo.organization_id) = datasets.organization_id AND
-       COALESCE(visits.date_metric, matomo.date_metric) = datasets.date_metric
-    LEFT OUTER JOIN (
-        SELECT organization_id, date_metric, sum(nb_visit) as nb_visit FROM metric.metrics_reuses
-        GROUP BY organization_id, date_metric
-    ) reuses
-    ON COALESCE(visits.organization_id, matomo.organization_id) = reuses.organization_id AND
-       COALESCE(visits.date_metric, matomo.date_metric) = reuses.date_metric
-;
+CREATE TABLE IF NOT EXISTS metric.metrics_datasets
+(
+    __id INTEGER,
+    date_metric DATE,
+    dataset_id CHARACTER VARYING,
+    organization_id CHARACTER VARYING,
+    nb_visit INTEGER,
+    nb_outlink INTEGER,
+    resource_nb_download BIGINT
+);
+CREATE TABLE IF NOT EXISTS metric.metrics_reuses
+(
+    __id INTEGER,
+    date_metric DATE,
+    reuse_id CHARACTER VARYING,
+    organization_id CHARACTER VARYING,
+    nb_visit INTEGER,
+    nb_outlink INTEGER
+);
+CREATE TABLE IF NOT EXISTS metric.metrics_organizations
+(
+    __id INTEGER,
+    date_metric DATE,
+    organization_id CHARACTER VARYING,
+    dataset_nb_visit BIGINT,
+    resource_nb_download NUMERIC,
+    reuse_nb_visit BIGINT,
+    nb_outlink INTEGER
+);
 
 -- Monthly aggregated metrics tables
-CREATE MATERIALIZED VIEW IF NOT EXISTS metric.datasets AS
-    SELECT
-        MIN(__id) as __id,
-        dataset_id,
-        to_char(date_trunc('month', date_metric) , 'YYYY-mm') AS metric_month,
-        sum(nb_visit) as monthly_visit,
-        sum(resource_nb_download) as monthly_download_resource
-    FROM metric.metrics_datasets
-    GROUP BY metric_month, dataset_id
-;
-
-CREATE MATERIALIZED VIEW IF NOT EXISTS metric.reuses AS
-    SELECT
-        MIN(__id) as __id,
-        reuse_id,
-        to_char(date_trunc('month', date_metric) , 'YYYY-mm') AS metric_month,
-        sum(nb_visit) as monthly_visit
-    FROM metric.metrics_reuses
-    GROUP BY metric_month, reuse_id
-;
-
-CREATE MATERIALIZED VIEW IF NOT EXISTS metric.organizations AS
-    SELECT
-        MIN(__id) as __id,
-        organization_id,
-        to_char(date_trunc('month', date_metric) , 'YYYY-mm') AS metric_month,
-        sum(dataset_nb_visit) as monthly_visit_dataset,
-        sum(resource_nb_download) as monthly_download_resource,
-        sum(reuse_nb_visit) as monthly_visit_reuse
-    FROM metric.metrics_organizations
-    GROUP BY metric_month, organization_id
-;
-
-CREATE MATERIALIZED VIEW IF NOT EXISTS metric.resources AS
-    SELECT
-        MIN(__id) as __id,
-        resource_id,
-        dataset_id,
-        to_char(date_trunc('month', date_metric) , 'YYYY-mm') AS metric_month,
-        sum(nb_visit) as monthly_download_resource
-    FROM metric.visits_resources
-    GROUP BY metric_month, resource_id, dataset_id
-;
+CREATE TABLE IF NOT EXISTS metric.datasets
+(
+    __id INTEGER,
+    dataset_id CHARACTER VARYING,
+    metric_month TEXT,
+    monthly_visit BIGINT,
+    monthly_download_resource NUMERIC
+);
+CREATE TABLE IF NOT EXISTS metric.reuses
+(
+    __id INTEGER,
+    reuse_id CHARACTER VARYING,
+    metric_month TEXT,
+    monthly_visit BIGINT
+);
+CREATE TABLE IF NOT EXISTS metric.organizations
+(
+    __id INTEGER,
+    organization_id CHARACTER VARYING,
+    metric_month TEXT,
+    monthly_visit_dataset NUMERIC,
+    monthly_download_resource NUMERIC,
+    monthly_visit_reuse NUMERIC
+);
+CREATE TABLE IF NOT EXISTS metric.resources
+(
+    __id INTEGER,
+    resource_id CHARACTER VARYING,
+    dataset_id CHARACTER VARYING,
+    metric_month TEXT,
+    monthly_download_resource BIGINT
+);
 
 -- Global site table
 CREATE MATERIALIZED VIEW IF NOT EXISTS metric.site AS
@@ -248,3 +230,31 @@ CREATE INDEX IF NOT EXISTS visits_reuses_organization_id ON metric.visits_reuses
 CREATE INDEX IF NOT EXISTS visits_resources_resource_id ON metric.visits_resources USING btree (resource_id);
 CREATE INDEX IF NOT EXISTS visits_resources_date_metric ON metric.visits_resources USING btree (date_metric);
 CREATE INDEX IF NOT EXISTS visits_resources_dataset_id ON metric.visits_resources USING btree (dataset_id);
+
+
+CREATE INDEX IF NOT EXISTS matomo_datasets_date_metric ON metric.matomo_datasets USING btree (date_metric);
+CREATE INDEX IF NOT EXISTS matomo_reuses_date_metric ON metric.matomo_reuses USING btree (date_metric);
+CREATE INDEX IF NOT EXISTS matomo_organizations_date_metric ON metric.matomo_organizations USING btree (date_metric);
+
+CREATE INDEX IF NOT EXISTS metrics_datasets_date_metric ON metric.metrics_datasets USING btree (date_metric);
+CREATE INDEX IF NOT EXISTS metrics_datasets_dataset_id ON metric.metrics_datasets USING btree (dataset_id);
+CREATE INDEX IF NOT EXISTS metrics_reuses_date_metric ON metric.metrics_reuses USING btree (date_metric);
+CREATE INDEX IF NOT EXISTS metrics_reuses_reuse_id ON metric.metrics_reuses USING btree (reuse_id);
+CREATE INDEX IF NOT EXISTS metrics_organizations_date_metric ON metric.metrics_organizations USING btree (date_metric);
+CREATE INDEX IF NOT EXISTS metrics_organizations_organization_id ON metric.metrics_organizations USING btree (organization_id);
+
+CREATE INDEX IF NOT EXISTS datasets_metric_month ON metric.datasets USING btree (metric_month);
+CREATE INDEX IF NOT EXISTS datasets_dataset_id ON metric.datasets USING btree (dataset_id);
+CREATE INDEX IF NOT EXISTS reuses_metric_month ON metric.reuses USING btree (metric_month);
+CREATE INDEX IF NOT EXISTS reuses_reuse_id ON metric.reuses USING btree (reuse_id);
+CREATE INDEX IF NOT EXISTS organizations_metric_month ON metric.organizations USING btree (metric_month);
+CREATE INDEX IF NOT EXISTS organizations_organization_id ON metric.organizations USING btree (organization_id);
+CREATE INDEX IF NOT EXISTS resources_metric_month ON metric.resources USING btree (metric_month);
+CREATE INDEX IF NOT EXISTS resources_resource_id ON metric.resources USING btree (resource_id);
+
+-- Unique indexes, needed to refresh the remaining materialized views concurrently
+CREATE UNIQUE INDEX IF NOT EXISTS site_metric_month ON metric.site USING btree (metric_month);
+CREATE UNIQUE INDEX IF NOT EXISTS datasets_total_dataset_id ON metric.datasets_total USING btree (dataset_id);
+CREATE UNIQUE INDEX IF NOT EXISTS reuses_total_reuse_id ON metric.reuses_total USING btree (reuse_id);
+CREATE UNIQUE INDEX IF NOT EXISTS organizations_total_organization_id ON metric.organizations_total USING btree (organization_id);
+CREATE UNIQUE INDEX IF NOT EXISTS resources_total_resource_id_dataset_id ON metric.resources_total USING btree (resource_id, dataset_id);
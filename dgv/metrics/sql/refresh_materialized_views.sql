@@ -1,12 +0,0 @@
-REFRESH MATERIALIZED VIEW metric.metrics_datasets;
-REFRESH MATERIALIZED VIEW metric.metrics_reuses;
-REFRESH MATERIALIZED VIEW metric.metrics_organizations;
-REFRESH MATERIALIZED VIEW metric.datasets;
-REFRESH MATERIALIZED VIEW metric.reuses;
-REFRESH MATERIALIZED VIEW metric.organizations;
-REFRESH MATERIALIZED VIEW metric.resources;
-REFRESH MATERIALIZED VIEW metric.site;
-REFRESH MATERIALIZED VIEW metric.datasets_total;
-REFRESH MATERIALIZED VIEW metric.reuses_total;
-REFRESH MATERIALIZED VIEW metric.organizations_total;
-REFRESH MATERIALIZED VIEW metric.resources_total;
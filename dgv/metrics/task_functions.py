@@ -1,18 +1,27 @@
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime, date, timedelta
+import csv
 import glob
 import os
+import pickle
+import re
+import shutil
+import time
 import pandas as pd
 import requests
 import tarfile
-from tqdm import tqdm
+from jinja2 import Environment, FileSystemLoader
 from airflow.hooks.base import BaseHook
 from airflow.models import Variable
 
-from datagouvfr_data_pipelines.utils.datagouv import DATAGOUV_MATOMO_ID
 from datagouvfr_data_pipelines.utils.minio import MinIOClient
 from datagouvfr_data_pipelines.utils.download import download_files
+from datagouvfr_data_pipelines.utils.matomo import MatomoClient
 from datagouvfr_data_pipelines.utils.postgres import (
     copy_file,
+    copy_files_parallel,
+    execute_query,
     execute_sql_file,
 )
 
@@ -26,9 +35,59 @@ TMP_FOLDER = f"{AIRFLOW_DAG_TMP}metrics/"
 DAG_FOLDER = "datagouvfr_data_pipelines/dgv/metrics/"
 conn = BaseHook.get_connection("POSTGRES_METRIC")
 DB_METRICS_SCHEMA = Variable.get("DB_METRICS_SCHEMA", "metric")
-tqdm.pandas(desc='pandas progress bar', mininterval=5)
 minio_infra = MinIOClient(bucket=MINIO_BUCKET_INFRA)
 
+LANGUAGES = ["fr", "en", "es"]
+# in the order they are looked for in a log item
+OBJECT_PATTERNS = [
+    ("resources-id", [f"/{lang}/datasets/r/" for lang in LANGUAGES]),
+    ("datasets", [f"/{lang}/datasets/" for lang in LANGUAGES]),
+    ("reuses", [f"/{lang}/reuses/" for lang in LANGUAGES]),
+    ("organizations", [f"/{lang}/organizations/" for lang in LANGUAGES]),
+]
+PATTERN_RESOURCES_STATIC = "/resources/"
+OBJECT_TYPES = [obj_type for obj_type, _ in OBJECT_PATTERNS] + ["resources-static"]
+# matches the items that contain at least one of the patterns above
+CANDIDATE_ITEM_REGEX = re.compile(
+    "|".join(
+        re.escape(pattern)
+        for _, patterns in OBJECT_PATTERNS for pattern in patterns
+    ) + "|" + re.escape(PATTERN_RESOURCES_STATIC)
+)
+LOG_CHUNK_SIZE = 50000
+LOG_MAX_WORKERS = os.cpu_count()
+# kept across runs, unlike TMP_FOLDER
+CATALOG_CACHE_FOLDER = f"{AIRFLOW_DAG_TMP}metrics_catalogs/"
+MATOMO_CACHE_FOLDER = f"{AIRFLOW_DAG_TMP}metrics_matomo/"
+# tables updated for the processed dates only, in dependency order:
+# each one only reads the visits/matomo tables and the rollups above it
+DAILY_ROLLUPS = ["metrics_datasets", "metrics_reuses", "metrics_organizations"]
+MONTHLY_ROLLUPS = ["datasets", "reuses", "organizations", "resources"]
+# they depend on the whole history, so they are still refreshed entirely
+MATERIALIZED_VIEWS = ["site", "datasets_total", "reuses_total", "organizations_total", "resources_total"]
+CATALOGS = {
+    "datasets": {
+        "url": "https://www.data.gouv.fr/fr/datasets/r/f868cca6-8da1-4369-a78d-47463f19a9a3",
+        "lookups": {"slug": ["slug", "id"]},
+        "attributes": ["organization_id"],
+    },
+    "organizations": {
+        "url": "https://www.data.gouv.fr/fr/datasets/r/b7bbfedc-2448-4135-a6c7-104548d396e7",
+        "lookups": {"slug": ["slug", "id"]},
+        "attributes": [],
+    },
+    "reuses": {
+        "url": "https://www.data.gouv.fr/fr/datasets/r/970aafa0-3778-4d8b-b9d1-de937525e379",
+        "lookups": {"slug": ["slug", "id"]},
+        "attributes": ["organization_id"],
+    },
+    "resources": {
+        "url": "https://www.data.gouv.fr/fr/datasets/r/4babf5f2-6a9c-45b5-9144-ca5eae6a7a6d",
+        "lookups": {"id": ["id"], "url": ["url"]},
+        "attributes": ["dataset.id", "dataset.organization_id"],
+    },
+}
+
 
 def create_metrics_tables():
     execute_sql_file(
@@ -79,29 +138,61 @@ def copy_log_to_processed_folder(ti):
     copy_log(new_logs, "/ongoing/", "/processed/")
 
 
+def get_etag(url):
+    response = requests.head(url, allow_redirects=True)
+    response.raise_for_status()
+    return response.headers.get("ETag")
+
+
+def read_etag(name):
+    etag_file = f"{CATALOG_CACHE_FOLDER}catalog_{name}.etag"
+    if not os.path.isfile(etag_file):
+        return None
+    with open(etag_file) as f:
+        return f.read()
+
+
 def download_catalog():
-    download_files([
-        {
-            "url": "https://www.data.gouv.fr/fr/datasets/r/f868cca6-8da1-4369-a78d-47463f19a9a3",
-            "dest_path": TMP_FOLDER,
-            "dest_name": "catalog_datasets.csv",
-        },
-        {
-            "url": "https://www.data.gouv.fr/fr/datasets/r/b7bbfedc-2448-4135-a6c7-104548d396e7",
-            "dest_path": TMP_FOLDER,
-            "dest_name": "catalog_organizations.csv",
-        },
-        {
-            "url": "https://www.data.gouv.fr/fr/datasets/r/970aafa0-3778-4d8b-b9d1-de937525e379",
-            "dest_path": TMP_FOLDER,
-            "dest_name": "catalog_reuses.csv",
-        },
-        {
-            "url": "https://www.data.gouv.fr/fr/datasets/r/4babf5f2-6a9c-45b5-9144-ca5eae6a7a6d",
-            "dest_path": TMP_FOLDER,
-            "dest_name": "catalog_resources.csv",
-        },
-    ])
+    """
+    The catalogs are kept in CATALOG_CACHE_FOLDER along with their ETag,
+    only the ones that changed since the previous run are downloaded again
+    """
+    os.makedirs(CATALOG_CACHE_FOLDER, exist_ok=True)
+    etags = {}
+    for name, catalog in CATALOGS.items():
+        etag = get_etag(catalog["url"])
+        if (
+            etag
+            and etag == read_etag(name)
+            and os.path.isfile(f"{CATALOG_CACHE_FOLDER}catalog_{name}.csv")
+        ):
+            print(f"catalog {name} unchanged")
+            continue
+        etags[name] = etag
+        # the cached catalog is no longer valid until downloaded
+        if os.path.isfile(f"{CATALOG_CACHE_FOLDER}catalog_{name}.etag"):
+            os.remove(f"{CATALOG_CACHE_FOLDER}catalog_{name}.etag")
+
+    if etags:
+        download_files([
+            {
+                "url": CATALOGS[name]["url"],
+                "dest_path": CATALOG_CACHE_FOLDER,
+                "dest_name": f"catalog_{name}.csv",
+            }
+            for name in etags
+        ])
+    for name, etag in etags.items():
+        print(f"catalog {name} downloaded")
+        if etag:
+            with open(f"{CATALOG_CACHE_FOLDER}catalog_{name}.etag", "w") as f:
+                f.write(etag)
+
+    for name in CATALOGS:
+        shutil.copyfile(
+            f"{CATALOG_CACHE_FOLDER}catalog_{name}.csv",
+            f"{TMP_FOLDER}catalog_{name}.csv",
+        )
 
 
 def remove_files_if_exists(folder):
@@ -113,20 +204,6 @@ def remove_files_if_exists(folder):
         os.remove(f)
 
 
-def get_dict(df, obj_property):
-    arr = {}
-    for index, row in df.iterrows():
-        if (
-            isinstance(row[obj_property], str)
-            and "static.data.gouv.fr" in row[obj_property]
-        ):
-            arr[row[obj_property]] = row["id"]
-        else:
-            arr[row[obj_property]] = row["id"]
-            arr[row["id"]] = row["id"]
-    return arr
-
-
 def get_date(a_date):
     return datetime.strptime(a_date, "[%d/%b/%Y:%H:%M:%S.%f]").strftime("%Y-%m-%d")
 
@@ -147,12 +224,6 @@ def search_pattern_resource_static(pattern, value, type_object):
 
 
 def get_info(parsed_line):
-    languages = ["fr", "en", "es"]
-    patterns_datasets = [f"/{lang}/datasets/" for lang in languages]
-    patterns_reuses = [f"/{lang}/reuses/" for lang in languages]
-    patterns_organizations = [f"/{lang}/organizations/" for lang in languages]
-    patterns_resources_id = [f"/{lang}/datasets/r/" for lang in languages]
-    pattern_resources_static = "/resources/"
     slug_line = None
     found = False
 
@@ -162,16 +233,16 @@ def get_info(parsed_line):
         and ('302' in parsed_line or '200' in parsed_line)
     ):
         for item in parsed_line:
-            slug, found, detect = search_pattern(patterns_resources_id, item, "resources-id")
-            if not found:
-                slug, found, detect = search_pattern(patterns_datasets, item, "datasets")
-            if not found:
-                slug, found, detect = search_pattern(patterns_reuses, item, "reuses")
-            if not found:
-                slug, found, detect = search_pattern(patterns_organizations, item, "organizations")
+            # most items can't match any pattern
+            if not CANDIDATE_ITEM_REGEX.search(item):
+                continue
+            for type_object, patterns in OBJECT_PATTERNS:
+                slug, found, detect = search_pattern(patterns, item, type_object)
+                if found:
+                    break
             if not found:
                 slug, found, detect = search_pattern_resource_static(
-                    pattern_resources_static,
+                    PATTERN_RESOURCES_STATIC,
                     item,
                     "resources-static"
                 )
@@ -184,34 +255,172 @@ def get_info(parsed_line):
         return None, None
 
 
-def save_list_obj_type(list_obj, obj_type):
-    file_object = open(f"{TMP_FOLDER}found/found_{obj_type}.csv", "a")
-    for item in list_obj:
-        file_object.write(f"{item['date']};{item['id']}\n")
-
-
-def save_list_obj(list_obj):
-    list_resources_id = []
-    list_resources_static = []
-    list_datasets = []
-    list_organizations = []
-    list_reuses = []
-    for obj in list_obj:
-        if obj["type"] == "resources-id":
-            list_resources_id.append(obj)
-        if obj["type"] == "resources-static":
-            list_resources_static.append(obj)
-        if obj["type"] == "datasets":
-            list_datasets.append(obj)
-        if obj["type"] == "organizations":
-            list_organizations.append(obj)
-        if obj["type"] == "reuses":
-            list_reuses.append(obj)
-    save_list_obj_type(list_resources_id, "resources-id")
-    save_list_obj_type(list_resources_static, "resources-static")
-    save_list_obj_type(list_datasets, "datasets")
-    save_list_obj_type(list_organizations, "organizations")
-    save_list_obj_type(list_reuses, "reuses")
+def count_hits(lines):
+    """Count the hits of each object in a chunk of log lines, by type and slug"""
+    hits = {obj_type: Counter() for obj_type in OBJECT_TYPES}
+    for b_line in lines:
+        try:
+            line = b_line.decode("utf-8")
+            # cheap check on the whole line before splitting it
+            if "DATAGOUVFR_RGS~" not in line or not CANDIDATE_ITEM_REGEX.search(line):
+                continue
+            slug_line, type_detect = get_info(line.split())
+            if slug_line:
+                hits[type_detect][slug_line] += 1
+        except:
+            raise Exception(f"Sorry, pb with line: {b_line}")
+    return hits
+
+
+def iter_log_chunks(file_names, chunk_size=LOG_CHUNK_SIZE):
+    """Stream the lines of all the members of the tar files, by chunks"""
+    chunk = []
+    for file_name in file_names:
+        with tarfile.open(file_name, "r:gz") as tar:
+            for log_file in tar:
+                log_data = tar.extractfile(log_file)
+                if log_data is None:
+                    continue
+                for line in log_data:
+                    chunk.append(line)
+                    if len(chunk) == chunk_size:
+                        yield chunk
+                        chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse(file_names, max_workers=LOG_MAX_WORKERS):
+    """
+    Parses the logs of a day, the chunks of lines are spread across worker processes
+    and only a few of them are in memory at any time.
+
+    Returns:
+        dict: a Counter of the hits by slug for each type of object
+    """
+    hits = {obj_type: Counter() for obj_type in OBJECT_TYPES}
+    nb_lines = 0
+
+    def merge(future):
+        for obj_type, counter in future.result().items():
+            hits[obj_type].update(counter)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for chunk in iter_log_chunks(file_names):
+            nb_lines += len(chunk)
+            pending.add(executor.submit(count_hits, chunk))
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    merge(future)
+        for future in pending:
+            merge(future)
+    print(f"{nb_lines} lines parsed")
+    for obj_type, counter in hits.items():
+        print(f"{obj_type}: {sum(counter.values())} hits on {len(counter)} objects")
+    return hits
+
+
+def get_positions(df_catalog, key_columns, id_positions):
+    """The values of key_columns (slugs, ids, urls) mapped to the position of their id"""
+    positions = {}
+    for column in key_columns:
+        has_key = df_catalog[column].notna()
+        positions.update(zip(df_catalog.loc[has_key, column], id_positions[has_key].tolist()))
+    return positions
+
+
+def get_rows(df_catalog, columns):
+    """The values of columns for each position of the catalog, missing values as None"""
+    df = df_catalog[columns].astype(object)
+    return list(df.where(df.notna(), None).itertuples(index=False, name=None))
+
+
+class CatalogIndex:
+    """
+    Interns the ids of a catalog as compact integers (the position of their last row),
+    with lookups from slugs, ids or urls to these positions, and the attributes written
+    along with the visits of each position.
+    """
+
+    def __init__(self, df_catalog, lookups, attributes, etag=None):
+        df_catalog = df_catalog[df_catalog["id"].notna()].reset_index(drop=True)
+        last_rows = df_catalog["id"].drop_duplicates(keep="last")
+        id_positions = df_catalog["id"].map(pd.Series(last_rows.index, index=last_rows.values))
+        self.etag = etag
+        self.rows = get_rows(df_catalog, ["id"] + attributes)
+        self.positions = {
+            lookup: get_positions(df_catalog, key_columns, id_positions)
+            for lookup, key_columns in lookups.items()
+        }
+        # resources that are counted from their static url
+        self.static = set()
+        if "url" in df_catalog.columns:
+            is_static = df_catalog["url"].str.contains("static.data.gouv.fr", regex=False, na=False)
+            self.static = set(id_positions[is_static].tolist())
+
+
+def get_catalog_index(name):
+    """
+    Loads the index of a catalog, from CATALOG_CACHE_FOLDER if the catalog's ETag
+    didn't change since it was built
+    """
+    etag = read_etag(name)
+    index_file = f"{CATALOG_CACHE_FOLDER}catalog_{name}.index.pickle"
+    if etag and os.path.isfile(index_file):
+        with open(index_file, "rb") as f:
+            index = pickle.load(f)
+        if index.etag == etag:
+            print(f"catalog {name}: index loaded from cache")
+            return index
+
+    catalog = CATALOGS[name]
+    columns = ["id"] + [
+        column
+        for column in sum(catalog["lookups"].values(), []) + catalog["attributes"]
+        if column != "id"
+    ]
+    df_catalog = pd.read_csv(
+        f"{TMP_FOLDER}catalog_{name}.csv",
+        dtype=str,
+        sep=";",
+        usecols=list(dict.fromkeys(columns)),
+    )
+    index = CatalogIndex(df_catalog, catalog["lookups"], catalog["attributes"], etag)
+    print(f"catalog {name}: index built on {len(index.rows)} objects")
+    if etag:
+        with open(f"{index_file}.tmp", "wb") as f:
+            pickle.dump(index, f)
+        os.replace(f"{index_file}.tmp", index_file)
+    return index
+
+
+def count_visits(hits, positions, rows=None, excluded=()):
+    """
+    Sums the hits of slugs by position in the catalog, the slugs that are not in the catalog
+    are dropped, unless rows is given: they are then interned at its end without attributes.
+    """
+    visits = Counter()
+    for slug, nb in hits.items():
+        position = positions.get(slug)
+        if position is None:
+            if rows is None:
+                continue
+            position = len(rows)
+            rows.append((slug,) + (None,) * (len(rows[0]) - 1 if rows else 0))
+            positions[slug] = position
+        if position not in excluded:
+            visits[position] += nb
+    return visits
+
+
+def write_visits(file_path, date, visits, rows):
+    """Writes the visits as (date, id, attributes..., nb_visit) rows, most visited first"""
+    with open(file_path, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        for position, nb in visits.most_common():
+            writer.writerow((date,) + rows[position] + (nb,))
 
 
 def get_id(arr, list_obj):
@@ -230,24 +439,6 @@ def append_chunk(cpt, obj_type, arr, list_obj, log):
             fp.write(f"{d['id']},{d['date']}\n")
 
 
-def parse(lines, date):
-    list_obj = []
-    for b_line in lines:
-        try:
-            slug_line = None
-            parsed_line = b_line.decode("utf-8").split()
-            slug_line, type_detect = get_info(parsed_line)
-            if slug_line:
-                list_obj.append({"type": type_detect, "id": slug_line, "date": date})
-                if len(list_obj) == 10000:
-                    save_list_obj(list_obj)
-                    list_obj = []
-        except:
-            raise Exception(f"Sorry, pb with line: {b_line}")
-
-    save_list_obj(list_obj)
-
-
 def get_unique_dates(first_list, second_list):
     in_first = set(first_list)
     in_second = set(second_list)
@@ -276,201 +467,69 @@ def process_log(ti):
     remove_files_if_exists("outputs")
     # analyser toutes les dates différentes
     alldates = set(d.split("/")[-1].split("-")[2] for d in newlogs)
+    # the catalogs are indexed once for all the dates
+    indexes = {name: get_catalog_index(name) for name in CATALOGS}
     for log_date in alldates:
-        remove_files_if_exists("found")
         print("---------------")
         print(log_date)
-        lines = []
-        for file_name in glob.glob(f"{TMP_FOLDER}/*{log_date}*.tar.gz"):
-            with tarfile.open(file_name, "r:gz") as tar:
-                for log_file in tar:
-                    log_data = tar.extractfile(log_file)
-                    lines += log_data.readlines()
-
-        print("haproxy loaded")
         print("parse lines")
         isoformat_log_date = datetime.strptime(log_date, '%d%m%Y').date().isoformat()
-        parse(lines, isoformat_log_date)
-
-        try:
-            print("---- datasets -----")
-            df_catalog = pd.read_csv(
-                f"{TMP_FOLDER}catalog_datasets.csv",
-                dtype=str,
-                sep=";",
-                usecols=["id", "slug", "organization_id"]
-            )
-            catalog_dict = get_dict(df_catalog, "slug")
-            df = pd.read_csv(
-                f"{TMP_FOLDER}found/found_datasets.csv",
-                sep=";",
-                dtype=str,
-                header=None
-            )
-            df["id"] = df[1].apply(
-                lambda x: catalog_dict[x] if x in catalog_dict else None
+        hits = parse(glob.glob(f"{TMP_FOLDER}/*{log_date}*.tar.gz"))
+
+        for obj_type in ["datasets", "organizations", "reuses"]:
+            if not hits[obj_type]:
+                print(f"empty data {obj_type}")
+                continue
+            print(f"---- {obj_type} -----")
+            index = indexes[obj_type]
+            visits = count_visits(hits[obj_type], index.positions["slug"])
+            write_visits(
+                f"{TMP_FOLDER}outputs/{obj_type}-{log_date}.csv",
+                isoformat_log_date,
+                visits,
+                index.rows,
             )
-            df = df.rename(columns={0: "date_metric"})
-            df = df.drop(columns=[1])
-            df["nb_visit"] = 1
-            df = df.groupby(
-                ["date_metric", "id"],
-                as_index=False
-            ).count().sort_values(
-                by=["nb_visit"],
-                ascending=False
-            )
-            df = pd.merge(df, df_catalog[["id", "organization_id"]], on="id", how="left")
-            df = df.rename(columns={"id": "dataset_id"})
-            df[["date_metric", "dataset_id", "organization_id", "nb_visit"]].to_csv(
-                f"{TMP_FOLDER}outputs/datasets-{log_date}.csv", index=False, header=False
-            )
-            all_dates_processed = get_unique_dates(all_dates_processed, list(df["date_metric"].unique()))
-        except pd.errors.EmptyDataError:
-            print("empty data datasets")
+            if visits:
+                all_dates_processed = get_unique_dates(all_dates_processed, [isoformat_log_date])
 
-        try:
-            print("---- organizations -----")
-            df_catalog = pd.read_csv(
-                f"{TMP_FOLDER}catalog_organizations.csv",
-                dtype=str,
-                sep=";",
-                usecols=["id", "slug"]
-            )
-            catalog_dict = get_dict(df_catalog, "slug")
-            df = pd.read_csv(
-                f"{TMP_FOLDER}found/found_organizations.csv",
-                sep=";",
-                dtype=str,
-                header=None
-            )
-            df["id"] = df[1].apply(
-                lambda x: catalog_dict[x] if x in catalog_dict else None
-            )
-            df = df.rename(columns={0: "date_metric"})
-            df = df.drop(columns=[1])
-            df["nb_visit"] = 1
-            df = df.groupby(
-                ["date_metric", "id"],
-                as_index=False
-            ).count().sort_values(
-                by=["nb_visit"],
-                ascending=False
-            )
-            df = pd.merge(df, df_catalog[["id"]], on="id", how="left")
-            df = df.rename(columns={"id": "organization_id"})
-            df[["date_metric", "organization_id", "nb_visit"]].to_csv(
-                f"{TMP_FOLDER}outputs/organizations-{log_date}.csv", index=False, header=False
-            )
-            all_dates_processed = get_unique_dates(all_dates_processed, list(df["date_metric"].unique()))
-        except pd.errors.EmptyDataError:
-            print("empty data organizations")
-
-        try:
-            print("---- reuses -----")
-            df_catalog = pd.read_csv(
-                f"{TMP_FOLDER}catalog_reuses.csv",
-                dtype=str,
-                sep=";",
-                usecols=["id", "slug", "organization_id"]
-            )
-            catalog_dict = get_dict(df_catalog, "slug")
-            df = pd.read_csv(
-                f"{TMP_FOLDER}found/found_reuses.csv",
-                sep=";",
-                dtype=str,
-                header=None
-            )
-            df["id"] = df[1].apply(
-                lambda x: catalog_dict[x] if x in catalog_dict else None
-            )
-            df = df.rename(columns={0: "date_metric"})
-            df = df.drop(columns=[1])
-            df["nb_visit"] = 1
-            df = df.groupby(
-                ["date_metric", "id"],
-                as_index=False
-            ).count().sort_values(
-                by=["nb_visit"],
-                ascending=False
-            )
-            df = pd.merge(df, df_catalog[["id", "organization_id"]], on="id", how="left")
-            df = df.rename(columns={"id": "reuse_id"})
-            df[["date_metric", "reuse_id", "organization_id", "nb_visit"]].to_csv(
-                f"{TMP_FOLDER}outputs/reuses-{log_date}.csv", index=False, header=False
-            )
-            all_dates_processed = get_unique_dates(all_dates_processed, list(df["date_metric"].unique()))
-        except pd.errors.EmptyDataError:
-            print("empty data reuses")
-
-        try:
+        if not hits["resources-id"] and not hits["resources-static"]:
+            print("empty data resources id and static")
+        else:
             print("--- resources ----")
-            df_catalog = pd.read_csv(
-                f"{TMP_FOLDER}catalog_resources.csv",
-                dtype=str,
-                sep=";",
-                usecols=["id", "url", "dataset.id", "dataset.organization_id"]
+            index = indexes["resources"]
+            # static resources are counted from their url, not from their id,
+            # unknown resource ids are kept, without dataset nor organization
+            visits = count_visits(
+                hits["resources-id"],
+                index.positions["id"],
+                rows=index.rows,
+                excluded=index.static,
+            )
+            visits.update(count_visits(hits["resources-static"], index.positions["url"]))
+            write_visits(
+                f"{TMP_FOLDER}outputs/resources-{log_date}.csv",
+                isoformat_log_date,
+                visits,
+                index.rows,
             )
-            res1 = pd.read_csv(f"{TMP_FOLDER}found/found_resources-id.csv", dtype=str, header=None, sep=";")
-            # remove resource when static
-            res1 = res1.rename(columns={0: "date_metric", 1: "id"})
-            res1 = pd.merge(res1, df_catalog[["id", "url"]], on="id", how="left")
-            res1["is_static"] = res1["url"].apply(
-                lambda x: True if "static.data.gouv.fr" in str(x) else False)
-            print("shape", res1.shape[0])
-            res1 = res1[res1["is_static"] == False]
-            res1 = res1[["date_metric", "id"]]
-            print("shape", res1.shape[0])
-
-            res2 = pd.read_csv(f"{TMP_FOLDER}found/found_resources-static.csv",
-                               dtype=str, header=None, sep=";")
-            res2 = res2.rename(columns={0: "date_metric", 1: "url"})
-            res2 = pd.merge(res2, df_catalog[["id", "url"]], on="url", how="left")
-            res2 = res2[res2["id"].notna()][["date_metric", "id"]]
-
-            resources = pd.concat([res1, res2])
-            resources["nb_visit"] = 1
-            resources = resources.groupby(["date_metric", "id"], as_index=False).count().sort_values(
-                by=["nb_visit"], ascending=False)
-            resources = pd.merge(resources, df_catalog[["id", "dataset.id", "dataset.organization_id"]],
-                                 on="id", how="left")
-            resources = resources.rename(columns={"id": "resource_id", "dataset.id": "dataset_id",
-                                                  "dataset.organization_id": "organization_id"})
-            resources = resources[["date_metric", "resource_id", "dataset_id", "organization_id",
-                                   "nb_visit"]]
-            resources.to_csv(f"{TMP_FOLDER}outputs/resources-{log_date}.csv", index=False, header=False)
-            all_dates_processed = get_unique_dates(all_dates_processed, list(df["date_metric"].unique()))
-        except FileNotFoundError:
-            print("no data resources file")
-        except pd.errors.EmptyDataError:
-            print("empty data resources id or static")
+            if visits:
+                all_dates_processed = get_unique_dates(all_dates_processed, [isoformat_log_date])
 
     ti.xcom_push(key="all_dates_processed", value=all_dates_processed)
 
 
-def get_matomo_outlinks(model, slug, target, metric_date):
-    matomo_url = 'https://stats.data.gouv.fr/index.php'
-    params = {
-        "module": "API",
+def get_outlinks_params(model, slug, metric_date):
+    return {
         "method": "Actions.getOutlinks",
         "actionType": "url",
         "segment": f"actionUrl==https://www.data.gouv.fr/fr/{model}/{slug}/",
-        "format": "JSON",
-        "token_auth": "anonymous",
-        "idSite": DATAGOUV_MATOMO_ID,
         "period": "day",
-        "date": metric_date.isoformat()
+        "date": metric_date.isoformat(),
     }
-    tries = 5
-    while tries > 0:
-        matomo_res = requests.get(matomo_url, params=params)
-        # The Matomo API is sometimes unstable and required a few retries
-        if matomo_res.status_code in ["502"]:
-            time.sleep(0.5)
-            tries-=1
-        break
-    matomo_res.raise_for_status()
-    return sum(outlink['nb_hits'] for outlink in matomo_res.json() if outlink["label"] in target)
+
+
+def count_outlinks(outlinks, target):
+    return sum(outlink['nb_hits'] for outlink in outlinks if outlink["label"] in target)
 
 
 def sum_outlinks_by_orga(df_orga, df_outlinks, model):
@@ -481,7 +540,7 @@ def sum_outlinks_by_orga(df_orga, df_outlinks, model):
     return df_orga
 
 
-def process_matomo():
+def process_matomo(ti):
     '''
     Fetch matomo metrics for external links for datasets, reuses and sum these by orga
     '''
@@ -498,6 +557,12 @@ def process_matomo():
 
     # Which timespan to target?
     yesterday = date.today() - timedelta(days=1)
+    # yesterday's results don't change anymore, they are cached in case of a rerun
+    os.makedirs(MATOMO_CACHE_FOLDER, exist_ok=True)
+    for cache_file in glob.glob(f"{MATOMO_CACHE_FOLDER}*.jsonl"):
+        if not cache_file.endswith(f"{yesterday.isoformat()}.jsonl"):
+            os.remove(cache_file)
+    matomo = MatomoClient(cache_file=f"{MATOMO_CACHE_FOLDER}outlinks-{yesterday.isoformat()}.jsonl")
     for model in ['reuses']:  # datasets?
         print(f"get matamo outlinks for {model}")
         df_catalog = pd.read_csv(
@@ -506,8 +571,18 @@ def process_matomo():
             sep=";",
             usecols=["id", "slug", "remote_url", "organization_id"]
         )
-        df_catalog['outlinks'] = df_catalog.progress_apply(
-            lambda x: get_matomo_outlinks(model, x.slug, x.remote_url, yesterday), axis=1)
+        # objects without remote url can't have outlinks to it
+        has_remote_url = df_catalog["remote_url"].notna()
+        print(f"{has_remote_url.sum()} {model} with a remote url out of {len(df_catalog)}")
+        outlinks = matomo.bulk_request([
+            get_outlinks_params(model, slug, yesterday)
+            for slug in df_catalog.loc[has_remote_url, "slug"]
+        ])
+        df_catalog['outlinks'] = 0
+        df_catalog.loc[has_remote_url, 'outlinks'] = [
+            count_outlinks(result, target)
+            for result, target in zip(outlinks, df_catalog.loc[has_remote_url, "remote_url"])
+        ]
         df_catalog['date_metric'] = yesterday.isoformat()
         df_catalog.to_csv(f'{TMP_FOLDER}matomo-outputs/{model}-outlinks.csv',
                           columns=['date_metric', 'id', 'organization_id', 'outlinks'], index=False,
@@ -522,6 +597,37 @@ def process_matomo():
         index=False,
         header=False,
     )
+    ti.xcom_push(key="matomo_date", value=yesterday.isoformat())
+
+
+def add_pending_dates(dates):
+    """Marks dates as saved in the visits/matomo tables, but not rolled up yet"""
+    dates = [d for d in dates if d]
+    if not dates:
+        return
+    execute_query(
+        conn.host,
+        conn.port,
+        conn.schema,
+        conn.login,
+        conn.password,
+        "INSERT INTO metric.pending_rollup_dates (date_metric) VALUES "
+        + ", ".join(f"('{d}')" for d in dates)
+        + " ON CONFLICT DO NOTHING;",
+    )
+
+
+def get_pending_dates():
+    # aggregated so that the query returns a row even if there is no pending date
+    return execute_query(
+        conn.host,
+        conn.port,
+        conn.schema,
+        conn.login,
+        conn.password,
+        "SELECT ARRAY_AGG(date_metric::TEXT ORDER BY date_metric) AS dates "
+        "FROM metric.pending_rollup_dates;",
+    )[0]["dates"] or []
 
 
 def save_metrics_to_postgres(ti):
@@ -544,27 +650,28 @@ def save_metrics_to_postgres(ti):
         },
     ]
     for obj in config:
-        for lf in glob.glob(f"{TMP_FOLDER}outputs/{obj['name']}-*"):
-            if "-id-" not in lf and "-static-" not in lf:
-                copy_file(
-                    PG_HOST=conn.host,
-                    PG_PORT=conn.port,
-                    PG_DB=conn.schema,
-                    PG_TABLE=f"{DB_METRICS_SCHEMA}.visits_{obj['name']}",
-                    PG_USER=conn.login,
-                    PG_PASSWORD=conn.password,
-                    list_files=[
-                        {
-                            "source_path": "/".join(lf.split("/")[:-1]) + "/",
-                            "source_name": lf.split("/")[-1],
-                            "column_order": obj["columns"],
-                        }
-                    ],
-                    has_header=False
-                )
+        copy_files_parallel(
+            PG_HOST=conn.host,
+            PG_PORT=conn.port,
+            PG_DB=conn.schema,
+            PG_TABLE=f"{DB_METRICS_SCHEMA}.visits_{obj['name']}",
+            PG_USER=conn.login,
+            PG_PASSWORD=conn.password,
+            list_files=[
+                {
+                    "source_path": "/".join(lf.split("/")[:-1]) + "/",
+                    "source_name": lf.split("/")[-1],
+                    "column_order": obj["columns"],
+                }
+                for lf in glob.glob(f"{TMP_FOLDER}outputs/{obj['name']}-*")
+                if "-id-" not in lf and "-static-" not in lf
+            ],
+            has_header=False,
+        )
+    add_pending_dates(ti.xcom_pull(key="all_dates_processed", task_ids="process_log") or [])
 
 
-def save_matomo_to_postgres():
+def save_matomo_to_postgres(ti):
     config = [
         {
             "name": "reuses",
@@ -593,19 +700,76 @@ def save_matomo_to_postgres():
                 ],
                 has_header=False
             )
+    add_pending_dates([ti.xcom_pull(key="matomo_date", task_ids="process_matomo")])
 
 
-def refresh_materialized_views():
-    execute_sql_file(
+def get_months_range(dates):
+    """First day of the month of the first date, and first day of the month after the last date"""
+    days = [date.fromisoformat(d) for d in dates]
+    start = min(days).replace(day=1)
+    end = (max(days).replace(day=1) + timedelta(days=32)).replace(day=1)
+    return start.isoformat(), end.isoformat()
+
+
+def is_populated(table):
+    return execute_query(
         conn.host,
         conn.port,
         conn.schema,
         conn.login,
         conn.password,
-        [
-            {
-                "source_path": f"{AIRFLOW_DAG_HOME}{DAG_FOLDER}sql/",
-                "source_name": "refresh_materialized_views.sql",
-            }
-        ],
-    )
+        f"SELECT EXISTS (SELECT 1 FROM metric.{table}) AS populated;",
+    )[0]["populated"]
+
+
+def refresh_materialized_views(ti):
+    """
+    Updates the daily and monthly rollups for the pending dates only, i.e. the dates
+    saved by this run or by previous runs whose refresh didn't happen (skipped or failed),
+    then refreshes the materialized views that depend on the whole history.
+    An empty rollup (just created) is filled with the whole history.
+    """
+    dates = get_pending_dates()
+    print("dates to refresh:", dates)
+    env = Environment(loader=FileSystemLoader(f"{AIRFLOW_DAG_HOME}{DAG_FOLDER}sql/rollups/"))
+    timings = {}
+    for rollup in DAILY_ROLLUPS + MONTHLY_ROLLUPS:
+        if not is_populated(rollup):
+            params, scope = {}, "whole history"
+        elif not dates:
+            continue
+        elif rollup in DAILY_ROLLUPS:
+            params, scope = {"dates": ", ".join(f"'{d}'" for d in dates)}, ", ".join(dates)
+        else:
+            start, end = get_months_range(dates)
+            params, scope = {"start": start, "end": end}, f"from {start} to {end}"
+        sql = env.get_template(f"{rollup}.sql.jinja").render(**params)
+        start_time = time.time()
+        execute_query(conn.host, conn.port, conn.schema, conn.login, conn.password, sql)
+        timings[rollup] = round(time.time() - start_time, 2)
+        print(f"{rollup} ({scope}): {timings[rollup]}s")
+
+    for view in MATERIALIZED_VIEWS:
+        start_time = time.time()
+        execute_query(
+            conn.host,
+            conn.port,
+            conn.schema,
+            conn.login,
+            conn.password,
+            f"REFRESH MATERIALIZED VIEW CONCURRENTLY metric.{view};",
+        )
+        timings[view] = round(time.time() - start_time, 2)
+        print(f"{view} (concurrently): {timings[view]}s")
+    if dates:
+        # only the dates read above, some could have been added in the meantime
+        execute_query(
+            conn.host,
+            conn.port,
+            conn.schema,
+            conn.login,
+            conn.password,
+            "DELETE FROM metric.pending_rollup_dates WHERE date_metric IN ("
+            + ", ".join(f"'{d}'" for d in dates) + ");",
+        )
+    ti.xcom_push(key="refresh_timings", value=timings)
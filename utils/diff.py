@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import Iterator, Optional, Tuple
+
+from datagouvfr_data_pipelines.utils.utils import get_memory_mb
+
+# memory available to diff a pair of partitions, both loaded as sets of lines
+DIFF_MEMORY_BUDGET = 256 * 1024 ** 2
+# memory used by a set of str compared to the size of the text it holds
+# (measured from x1.4 for 250-char lines to x2.5 for 60-char lines, plus some margin)
+SET_MEMORY_FACTOR = 3
+
+
+def _partition_file(
+    file_path: str,
+    nb_partitions: int,
+    prefix: str,
+    tmp_dir: str,
+    skip_header: bool,
+):
+    """Spread the lines of a file across partition files, according to their hash"""
+    partitions = [
+        open(os.path.join(tmp_dir, f"{prefix}_{k}"), "w")
+        for k in range(nb_partitions)
+    ]
+    try:
+        with open(file_path, "r") as f:
+            if skip_header:
+                f.readline()
+            for line in f:
+                # removing carriage return so that if the last row doesn't have one
+                # it'll not be considered new when data is appended
+                line = line.rstrip("\n")
+                if line:
+                    partitions[hash(line) % nb_partitions].write(line + "\n")
+    finally:
+        for p in partitions:
+            p.close()
+
+
+def _read_partition(file_path: str):
+    with open(file_path, "r") as f:
+        return set(line.rstrip("\n") for line in f)
+
+
+def diff_lines(
+    new_file: str,
+    old_file: str,
+    nb_partitions: Optional[int] = None,
+    tmp_dir: Optional[str] = None,
+    skip_header: bool = True,
+) -> Iterator[Tuple[str, str]]:
+    """Stream the lines added to and deleted from a file, with bounded memory
+
+    Both files are read once and their lines are hash-partitioned into spill
+    files, so that identical lines always land in the same partition. Each pair
+    of partitions is then diffed in memory, one at a time. Like a set
+    difference, the order and the duplicates of lines are not preserved.
+
+    Args:
+        new_file (str): path of the new version of the file
+        old_file (str): path of the old version of the file
+        nb_partitions (int): number of partitions, by default computed so that
+        each pair of partitions fits in DIFF_MEMORY_BUDGET once loaded
+        tmp_dir (str): where to write the spill files, next to new_file by default
+        skip_header (bool): whether the first line of both files is a header
+
+    Yields:
+        Tuple[str, str]: ("+", line) for additions and ("-", line) for deletions,
+        lines are yielded without their carriage return
+    """
+    if nb_partitions is None:
+        total_size = os.path.getsize(new_file) + os.path.getsize(old_file)
+        nb_partitions = max(1, -(-int(total_size * SET_MEMORY_FACTOR) // DIFF_MEMORY_BUDGET))
+    start = time.time()
+    # the peak of the process may predate the diff, the diff's own peak is measured
+    # as the resident memory when a pair of partitions is loaded, minus the initial one
+    initial_memory = get_memory_mb()
+    peak_memory = initial_memory
+    spill_dir = tempfile.mkdtemp(dir=tmp_dir or os.path.dirname(os.path.abspath(new_file)))
+    nb_additions, nb_deletions = 0, 0
+    try:
+        _partition_file(new_file, nb_partitions, "new", spill_dir, skip_header)
+        _partition_file(old_file, nb_partitions, "old", spill_dir, skip_header)
+        print(f"> Partitioned in {nb_partitions} parts in {round(time.time() - start, 2)}s")
+        for k in range(nb_partitions):
+            new_lines = _read_partition(os.path.join(spill_dir, f"new_{k}"))
+            old_lines = _read_partition(os.path.join(spill_dir, f"old_{k}"))
+            peak_memory = max(peak_memory, get_memory_mb())
+            for line in new_lines - old_lines:
+                nb_additions += 1
+                yield "+", line
+            for line in old_lines - new_lines:
+                nb_deletions += 1
+                yield "-", line
+            del new_lines, old_lines
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    print(
+        f"> Diff done in {round(time.time() - start, 2)}s: {nb_additions} additions, "
+        f"{nb_deletions} deletions (peak memory of the diff {peak_memory - initial_memory} MB)"
+    )
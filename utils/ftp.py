@@ -0,0 +1,379 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from datetime import datetime
+import ftplib
+import mimetypes
+import threading
+import time
+from typing import List, Optional, Tuple, TypedDict
+
+from dateutil import parser
+import pytz
+
+from datagouvfr_data_pipelines.utils.minio import MinIOClient
+
+# size of the parts of multipart uploads, S3 requires at least 5MB (except for the last one)
+PART_SIZE = 32 * 1024 ** 2
+READ_SIZE = 1024 ** 2
+MAX_RESUMES = 5
+
+
+class TransferFile(TypedDict):
+    source_path: str
+    source_name: str
+    dest_path: str
+    dest_name: str
+
+
+class RateLimiter:
+    """Token bucket shared by all transfers, to cap the total bandwidth used"""
+
+    def __init__(self, max_bytes_per_second: Optional[int] = None):
+        self.rate = max_bytes_per_second
+        self.allowance = max_bytes_per_second or 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nb_bytes: int):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nb_bytes
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class FTPSessionPool:
+    """Bounded pool of logged-in FTP sessions, shared between threads"""
+
+    def __init__(self, host: str, user: str, password: str, max_sessions: int = 3):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.max_sessions = max_sessions
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._features = None
+
+    @property
+    def features(self):
+        """Commands supported by the server (from FEAT), e.g. MLST"""
+        if self._features is None:
+            with self.session() as ftp:
+                try:
+                    self._features = {
+                        line.strip().split(" ")[0].upper()
+                        for line in ftp.sendcmd("FEAT").splitlines()[1:-1]
+                    }
+                except ftplib.error_perm:
+                    self._features = set()
+        return self._features
+
+    def _connect(self):
+        ftp = ftplib.FTP(self.host)
+        ftp.login(self.user, self.password)
+        return ftp
+
+    @contextmanager
+    def session(self):
+        """Borrow a session, at most `max_sessions` are opened at the same time"""
+        with self._slots:
+            with self._lock:
+                ftp = self._idle.pop() if self._idle else None
+            if ftp is not None:
+                try:
+                    ftp.voidcmd("NOOP")
+                except ftplib.all_errors:
+                    # the server has closed the idle session
+                    ftp = None
+            if ftp is None:
+                ftp = self._connect()
+            broken = False
+            try:
+                yield ftp
+            except ftplib.all_errors:
+                broken = True
+                raise
+            finally:
+                if broken:
+                    ftp.close()
+                else:
+                    with self._lock:
+                        self._idle.append(ftp)
+
+    def close(self):
+        with self._lock:
+            for ftp in self._idle:
+                try:
+                    ftp.quit()
+                except ftplib.all_errors:
+                    ftp.close()
+            self._idle = []
+
+
+def _read_part(stream, part_size: int, rate_limiter: Optional[RateLimiter]):
+    chunks = []
+    remaining = part_size
+    while remaining > 0:
+        data = stream.read(min(remaining, READ_SIZE))
+        if not data:
+            break
+        if rate_limiter:
+            rate_limiter.consume(len(data))
+        chunks.append(data)
+        remaining -= len(data)
+    return b"".join(chunks)
+
+
+def _get_content_type(file_name: str):
+    if file_name.endswith(".gz"):
+        return "application/gzip"
+    return mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+
+
+def transfer_ftp_file_to_minio(
+    ftp_pool: FTPSessionPool,
+    s3,
+    bucket: str,
+    file: TransferFile,
+    rate_limiter: Optional[RateLimiter] = None,
+    part_size: int = PART_SIZE,
+):
+    """Stream a file from an FTP server into a MinIO multipart upload, without staging it on disk
+
+    Parts are only uploaded once fully read. If the FTP transfer is interrupted,
+    it is resumed (REST) from the end of the last uploaded part, on a new session.
+
+    Args:
+        ftp_pool (FTPSessionPool): pool of FTP sessions
+        s3: boto3 S3 client (see MinIOClient.get_s3_client)
+        bucket (str): destination bucket
+        file (TransferFile): `source_path` and `source_name`: location on the FTP ;
+        `dest_path` and `dest_name` : location in the bucket
+        rate_limiter (RateLimiter): shared bandwidth budget
+        part_size (int): size of the uploaded parts
+
+    Returns:
+        dict: transfer metrics (bytes, seconds, MB/s, resumes)
+    """
+    key = f"{file['dest_path']}{file['dest_name']}"
+    source = f"{file['source_path'].rstrip('/')}/{file['source_name']}"
+    upload_id = s3.create_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        ContentType=_get_content_type(file["dest_name"]),
+    )["UploadId"]
+    parts = []
+    offset = 0
+    resumes = 0
+    start = time.time()
+
+    def upload_part(body):
+        response = s3.upload_part(
+            Bucket=bucket,
+            Key=key,
+            PartNumber=len(parts) + 1,
+            UploadId=upload_id,
+            Body=body,
+        )
+        parts.append({"PartNumber": len(parts) + 1, "ETag": response["ETag"]})
+
+    try:
+        while True:
+            try:
+                with ftp_pool.session() as ftp:
+                    ftp.voidcmd("TYPE I")
+                    conn = ftp.transfercmd(f"RETR {source}", rest=offset or None)
+                    last_part = None
+                    try:
+                        with conn.makefile("rb") as stream:
+                            while True:
+                                part = _read_part(stream, part_size, rate_limiter)
+                                if len(part) < part_size:
+                                    # either the end of the file or an interrupted transfer,
+                                    # we only know for sure once the server has answered
+                                    last_part = part
+                                    break
+                                upload_part(part)
+                                offset += len(part)
+                    finally:
+                        conn.close()
+                    ftp.voidresp()
+                if last_part or not parts:
+                    # S3 requires at least one part, even for empty files
+                    upload_part(last_part or b"")
+                    offset += len(last_part or b"")
+                break
+            except ftplib.all_errors as e:
+                resumes += 1
+                if resumes > MAX_RESUMES:
+                    raise
+                print(f"> Transfer of {source} interrupted at {offset} bytes ({e}), resuming")
+        s3.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    duration = max(time.time() - start, 1e-6)
+    return {
+        "file": source,
+        "bytes": offset,
+        "seconds": round(duration, 2),
+        "mb_per_s": round(offset / 1024 ** 2 / duration, 2),
+        "resumes": resumes,
+    }
+
+
+def transfer_ftp_files_to_minio(
+    ftp_host: str,
+    ftp_user: str,
+    ftp_password: str,
+    minio_client: MinIOClient,
+    list_files: List[TransferFile],
+    max_sessions: int = 3,
+    max_bytes_per_second: Optional[int] = None,
+):
+    """Transfer files from an FTP server to MinIO concurrently, within a budget
+
+    Args:
+        ftp_host (str): FTP server
+        ftp_user (str): FTP user
+        ftp_password (str): FTP password
+        minio_client (MinIOClient): client on the destination bucket
+        list_files (List[TransferFile]): files to transfer, see transfer_ftp_file_to_minio
+        max_sessions (int): maximum number of simultaneous FTP sessions (and transfers)
+        max_bytes_per_second (int): total bandwidth budget, unlimited if None
+
+    Returns:
+        dict: for each source file, the transfer metrics or the error that occurred
+    """
+    if minio_client.bucket is None:
+        raise AttributeError("A bucket has to be specified.")
+    ftp_pool = FTPSessionPool(ftp_host, ftp_user, ftp_password, max_sessions)
+    rate_limiter = RateLimiter(max_bytes_per_second)
+    s3 = minio_client.get_s3_client()
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_sessions) as executor:
+            futures = {
+                executor.submit(
+                    transfer_ftp_file_to_minio,
+                    ftp_pool,
+                    s3,
+                    minio_client.bucket,
+                    file,
+                    rate_limiter,
+                ): f"{file['source_path'].rstrip('/')}/{file['source_name']}"
+                for file in list_files
+            }
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                    print(
+                        f"> {futures[future]}: {results[futures[future]]['bytes']} bytes "
+                        f"in {results[futures[future]]['seconds']}s "
+                        f"({results[futures[future]]['mb_per_s']} MB/s)"
+                    )
+                except Exception as e:
+                    print(f"⚠️ Unable to transfer {futures[future]}: {e}")
+                    results[futures[future]] = {"file": futures[future], "error": str(e)}
+    finally:
+        ftp_pool.close()
+    return results
+
+
+# all the modification dates are returned as naive UTC datetimes
+def _parse_list_date(date_string: str, server_tz: str) -> datetime:
+    # LIST dates are in the local time of the server and don't have a year for recent files,
+    # this returns the last occurrence of the date, not a future one
+    tz = pytz.timezone(server_tz)
+    tmp = parser.parse(date_string)
+    if tmp > datetime.now(tz).replace(tzinfo=None):
+        tmp = tmp.replace(year=tmp.year - 1)
+    return tz.localize(tmp).astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def _parse_mlsd_date(modify: str) -> datetime:
+    # MLSD dates are always in UTC (RFC 3659)
+    return datetime.strptime(modify[:14], "%Y%m%d%H%M%S")
+
+
+def _list_dir(ftp, abs_path: str, use_mlsd: bool, server_tz: str) -> Tuple[list, list]:
+    """List the files (name, size, modification date) and subdirectories of a single directory"""
+    files, subdirs = [], []
+    if use_mlsd:
+        for name, facts in ftp.mlsd(abs_path, facts=["type", "size", "modify"]):
+            if facts.get("type") == "dir":
+                subdirs.append(name)
+            elif facts.get("type") == "file":
+                files.append((name, int(facts.get("size", 0)), _parse_mlsd_date(facts["modify"])))
+    else:
+        lines = []
+        ftp.retrlines(f"LIST {abs_path}", lines.append)
+        for line in lines:
+            parts = line.split(maxsplit=8)
+            if len(parts) < 9:
+                continue
+            if line.startswith("d"):
+                subdirs.append(parts[8])
+            else:
+                date_string = " ".join(parts[5:8])
+                files.append((parts[8], int(parts[4]), _parse_list_date(date_string, server_tz)))
+    return files, subdirs
+
+
+def list_ftp_files(
+    ftp_pool: FTPSessionPool,
+    root: str = "",
+    server_tz: str = "UTC",
+) -> list:
+    """List all the files of an FTP tree, crawling directories concurrently
+
+    Directories are listed with MLSD when the server supports it (LIST otherwise),
+    over the sessions of the pool.
+
+    Args:
+        ftp_pool (FTPSessionPool): pool of FTP sessions, its size sets the concurrency
+        root (str): directory to start from, relative to "/"
+        server_tz (str): timezone of the dates returned by LIST (MLSD dates are UTC)
+
+    Returns:
+        list: the files as (path, name, size, modification date) tuples,
+        the dates being naive UTC datetimes
+    """
+    use_mlsd = "MLST" in ftp_pool.features
+    files = []
+    nb_listed = 0
+
+    def process(path: str):
+        with ftp_pool.session() as ftp:
+            try:
+                return path, _list_dir(ftp, "/" + path, use_mlsd, server_tz)
+            except ftplib.error_perm:
+                return path, None
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=ftp_pool.max_sessions) as executor:
+        pending = {executor.submit(process, root.strip("/"))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, listing = future.result()
+                if listing is None:
+                    continue
+                nb_listed += 1
+                dir_files, subdirs = listing
+                files += [(path, name, size, modif_date) for name, size, modif_date in dir_files]
+                for name in subdirs:
+                    pending.add(executor.submit(process, f"{path}/{name}" if path else name))
+    print(f"> Listed {nb_listed} directories in {round(time.time() - start, 2)}s")
+    return files
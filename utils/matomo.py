@@ -0,0 +1,130 @@
+from typing import List, Optional
+from urllib.parse import urlencode
+import aiohttp
+import asyncio
+import json
+import os
+import time
+
+from datagouvfr_data_pipelines.utils.datagouv import DATAGOUV_MATOMO_ID
+from datagouvfr_data_pipelines.utils.retry import simple_connection_retry
+
+MATOMO_URL = "https://stats.data.gouv.fr/index.php"
+# number of API calls sent in one API.getBulkRequest
+BULK_SIZE = 100
+MAX_CONCURRENT_REQUESTS = 4
+MAX_REQUESTS_PER_SECOND = 4
+
+
+class MatomoClient:
+    """
+    Sends Matomo API calls by batches through API.getBulkRequest, several batches
+    being sent concurrently under a rate limit.
+    Results can be cached in a JSON lines file, so that a rerun doesn't fetch them again:
+    only use it for calls whose results can't change anymore (past days).
+    """
+
+    def __init__(
+        self,
+        url: str = MATOMO_URL,
+        site_id: int = DATAGOUV_MATOMO_ID,
+        token_auth: str = "anonymous",
+        bulk_size: int = BULK_SIZE,
+        max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS,
+        max_requests_per_second: float = MAX_REQUESTS_PER_SECOND,
+        cache_file: Optional[str] = None,
+        timeout: int = 300,
+    ):
+        self.url = url
+        self.site_id = site_id
+        self.token_auth = token_auth
+        self.bulk_size = bulk_size
+        self.max_concurrent_requests = max_concurrent_requests
+        self.min_interval = 1 / max_requests_per_second
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.cache = self.load_cache()
+        self.stats = {"cache_hit": 0, "fetched": 0, "http_requests": 0}
+
+    def load_cache(self) -> dict:
+        cache = {}
+        if self.cache_file and os.path.isfile(self.cache_file):
+            with open(self.cache_file) as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of an interrupted run
+                        continue
+                    cache[item["query"]] = item["result"]
+        return cache
+
+    def save_to_cache(self, queries: List[str], results: list):
+        for query, result in zip(queries, results):
+            self.cache[query] = result
+        if self.cache_file:
+            with open(self.cache_file, "a") as f:
+                for query, result in zip(queries, results):
+                    f.write(json.dumps({"query": query, "result": result}) + "\n")
+
+    def get_query(self, params: dict) -> str:
+        return urlencode({"idSite": self.site_id, **params})
+
+    async def wait_rate_limit(self):
+        async with self.rate_lock:
+            delay = self.next_request - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_request = max(self.next_request, time.monotonic()) + self.min_interval
+
+    @simple_connection_retry
+    async def post_bulk(self, session: aiohttp.ClientSession, queries: List[str]) -> list:
+        await self.wait_rate_limit()
+        data = {
+            "module": "API",
+            "method": "API.getBulkRequest",
+            "format": "JSON",
+            "token_auth": self.token_auth,
+        }
+        for k, query in enumerate(queries):
+            data[f"urls[{k}]"] = query
+        self.stats["http_requests"] += 1
+        async with session.post(self.url, data=data) as response:
+            response.raise_for_status()
+            results = await response.json(content_type=None)
+        if isinstance(results, dict) and results.get("result") == "error":
+            raise Exception(f"Matomo error: '{results.get('message')}'")
+        if len(results) != len(queries):
+            raise Exception(f"Matomo returned {len(results)} results for {len(queries)} calls")
+        return results
+
+    async def fetch_batch(self, session: aiohttp.ClientSession, queries: List[str]):
+        async with self.semaphore:
+            results = await self.post_bulk(session, queries)
+        for query, result in zip(queries, results):
+            if isinstance(result, dict) and result.get("result") == "error":
+                raise Exception(f"Matomo error for '{query}': '{result.get('message')}'")
+        self.stats["fetched"] += len(queries)
+        self.save_to_cache(queries, results)
+
+    async def async_bulk_request(self, queries: List[str]):
+        self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        self.rate_lock = asyncio.Lock()
+        self.next_request = time.monotonic()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(*[
+                self.fetch_batch(session, queries[k:k + self.bulk_size])
+                for k in range(0, len(queries), self.bulk_size)
+            ])
+
+    def bulk_request(self, list_params: List[dict]) -> list:
+        """Results of the API calls described by list_params (method, period, date...), in order"""
+        queries = [self.get_query(params) for params in list_params]
+        # each call is only sent once, even if it is asked several times
+        to_fetch = list(dict.fromkeys(q for q in queries if q not in self.cache))
+        self.stats["cache_hit"] += len(queries) - len(to_fetch)
+        if to_fetch:
+            asyncio.run(self.async_bulk_request(to_fetch))
+        print(self.stats)
+        return [self.cache[query] for query in queries]
@@ -50,6 +50,16 @@ class MinIOClient:
             if not self.bucket_exists:
                 raise ValueError(f"Bucket '{self.bucket}' does not exist.")
 
+    def get_s3_client(self):
+        """Return a boto3 client on the same instance, for lower-level S3 operations
+        (e.g. multipart uploads)"""
+        return boto3.client(
+            "s3",
+            endpoint_url=f"https://{self.url}",
+            aws_access_key_id=self.user,
+            aws_secret_access_key=self.password,
+        )
+
     @simple_connection_retry
     def send_files(
         self,
@@ -157,12 +167,7 @@ class MinIOClient:
         """
         if self.bucket is None:
             raise AttributeError("A bucket has to be specified.")
-        s3 = boto3.client(
-            "s3",
-            endpoint_url=f"https://{self.url}",
-            aws_access_key_id=self.user,
-            aws_secret_access_key=self.password,
-        )
+        s3 = self.get_s3_client()
 
         try:
             print(f"{AIRFLOW_ENV}/{file_path_1}{file_name_1}")
@@ -1,7 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import csv
+import io
+import threading
+import time
+import uuid
 import psycopg2
-from typing import List, TypedDict, Optional
+from psycopg2.pool import ThreadedConnectionPool
+from typing import Callable, Iterable, List, TypedDict, Optional
 import os
 
+# process-wide pools, keyed by (host, port, db, user, schema)
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = 8
+# size of the byte chunks sent to COPY when streaming
+COPY_CHUNK_SIZE = 1024 * 1024
+# above these, loads are considered large enough to drop and rebuild indexes
+BULK_LOAD_ROWS_THRESHOLD = 1_000_000
+BULK_LOAD_BYTES_THRESHOLD = 200 * 1024 ** 2
+# when loading into a table that already has data, share of the table the load has to
+# represent for rebuilding the indexes (which cover the whole table) to be worth it
+BULK_LOAD_TABLE_SHARE = 0.5
+
 
 class File(TypedDict):
     source_name: str
@@ -45,6 +67,161 @@ def get_conn(
     return conn
 
 
+def get_pool(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    PG_SCHEMA: Optional[str] = None,
+    max_conn: int = POOL_MAX_CONN,
+):
+    """Get (or create) the process-wide connection pool for a postgres instance
+
+    Pools are keyed by (host, port, db, user, schema), so every task of a DAG
+    hitting the same database reuses the same warm connections.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        PG_SCHEMA (str): schema
+        max_conn (int): maximum number of connections kept by the pool
+
+    Returns:
+        ThreadedConnectionPool: pool of connections to postgres instance
+    """
+    if not PG_SCHEMA:
+        PG_SCHEMA = "public"
+    key = (PG_HOST, str(PG_PORT), PG_DB, PG_USER, PG_SCHEMA)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None or pool.closed:
+            pool = ThreadedConnectionPool(
+                POOL_MIN_CONN,
+                max_conn,
+                host=PG_HOST,
+                database=PG_DB,
+                user=PG_USER,
+                password=PG_PASSWORD,
+                port=PG_PORT,
+                options=f"-c search_path={PG_SCHEMA}",
+            )
+            _POOLS[key] = pool
+    return pool
+
+
+def close_pools():
+    """Close all the connections of all the pools opened by this process"""
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            if not pool.closed:
+                pool.closeall()
+        _POOLS.clear()
+
+
+def is_healthy(conn):
+    """Check that a pooled connection is still usable
+
+    Args:
+        conn: connection to postgres instance
+
+    Returns:
+        bool: True if the connection answers a trivial query
+    """
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def pooled_conn(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    PG_SCHEMA: Optional[str] = None,
+):
+    """Borrow a healthy connection from the pool, and give it back afterwards
+
+    The connection is rolled back before being returned to the pool, so that
+    nothing uncommitted leaks from one caller to the next.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        PG_SCHEMA (str): schema
+
+    Yields:
+        conn: Connection to postgres instance
+    """
+    pool = get_pool(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
+    conn = pool.getconn()
+    if not is_healthy(conn):
+        # stale connection (server restart, idle timeout...): drop it and get a new one
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except psycopg2.OperationalError:
+        broken = True
+        raise
+    finally:
+        if not broken and not conn.closed:
+            conn.rollback()
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+@contextmanager
+def transaction(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    PG_SCHEMA: Optional[str] = None,
+):
+    """Run several statements in a single transaction on a pooled connection
+
+    Commits if the block succeeds, rolls back otherwise. Usage:
+
+        with transaction(host, port, db, user, pwd, schema) as conn:
+            with conn.cursor() as cur:
+                cur.execute(...)
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        PG_SCHEMA (str): schema
+
+    Yields:
+        conn: Connection to postgres instance
+    """
+    with pooled_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+
 def return_sql_results(cur):
     """Return data from a sql query
 
@@ -89,12 +266,10 @@ def execute_query(
         dict, bool: result of sql query or True if no result but
         correct execution
     """
-    conn = get_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
-    with conn.cursor() as cur:
-        cur.execute(sql)
-        data = return_sql_results(cur)
-        conn.commit()
-        conn.close()
+    with transaction(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            data = return_sql_results(cur)
     return data
 
 
@@ -126,23 +301,21 @@ def execute_sql_file(
         dict, bool: result of sql query or True if no result but
         correct execution
     """
-    for file in list_files:
-        is_file = os.path.isfile(os.path.join(file["source_path"], file["source_name"]))
-        if is_file:
-            conn = get_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
-            with conn.cursor() as cur:
-                cur.execute(
-                    open(
-                        os.path.join(file["source_path"], file["source_name"]), "r"
-                    ).read()
-                )
-                data = return_sql_results(cur)
+    with pooled_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        for file in list_files:
+            is_file = os.path.isfile(os.path.join(file["source_path"], file["source_name"]))
+            if is_file:
+                with conn.cursor() as cur, open(
+                    os.path.join(file["source_path"], file["source_name"]), "r"
+                ) as f:
+                    cur.execute(f.read())
+                    data = return_sql_results(cur)
+                # each file is committed on its own, as they used to be
                 conn.commit()
-                conn.close()
-        else:
-            raise Exception(
-                f"file {file['source_path']}{file['source_name']} does not exists"
-            )
+            else:
+                raise Exception(
+                    f"file {file['source_path']}{file['source_name']} does not exists"
+                )
     return data
 
 
@@ -156,6 +329,7 @@ def copy_file(
     list_files: List[File],
     PG_SCHEMA: Optional[str] = None,
     has_header: Optional[bool] = True,
+    delimiter: str = ",",
 ):
     """Copy raw data from local files to postgres instance
 
@@ -169,6 +343,8 @@ def copy_file(
         list_files (List[File]): List of files containing raw data.
         Local files are specified in a array of dictionnaries containing for each
         `source_path` and `source_name` : path of local sql file to execute.
+        has_header (bool): whether the files have a header row
+        delimiter (str): csv delimiter of the files
 
     Raises:
         Exception: _description_
@@ -176,34 +352,639 @@ def copy_file(
     Returns:
         _type_: _description_
     """
-    for file_conf in list_files:
-        is_file = os.path.isfile(os.path.join(file_conf["source_path"], file_conf["source_name"]))
-        if is_file:
-            conn = get_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
-            if "column_order" in file_conf and file_conf["column_order"] is not None:
-                COLUMNS = file_conf["column_order"]
-            else:
-                COLUMNS = ""
-            if has_header:
-                HEADER = "HEADER"
+    with pooled_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        for file_conf in list_files:
+            is_file = os.path.isfile(os.path.join(file_conf["source_path"], file_conf["source_name"]))
+            if is_file:
+                if "column_order" in file_conf and file_conf["column_order"] is not None:
+                    COLUMNS = file_conf["column_order"]
+                else:
+                    COLUMNS = ""
+                if has_header:
+                    HEADER = "HEADER"
+                else:
+                    HEADER = ""
+                with conn.cursor() as cur, open(
+                    os.path.join(file_conf["source_path"], file_conf["source_name"]), "r"
+                ) as file:
+                    cur.copy_expert(
+                        sql=(
+                            f"COPY {PG_TABLE} {COLUMNS} FROM STDIN "
+                            f"WITH CSV {HEADER} DELIMITER AS '{delimiter}'"
+                        ),
+                        file=file,
+                    )
+                    data = return_sql_results(cur)
+                conn.commit()
             else:
-                HEADER = ""
-            file = open(
-                os.path.join(file_conf["source_path"], file_conf["source_name"]), "r"
-            )
-            with conn.cursor() as cur:
-                cur.copy_expert(
-                    sql=(
-                        f"COPY {PG_TABLE} {COLUMNS} FROM STDIN "
-                        f"WITH CSV {HEADER} DELIMITER AS ','"
-                    ),
-                    file=file,
+                raise Exception(
+                    f"file {file_conf['source_path']}{file_conf['source_name']} does not exists"
                 )
-                data = return_sql_results(cur)
-                conn.commit()
-                conn.close()
+    return data
+
+
+class _IteratorFile(io.RawIOBase):
+    """Read-only file-like object over an iterator of bytes, as expected by copy_expert"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def _serialize_for_copy(
+    data: Iterable,
+    delimiter: str,
+    quote: str,
+    transform: Optional[Callable],
+    encoding: str,
+):
+    """Turn rows, lines, byte chunks or dataframe chunks into csv byte chunks"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, quotechar=quote, lineterminator="\n")
+    pending = []
+    pending_size = 0
+    for item in data:
+        if transform is not None:
+            item = transform(item)
+            if item is None:
+                # the transform can drop items
+                continue
+        if isinstance(item, bytes):
+            chunk = item
+        elif isinstance(item, str):
+            chunk = (item if item.endswith("\n") else item + "\n").encode(encoding)
+        elif hasattr(item, "to_csv"):
+            # pandas dataframe (for instance a chunk of read_csv(..., chunksize=...))
+            chunk = item.to_csv(
+                sep=delimiter, quotechar=quote, header=False, index=False
+            ).encode(encoding)
         else:
+            writer.writerow(item)
+            chunk = buffer.getvalue().encode(encoding)
+            buffer.seek(0)
+            buffer.truncate()
+        pending.append(chunk)
+        pending_size += len(chunk)
+        # grouping small items so that we don't send one row at a time
+        if pending_size >= COPY_CHUNK_SIZE:
+            yield b"".join(pending)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield b"".join(pending)
+
+
+def copy_iterable(
+    cursor,
+    PG_TABLE: str,
+    data: Iterable,
+    columns: Optional[List[str]] = None,
+    has_header: bool = False,
+    delimiter: str = ",",
+    quote: str = '"',
+    transform: Optional[Callable] = None,
+    encoding: str = "utf-8",
+):
+    """Stream data into a table with COPY, without writing it to disk first
+
+    Args:
+        cursor (Cursor): cursor from postgres connection, the caller handles the transaction
+        PG_TABLE (str): table to upload data
+        data (Iterable): any iterable of rows (lists/tuples, serialized as csv),
+        lines (str), raw chunks (bytes) or pandas dataframes (e.g. a chunked read_csv).
+        An open file, including gzip.open(..., "rt"), is an iterable of lines.
+        columns (List[str]): columns of the table to fill, in the order of the data
+        has_header (bool): whether the first line of the data is a header
+        delimiter (str): csv delimiter
+        quote (str): csv quote character
+        transform (Callable): applied on the fly to each item of data before it is sent,
+        returning None drops the item
+        encoding (str): encoding used for str items
+
+    Returns:
+        int: number of rows copied
+    """
+    COLUMNS = f"({', '.join(columns)})" if columns else ""
+    HEADER = "HEADER" if has_header else ""
+    cursor.copy_expert(
+        sql=(
+            f"COPY {PG_TABLE} {COLUMNS} FROM STDIN "
+            f"WITH CSV {HEADER} DELIMITER AS '{delimiter}' QUOTE AS '{quote}'"
+        ),
+        file=io.BufferedReader(
+            _IteratorFile(_serialize_for_copy(data, delimiter, quote, transform, encoding)),
+            buffer_size=COPY_CHUNK_SIZE,
+        ),
+        size=COPY_CHUNK_SIZE,
+    )
+    return cursor.rowcount
+
+
+def copy_stream(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_TABLE: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    data: Iterable,
+    PG_SCHEMA: Optional[str] = None,
+    columns: Optional[List[str]] = None,
+    has_header: bool = False,
+    delimiter: str = ",",
+    quote: str = '"',
+    transform: Optional[Callable] = None,
+):
+    """Stream data from any iterable to postgres instance, in a single transaction
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_TABLE (str): table to upload data
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        data (Iterable): rows, lines, bytes or dataframes, see copy_iterable
+        columns (List[str]): columns of the table to fill, in the order of the data
+        has_header (bool): whether the first line of the data is a header
+        delimiter (str): csv delimiter
+        quote (str): csv quote character
+        transform (Callable): applied on the fly to each item of data before it is sent
+
+    Returns:
+        int: number of rows copied
+    """
+    with transaction(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        with conn.cursor() as cur:
+            nb_rows = copy_iterable(
+                cur,
+                PG_TABLE,
+                data,
+                columns=columns,
+                has_header=has_header,
+                delimiter=delimiter,
+                quote=quote,
+                transform=transform,
+            )
+    return nb_rows
+
+
+def _copy_one_file(
+    conn_params: tuple,
+    staging_table: str,
+    file_conf: File,
+    has_header: bool,
+    delimiter: str,
+):
+    """Copy one local file into the staging table, on its own pooled connection"""
+    file_path = os.path.join(file_conf["source_path"], file_conf["source_name"])
+    COLUMNS = file_conf.get("column_order") or ""
+    HEADER = "HEADER" if has_header else ""
+    size = os.path.getsize(file_path)
+    start = time.time()
+    with transaction(*conn_params) as conn:
+        with conn.cursor() as cur, open(file_path, "r") as file:
+            cur.copy_expert(
+                sql=(
+                    f"COPY {staging_table} {COLUMNS} FROM STDIN "
+                    f"WITH CSV {HEADER} DELIMITER AS '{delimiter}'"
+                ),
+                file=file,
+                size=COPY_CHUNK_SIZE,
+            )
+            nb_rows = cur.rowcount
+    duration = max(time.time() - start, 1e-6)
+    return {
+        "file": file_path,
+        "rows": nb_rows,
+        "bytes": size,
+        "seconds": round(duration, 2),
+        "rows_per_s": round(nb_rows / duration),
+        "mb_per_s": round(size / 1024 ** 2 / duration, 2),
+    }
+
+
+def copy_files_parallel(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_TABLE: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    list_files: List[File],
+    PG_SCHEMA: Optional[str] = None,
+    has_header: Optional[bool] = True,
+    delimiter: str = ",",
+    max_workers: int = 4,
+    truncate: bool = False,
+):
+    """Copy several local files to a table concurrently, all or nothing
+
+    Files are loaded in parallel (one pooled connection per worker) into an
+    unlogged staging table shaped like the target. Once every file is in, the
+    staging content is moved to the target in a single transaction (after
+    emptying the target if `truncate`), so a failure on any file leaves the
+    target untouched.
+
+    The staging table is not swapped with the target even when truncating: a
+    rename would lose what hangs on the target (dependent views such as the
+    metrics materialized views, grants, serial sequences it owns, index names
+    that creation scripts rely on), and the UNLOGGED staging table would need a
+    full rewrite (SET LOGGED) to become permanent anyway. The rows are therefore
+    written twice, once in the staging table and once in the target.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_TABLE (str): table to upload data
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        list_files (List[File]): List of files containing raw data, see copy_file.
+        All files are expected to share the same `column_order`.
+        has_header (bool): whether the files have a header row
+        delimiter (str): csv delimiter of the files
+        max_workers (int): maximum number of files loaded at the same time,
+        capped by the size of the connection pool
+        truncate (bool): replace the content of the target instead of appending to it
+
+    Raises:
+        Exception: If one of the local file does not exist
+
+    Returns:
+        List[dict]: throughput report for each file (rows, bytes, rows/s, MB/s)
+    """
+    for file_conf in list_files:
+        if not os.path.isfile(os.path.join(file_conf["source_path"], file_conf["source_name"])):
             raise Exception(
                 f"file {file_conf['source_path']}{file_conf['source_name']} does not exists"
             )
-    return data
+    if not list_files:
+        return []
+    conn_params = (PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
+    schema, _, table_name = PG_TABLE.rpartition(".")
+    staging_table = (
+        f"{schema + '.' if schema else ''}{table_name}__staging_{uuid.uuid4().hex[:8]}"
+    )
+    COLUMNS = list_files[0].get("column_order") or ""
+    execute_query(
+        *conn_params[:5],
+        f"CREATE UNLOGGED TABLE {staging_table} (LIKE {PG_TABLE} INCLUDING DEFAULTS);",
+        PG_SCHEMA,
+    )
+    try:
+        reports = []
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, POOL_MAX_CONN))) as executor:
+            futures = [
+                executor.submit(
+                    _copy_one_file, conn_params, staging_table, file_conf, has_header, delimiter
+                )
+                for file_conf in list_files
+            ]
+            for future in as_completed(futures):
+                report = future.result()
+                print(
+                    f"> {report['file']}: {report['rows']} rows in {report['seconds']}s "
+                    f"({report['rows_per_s']} rows/s, {report['mb_per_s']} MB/s)"
+                )
+                reports.append(report)
+        print(f"> {len(list_files)} files loaded in staging in {round(time.time() - start, 2)}s")
+        with transaction(*conn_params) as conn:
+            with conn.cursor() as cur:
+                if truncate:
+                    cur.execute(f"TRUNCATE TABLE {PG_TABLE};")
+                cur.execute(
+                    f"INSERT INTO {PG_TABLE} {COLUMNS} "
+                    f"SELECT {COLUMNS.strip('()') or '*'} FROM {staging_table};"
+                )
+    finally:
+        execute_query(
+            *conn_params[:5],
+            f"DROP TABLE IF EXISTS {staging_table};",
+            PG_SCHEMA,
+        )
+    return reports
+
+
+def is_large_load(
+    estimated_rows: Optional[int] = None,
+    estimated_bytes: Optional[int] = None,
+    rows_threshold: int = BULK_LOAD_ROWS_THRESHOLD,
+    bytes_threshold: int = BULK_LOAD_BYTES_THRESHOLD,
+):
+    """Whether a load is big enough for maintaining indexes row by row to be slower
+    than rebuilding them afterwards"""
+    return (
+        (estimated_rows is not None and estimated_rows >= rows_threshold)
+        or (estimated_bytes is not None and estimated_bytes >= bytes_threshold)
+    )
+
+
+def get_estimated_table_rows(cursor, PG_TABLE: str) -> int:
+    """Number of rows of a table as estimated by the planner (0 if never analyzed)"""
+    cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", (PG_TABLE,))
+    return max(0, int(cursor.fetchone()[0]))
+
+
+def get_secondary_indexes(cursor, PG_TABLE: str):
+    """List the indexes of a table that can be dropped before a bulk load
+
+    Primary keys, unique indexes and indexes backing a constraint are left out,
+    as they guarantee the integrity of the data being loaded.
+
+    Args:
+        cursor (Cursor): cursor from postgres connection
+        PG_TABLE (str): table, optionally schema-qualified
+
+    Returns:
+        List[Tuple[str, str]]: schema-qualified name and definition of each index
+    """
+    cursor.execute(
+        """
+        SELECT n.nspname || '.' || i.relname, pg_get_indexdef(ix.indexrelid)
+        FROM pg_index ix
+        JOIN pg_class i ON i.oid = ix.indexrelid
+        JOIN pg_namespace n ON n.oid = i.relnamespace
+        WHERE ix.indrelid = %s::regclass
+        AND NOT ix.indisprimary
+        AND NOT ix.indisunique
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = ix.indexrelid)
+        """,
+        (PG_TABLE,),
+    )
+    return cursor.fetchall()
+
+
+@contextmanager
+def bulk_load(
+    cursor,
+    PG_TABLE: str,
+    estimated_rows: Optional[int] = None,
+    estimated_bytes: Optional[int] = None,
+    rows_threshold: int = BULK_LOAD_ROWS_THRESHOLD,
+    bytes_threshold: int = BULK_LOAD_BYTES_THRESHOLD,
+    min_table_share: Optional[float] = None,
+):
+    """Drop secondary indexes around a large load made in the caller's transaction
+
+    If the load is estimated to be large, the secondary indexes are dropped before
+    the block and rebuilt after it, then the table is analyzed. As the indexes are
+    rebuilt over the whole table, `min_table_share` can require the load to also be
+    a given share of the rows already in the table (from `estimated_rows` and the
+    planner's estimate of the table size). Everything happens
+    in the caller's transaction, so a rollback restores the indexes. Note that
+    DROP INDEX takes an ACCESS EXCLUSIVE lock on the table, held until the caller
+    commits: readers of the table are blocked during the whole load, so only use it
+    where that is acceptable (or use bulk_load_files, which commits each phase). Usage:
+
+        with bulk_load(cursor, "meteo.table", estimated_bytes=size) as timings:
+            copy_iterable(cursor, "meteo.table", data)
+
+    Args:
+        cursor (Cursor): cursor from postgres connection, the caller handles the transaction
+        PG_TABLE (str): table to load, optionally schema-qualified
+        estimated_rows (int): estimated number of rows to load
+        estimated_bytes (int): estimated size of the data to load
+        rows_threshold (int): number of rows above which the load is considered large
+        bytes_threshold (int): size above which the load is considered large
+        min_table_share (float): minimum share of the current rows of the table
+            that `estimated_rows` has to represent, not checked if None
+
+    Yields:
+        dict: duration (in seconds) of each phase, filled as the phases complete
+    """
+    timings = {}
+    indexes = []
+    large = is_large_load(estimated_rows, estimated_bytes, rows_threshold, bytes_threshold)
+    if large and min_table_share is not None:
+        table_rows = get_estimated_table_rows(cursor, PG_TABLE)
+        large = (estimated_rows or 0) >= min_table_share * table_rows
+        if not large:
+            print(
+                f"> Loading {estimated_rows} rows into {PG_TABLE} (~{table_rows} rows), "
+                "indexes are maintained row by row"
+            )
+    if large:
+        start = time.time()
+        indexes = get_secondary_indexes(cursor, PG_TABLE)
+        for name, _ in indexes:
+            cursor.execute(f"DROP INDEX {name};")
+        timings["drop_indexes"] = round(time.time() - start, 2)
+    start = time.time()
+    yield timings
+    timings["load"] = round(time.time() - start, 2)
+    if large:
+        start = time.time()
+        for _, definition in indexes:
+            cursor.execute(definition)
+        timings["rebuild_indexes"] = round(time.time() - start, 2)
+        start = time.time()
+        cursor.execute(f"ANALYZE {PG_TABLE};")
+        timings["analyze"] = round(time.time() - start, 2)
+    print(f"> Bulk load of {PG_TABLE} ({len(indexes)} indexes dropped): {timings}")
+
+
+def _create_index(conn_params: tuple, definition: str, concurrently: bool):
+    """Create one index on its own pooled connection"""
+    with pooled_conn(*conn_params) as conn:
+        if concurrently:
+            # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+            conn.autocommit = True
+            definition = definition.replace("CREATE INDEX ", "CREATE INDEX CONCURRENTLY ", 1)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(definition)
+            if not concurrently:
+                conn.commit()
+        finally:
+            conn.autocommit = False
+
+
+def bulk_load_files(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_TABLE: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    list_files: List[File],
+    PG_SCHEMA: Optional[str] = None,
+    has_header: Optional[bool] = True,
+    delimiter: str = ",",
+    max_workers: int = 4,
+    truncate: bool = False,
+    concurrently: bool = False,
+    bytes_threshold: int = BULK_LOAD_BYTES_THRESHOLD,
+):
+    """Load files with copy_files_parallel, dropping and rebuilding indexes if large
+
+    If the files weigh more than `bytes_threshold`, the secondary indexes of the
+    table are dropped before the load, then rebuilt in parallel (one connection
+    per index, optionally CONCURRENTLY so that readers are not blocked) and the
+    table is analyzed. Unlike bulk_load, the phases are committed one by one.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_TABLE (str): table to upload data
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        list_files (List[File]): List of files containing raw data, see copy_file
+        has_header (bool): whether the files have a header row
+        delimiter (str): csv delimiter of the files
+        max_workers (int): maximum number of files loaded / indexes built at the same time
+        truncate (bool): replace the content of the target instead of appending to it
+        concurrently (bool): rebuild indexes with CREATE INDEX CONCURRENTLY
+        bytes_threshold (int): size above which the load is considered large
+
+    Returns:
+        dict: duration (in seconds) of each phase
+    """
+    conn_params = (PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
+    timings = {}
+    indexes = []
+    estimated_bytes = sum(
+        os.path.getsize(os.path.join(f["source_path"], f["source_name"]))
+        for f in list_files
+        if os.path.isfile(os.path.join(f["source_path"], f["source_name"]))
+    )
+    large = is_large_load(estimated_bytes=estimated_bytes, bytes_threshold=bytes_threshold)
+    if large:
+        start = time.time()
+        with transaction(*conn_params) as conn:
+            with conn.cursor() as cur:
+                indexes = get_secondary_indexes(cur, PG_TABLE)
+                for name, _ in indexes:
+                    cur.execute(f"DROP INDEX {name};")
+        timings["drop_indexes"] = round(time.time() - start, 2)
+    start = time.time()
+    try:
+        copy_files_parallel(
+            *conn_params[:3],
+            PG_TABLE,
+            *conn_params[3:5],
+            list_files=list_files,
+            PG_SCHEMA=PG_SCHEMA,
+            has_header=has_header,
+            delimiter=delimiter,
+            max_workers=max_workers,
+            truncate=truncate,
+        )
+        timings["load"] = round(time.time() - start, 2)
+    finally:
+        # the drop is already committed: the indexes are rebuilt even if the load failed,
+        # otherwise the table would stay without them
+        if large:
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, POOL_MAX_CONN))) as executor:
+                for future in [
+                    executor.submit(_create_index, conn_params, definition, concurrently)
+                    for _, definition in indexes
+                ]:
+                    future.result()
+            timings["rebuild_indexes"] = round(time.time() - start, 2)
+    if large:
+        start = time.time()
+        execute_query(*conn_params[:5], f"ANALYZE {PG_TABLE};", PG_SCHEMA)
+        timings["analyze"] = round(time.time() - start, 2)
+    print(f"> Bulk load of {PG_TABLE} ({len(indexes)} indexes dropped): {timings}")
+    return timings
+
+
+def delete_by_keys(
+    cursor,
+    PG_TABLE: str,
+    key_columns: List[str],
+    keys: Iterable,
+    delimiter: str = ",",
+):
+    """Delete the rows matching a set of keys with a single set-based query
+
+    The keys are streamed with COPY into a temporary table (typed like the
+    target's columns, so that postgres does the casting), then removed with
+    one DELETE ... USING join.
+
+    Args:
+        cursor (Cursor): cursor from postgres connection, the caller handles the transaction
+        PG_TABLE (str): table to delete from, optionally schema-qualified
+        key_columns (List[str]): columns identifying the rows to delete
+        keys (Iterable): key values, as rows (in the order of key_columns) or csv lines
+        delimiter (str): csv delimiter, if keys are lines
+
+    Returns:
+        int: number of deleted rows
+    """
+    tmp_table = f"tmp_keys_{uuid.uuid4().hex[:8]}"
+    cursor.execute(
+        f"CREATE TEMP TABLE {tmp_table} ON COMMIT DROP AS "
+        f"SELECT {', '.join(key_columns)} FROM {PG_TABLE} WITH NO DATA;"
+    )
+    nb_keys = copy_iterable(cursor, tmp_table, keys, columns=key_columns, delimiter=delimiter)
+    if not nb_keys:
+        cursor.execute(f"DROP TABLE {tmp_table};")
+        return 0
+    cursor.execute(f"ANALYZE {tmp_table};")
+    cursor.execute(
+        f"DELETE FROM {PG_TABLE} t USING {tmp_table} k WHERE "
+        + " AND ".join(f"t.{c} = k.{c}" for c in key_columns)
+        + ";"
+    )
+    nb_deleted = cursor.rowcount
+    cursor.execute(f"DROP TABLE {tmp_table};")
+    return nb_deleted
+
+
+def apply_diff(
+    cursor,
+    PG_TABLE: str,
+    key_columns: List[str],
+    deletions: Optional[Iterable] = None,
+    additions: Optional[Iterable] = None,
+    columns: Optional[List[str]] = None,
+    has_header: bool = False,
+    delimiter: str = ",",
+):
+    """Apply a diff to a table: delete rows by key, then insert new rows
+
+    Args:
+        cursor (Cursor): cursor from postgres connection, the caller handles the transaction
+        PG_TABLE (str): table to update, optionally schema-qualified
+        key_columns (List[str]): columns identifying the rows to delete
+        deletions (Iterable): keys of the rows to delete, see delete_by_keys
+        additions (Iterable): rows to insert, see copy_iterable
+        columns (List[str]): columns of the table to fill with additions
+        has_header (bool): whether the additions start with a header line
+        delimiter (str): csv delimiter, for lines
+
+    Returns:
+        Tuple[int, int]: number of deleted and inserted rows
+    """
+    nb_deleted, nb_inserted = 0, 0
+    if deletions is not None:
+        nb_deleted = delete_by_keys(cursor, PG_TABLE, key_columns, deletions, delimiter=delimiter)
+    if additions is not None:
+        nb_inserted = copy_iterable(
+            cursor,
+            PG_TABLE,
+            additions,
+            columns=columns,
+            has_header=has_header,
+            delimiter=delimiter,
+        )
+    return nb_deleted, nb_inserted
@@ -1,6 +1,8 @@
 import csv
 from datetime import date, datetime
 import gzip
+import os
+import resource
 from typing import Optional
 
 import duckdb
@@ -103,3 +105,15 @@ def time_is_between(time1, time2):
     if time1 > time2:
         time1, time2 = time2, time1
     return time1 <= datetime.now().time() <= time2
+
+
+def get_peak_memory_mb():
+    """Return the memory high-water mark of the current process, in MB"""
+    # ru_maxrss is in kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def get_memory_mb():
+    """Return the current resident memory of the process, in MB (linux only)"""
+    with open("/proc/self/statm") as f:
+        return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2)